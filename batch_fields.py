@@ -0,0 +1,141 @@
+""" Runs the cluster_hdbscan.py pipeline (gaia_dr2_read_setup, scaled_features, and
+    clustering_algorithm) for every field in a manifest across a
+    pool of worker processes.  Each field's outputs are written to the output directory
+    along with a run summary, and a field that fails is recorded without stopping the
+    rest of the batch.
+
+    The manifest is a csv file with one field per row and the columns name and radius
+    (which together identify the "<name>gaiafield<radius>.csv" input file), and the
+    optional columns distance_scale, pm_scale, and min_samples, which default to the
+    cluster_hdbscan.py DISTANCE_SCALE, PM_SCALE, and MIN_SAMPLE.  The output files of
+    each field are prefixed by "<name>_r<radius>_", followed by the manifest row number
+    if the same field is listed more than once (e.g., with different scalings).  For
+    example:
+
+    name,radius,distance_scale,pm_scale,min_samples
+    blanco1,2.5,5,35,98
+    velaOB2,2,5,10,64
+
+    field_pipeline.py runs the same manifest with the stages of successive fields
+    overlapping instead.
+
+    Usage: python batch_fields.py manifest.csv [--workers N] [--output-dir DIR] """
+import argparse
+import os
+import time
+import traceback
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+import cluster_hdbscan
+from cluster_summary import ClusterSummary
+import pipeline_profile
+
+SUMMARY_NAME = "batch_summary.csv"
+
+
+def read_manifest(manifest_path):
+    """ Reads the manifest into a list of field dictionaries.  The radius is kept as
+    written (e.g., "2" rather than "2.0") so that it matches the input filename, and
+    missing optional values are left as None for the cluster_hdbscan.py defaults. """
+    manifest = pd.read_csv(manifest_path, dtype={"name": str, "radius": str})
+    repeated = manifest.duplicated(["name", "radius"], keep=False)
+    fields = []
+    for row_number, field in enumerate(manifest.to_dict("records")):
+        field["label"] = field["name"]+"_r"+field["radius"]
+        if repeated.iloc[row_number]:
+            field["label"] += "_"+str(row_number)
+        for column in ["distance_scale", "pm_scale", "min_samples"]:
+            if pd.isna(field.get(column, None)):
+                field[column] = None
+        if field["min_samples"] is not None:
+            field["min_samples"] = int(field["min_samples"])
+        fields.append(field)
+    return fields
+
+
+def field_prefix(field, output_dir):
+    """ The output filename prefix of a field. """
+    return os.path.join(output_dir, field["label"]+"_")
+
+
+def run_field(field, output_dir, core_dist_n_jobs):
+    """ Clusters one field, writing the CLUSTER_EXTRACT_NUM cluster members and the
+    ClusterSummary table of all clusters (and the stage report when GAIA_PROFILE is
+    set, see pipeline_profile.py).  Any error is caught and returned in the summary row
+    (with the traceback written to a file) rather than raised. """
+    # As in cluster_hdbscan.py, the HDBSCAN and pandas warnings are not shown.
+    warnings.filterwarnings("ignore")
+    start = time.time()
+    prefix = field_prefix(field, output_dir)
+    row = {"label": field["label"], "name": field["name"], "radius": field["radius"],\
+     "status": "ok", "stars": 0, "clusters": 0, "real_clusters": 0, "seconds": 0.0, "error": ""}
+    try:
+        with pipeline_profile.run(prefix):
+            fieldpar = cluster_hdbscan.gaia_dr2_read_setup(field["name"], field["radius"])
+            row["stars"] = len(fieldpar)
+            features = cluster_hdbscan.scaled_features(fieldpar, field["distance_scale"],\
+             field["pm_scale"])
+            source = cluster_hdbscan.feature_source(field["name"], field["radius"],\
+             field["distance_scale"], field["pm_scale"])
+            fieldpar = cluster_hdbscan.clustering_algorithm(features, fieldpar,\
+             field["min_samples"], prefix, core_dist_n_jobs, source=source)
+            summary = ClusterSummary(fieldpar)
+            summary.table.to_csv(prefix+"summary.csv")
+            row["clusters"] = len(summary.table)
+            row["real_clusters"] = len(summary.real_clusters)
+    except Exception as error:
+        row["status"] = "failed"
+        row["error"] = repr(error)
+        with open(prefix+"error.txt", "w") as outfile:
+            outfile.write(traceback.format_exc())
+    row["seconds"] = round(time.time() - start, 2)
+    return row
+
+
+def run_batch(fields, output_dir="batch_output", workers=None):
+    """ Runs every field across a process pool and writes the run summary.  The
+    HDBSCAN core distance jobs of each field are sized so the workers together use
+    about one job per core.  Returns the summary dataframe. """
+    cores = os.cpu_count() or 1
+    if workers is None:
+        workers = min(len(fields), cores)
+    workers = max(1, workers)
+    core_dist_n_jobs = max(1, cores//workers)
+    os.makedirs(output_dir, exist_ok=True)
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_field, field, output_dir, core_dist_n_jobs): field\
+         for field in fields}
+        for future in as_completed(futures):
+            field = futures[future]
+            try:
+                row = future.result()
+            except Exception as error:
+                # The worker process itself died (e.g., out of memory).
+                row = {"label": field["label"], "name": field["name"], "radius": field["radius"],\
+                 "status": "failed", "error": repr(error)}
+            print(row["label"]+": "+row["status"]+\
+             (" "+row["error"] if row["status"] != "ok" else ""))
+            rows.append(row)
+    summary = pd.DataFrame(rows).set_index("label")
+    summary = summary.reindex([field["label"] for field in fields]).reset_index()
+    summary.to_csv(os.path.join(output_dir, SUMMARY_NAME), index=False)
+    return summary
+
+
+def main():
+    """ Parses the command line and runs the batch. """
+    parser = argparse.ArgumentParser(description="Cluster every Gaia field in a manifest.")
+    parser.add_argument("manifest", help="csv file of fields (name, radius, and optional "\
+     "distance_scale, pm_scale, and min_samples)")
+    parser.add_argument("--workers", type=int, default=None,\
+     help="number of fields processed at once (default: one per core, up to the field count)")
+    parser.add_argument("--output-dir", default="batch_output", help="output directory")
+    args = parser.parse_args()
+    summary = run_batch(read_manifest(args.manifest), args.output_dir, args.workers)
+    print(summary.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
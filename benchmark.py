@@ -0,0 +1,379 @@
+""" Benchmarks of the clustering pipeline, run on synthetic fields (see
+    synthetic_field.py) so that any field size can be tested and the recovered clusters
+    can be compared with the injected ones.
+
+    scaling: the wall time and peak memory of every pipeline stage (reading the csv and
+    building the columnar store, reading the store, scaled_features, the HDBSCAN fit,
+    ClusterSummary, and the white dwarf search) over a range of field sizes and HDBSCAN
+    tree algorithms, along with how well the injected clusters are recovered.  Each field
+    size and algorithm runs in a fresh process, and the peaks are measured as in
+    pipeline_profile.StageMeter.
+
+    prefilter: the HDBSCAN time and injected cluster recovery of reference synthetic
+    fields clustered with and without the density prefilter (see density_prefilter.py),
+    with the number of rows (and injected cluster members) it removes.
+
+    distance: the time and accuracy of the Monte Carlo distances (see distance_engine.py)
+    under each prior against the direct inversion of the parallax, on parallaxes drawn
+    from known distances (with the exponentially decreasing space density prior and
+    uniform parallax errors of DISTANCE_ERROR_RANGE mas), and against the numerically
+    integrated posterior of each prior.
+
+    feature_memory: the peak memory (RSS) of building the HDBSCAN input and attaching
+    the cluster labels and probabilities, comparing the original dataframe path
+    (copy, ra_wrapper, parameter_scaler, and list labels) with the single
+    scaled_features array.  Each measurement runs in a fresh process so that the
+    peaks are independent.  The HDBSCAN fit itself is the same for every path and is
+    not run; only the float64 conversion HDBSCAN applies to its input is included.
+
+    Usage: python benchmark.py [scaling|prefilter|distance|memory|all] [--stars N [N ...]]
+     [--algorithms ALGORITHM [ALGORITHM ...]] [--seed SEED] """
+import argparse
+import contextlib
+import io
+import multiprocessing
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+import cluster_hdbscan
+import density_prefilter
+import distance_engine
+from pipeline_profile import StageMeter
+from synthetic_field import synthetic_field, write_field
+
+FEATURE_METHODS = ["dataframe", "float64", "float32"]
+MEMORY_STAR_COUNTS = [100000, 1000000, 3000000]
+
+# The requested disk field sizes (before the gaia_search.py parallax cuts) and the
+# HDBSCAN tree algorithms of the scaling benchmark.  The "generic" algorithm builds the
+# full distance matrix and is left out.
+SCALING_STAR_COUNTS = [10000, 30000, 100000]
+SCALING_ALGORITHMS = ["boruvka_kdtree", "boruvka_balltree", "prims_kdtree", "prims_balltree"]
+SCALING_STAGES = ["read_csv", "read_store", "scaled_features", "hdbscan", "cluster_summary",\
+ "wd_search"]
+SCALING_OUTPUT = "benchmark_scaling.csv"
+
+# An injected cluster counts as recovered when a real cluster (see cluster_plot) holds
+# at least this fraction of its stars and at least this fraction of that real
+# cluster's stars are injected members.
+RECOVERY_FRACTION = 0.5
+
+# The requested field sizes and the seeds of the reference fields of the density
+# prefilter comparison.
+PREFILTER_STAR_COUNTS = [30000, 100000]
+PREFILTER_SEEDS = [0, 1, 2]
+
+# The star counts and the parallax error range (mas) of the distance benchmark.
+DISTANCE_STAR_COUNTS = [1000000, 10000000]
+DISTANCE_ERROR_RANGE = (0.02, 0.3)
+
+# The stars whose Monte Carlo distances are checked against the numerically integrated
+# posterior, and the distance grid of that integration (points, and multiple of the
+# prior's range).
+ANALYTIC_STARS = 1000
+ANALYTIC_GRID_POINTS = 200000
+ANALYTIC_GRID_MAX = 2
+
+
+def random_field(star_count, seed=0):
+    """ A synthetic field (see synthetic_field.py) with the gaia_dr2_read_setup
+    columns, spanning RA=0,360 so the RA wrap is exercised. """
+    field = synthetic_field(star_count, seed=seed)
+    field = field[["ra", "dec", "pmra", "pmdec", "parallax", "phot_g_mean_mag", "bp_rp"]]
+    field["distance"] = 1/((field["parallax"]+0.03)*0.001)
+    return field
+
+
+def recovery(injected, labels, real_clusters):
+    """ Matches every injected cluster to the output cluster holding most of its stars,
+    and returns a dataframe (by injected cluster) of the matched cluster, its
+    completeness (the fraction of the injected stars it holds) and purity (the fraction
+    of its stars that are injected members), and whether the injected cluster was
+    recovered by a real cluster. """
+    rows = []
+    for number in np.unique(injected[injected >= 0]):
+        members = injected == number
+        member_labels = labels[members]
+        member_labels = member_labels[member_labels >= 0]
+        row = {"injected_cluster": number, "clusternum": -1, "completeness": 0.0,\
+         "purity": 0.0, "recovered": False}
+        if len(member_labels):
+            clusternum = np.bincount(member_labels).argmax()
+            matched = np.count_nonzero(member_labels == clusternum)
+            row.update(clusternum=clusternum, completeness=matched/np.count_nonzero(members),\
+             purity=matched/np.count_nonzero(labels == clusternum))
+            row["recovered"] = bool(clusternum in real_clusters and\
+             row["completeness"] >= RECOVERY_FRACTION and row["purity"] >= RECOVERY_FRACTION)
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def _scaling_run(star_count, algorithm, seed, results):
+    """ Runs the pipeline stages on one synthetic field with one HDBSCAN algorithm, and
+    reports the stage times, peaks, and recovery of the injected clusters. """
+    from cluster_hdbscan_wdsearch import white_dwarf_identification
+    from cluster_summary import ClusterSummary
+
+    field = synthetic_field(star_count, seed=seed)
+    meter = StageMeter()
+    with tempfile.TemporaryDirectory() as directory:
+        cluster_name = os.path.join(directory, "synthetic")
+        write_field(field, cluster_name, 2.5)
+        with meter.stage("read_csv"):
+            fieldpar = cluster_hdbscan.gaia_dr2_read_setup(cluster_name, 2.5)
+        with meter.stage("read_store"):
+            fieldpar = cluster_hdbscan.gaia_dr2_read_setup(cluster_name, 2.5)
+        with meter.stage("scaled_features"):
+            features = cluster_hdbscan.scaled_features(fieldpar)
+        with meter.stage("hdbscan"):
+            fieldpar = cluster_hdbscan.clustering_algorithm(features, fieldpar,\
+             cluster_name=cluster_name, core_dist_n_jobs=os.cpu_count() or 1, algorithm=algorithm)
+        with meter.stage("cluster_summary"):
+            summary = ClusterSummary(fieldpar)
+        with meter.stage("wd_search"), contextlib.redirect_stdout(io.StringIO()):
+            candidates = white_dwarf_identification(fieldpar)
+    meter.close()
+    # The field store keeps the csv row numbers as the index.
+    injected = field["injected_cluster"].to_numpy()[fieldpar.index]
+    matches = recovery(injected, fieldpar["clusternum"].to_numpy(), summary.real_clusters)
+    row = {"stars": len(fieldpar), "algorithm": algorithm}
+    for stage in SCALING_STAGES:
+        row[stage+"_s"] = round(meter.seconds[stage], 3)
+        row[stage+"_mb"] = round(meter.peak_mb[stage], 1)
+    row.update(injected=len(matches), recovered=int(matches["recovered"].sum()),\
+     completeness=round(matches["completeness"].mean(), 3),\
+     purity=round(matches["purity"].mean(), 3), real_clusters=len(summary.real_clusters),\
+     wd_candidates=len(candidates))
+    results.put(row)
+
+
+def scaling(star_counts=SCALING_STAR_COUNTS, algorithms=SCALING_ALGORITHMS, seed=0):
+    """ Runs the scaling benchmark for every field size and HDBSCAN algorithm and
+    returns the table, one row per run (stage times in s and peaks in MB). """
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    for star_count in star_counts:
+        for algorithm in algorithms:
+            results = context.Queue()
+            process = context.Process(target=_scaling_run, args=(star_count, algorithm, seed,\
+             results))
+            process.start()
+            rows.append(results.get())
+            process.join()
+            print(str(rows[-1]["stars"])+" stars, "+algorithm+": HDBSCAN "+\
+             str(rows[-1]["hdbscan_s"])+" s, "+str(rows[-1]["recovered"])+" of "+\
+             str(rows[-1]["injected"])+" injected clusters recovered")
+    return pd.DataFrame(rows)
+
+
+def _prefilter_run(star_count, seed, results):
+    """ Clusters one synthetic field with and without the density prefilter (after a
+    small warm-up fit, so that neither pays the one-off start-up cost of the first fit)
+    and reports the HDBSCAN times, the rows removed, and the injected cluster recovery
+    of both. """
+    import hdbscan
+    from cluster_summary import ClusterSummary
+
+    warmup = random_field(2000, seed=seed)
+    hdbscan.HDBSCAN(min_cluster_size=50, core_dist_n_jobs=os.cpu_count() or 1).\
+     fit(cluster_hdbscan.scaled_features(warmup))
+    field = synthetic_field(star_count, seed=seed)
+    row = {"seed": seed}
+    with tempfile.TemporaryDirectory() as directory:
+        cluster_name = os.path.join(directory, "synthetic")
+        write_field(field, cluster_name, 2.5)
+        fieldpar = cluster_hdbscan.gaia_dr2_read_setup(cluster_name, 2.5)
+        injected = field["injected_cluster"].to_numpy()[fieldpar.index]
+        row["stars"] = len(fieldpar)
+        for prefilter in [False, True]:
+            features = cluster_hdbscan.scaled_features(fieldpar)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                fieldpar = cluster_hdbscan.clustering_algorithm(features, fieldpar,\
+                 cluster_name=cluster_name, core_dist_n_jobs=os.cpu_count() or 1,\
+                 prefilter=prefilter)
+            seconds = time.perf_counter() - start
+            summary = ClusterSummary(fieldpar)
+            matches = recovery(injected, fieldpar["clusternum"].to_numpy(), summary.real_clusters)
+            prefix = "prefilter_" if prefilter else "full_"
+            row[prefix+"s"] = round(seconds, 3)
+            row[prefix+"recovered"] = int(matches["recovered"].sum())
+            row[prefix+"completeness"] = round(matches["completeness"].mean(), 3)
+            row[prefix+"purity"] = round(matches["purity"].mean(), 3)
+        keep = density_prefilter.dense_rows(features)
+        row["removed"] = int(np.count_nonzero(~keep))
+        row["injected_removed"] = int(np.count_nonzero(~keep & (injected >= 0)))
+        row["injected"] = len(matches)
+    results.put(row)
+
+
+def prefilter_comparison(star_counts=PREFILTER_STAR_COUNTS, seeds=PREFILTER_SEEDS):
+    """ Runs the density prefilter comparison for every field size and seed and returns
+    the table, one row per field. """
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    for star_count in star_counts:
+        for seed in seeds:
+            results = context.Queue()
+            process = context.Process(target=_prefilter_run, args=(star_count, seed, results))
+            process.start()
+            rows.append(results.get())
+            process.join()
+            print(str(rows[-1]["stars"])+" stars, seed "+str(seed)+": removed "+\
+             str(rows[-1]["removed"])+", HDBSCAN "+str(rows[-1]["full_s"])+" s -> "+\
+             str(rows[-1]["prefilter_s"])+" s, recovered "+str(rows[-1]["full_recovered"])+\
+             " -> "+str(rows[-1]["prefilter_recovered"])+" of "+str(rows[-1]["injected"]))
+    return pd.DataFrame(rows)
+
+
+def analytic_quantiles(parallax, parallax_error, prior, quantiles, grid_points=None):
+    """ The (stars, quantiles) distance quantiles (pc) of the posterior of each star
+    under a distance_engine.py prior, integrated numerically on a grid of grid_points
+    (default ANALYTIC_GRID_POINTS) distances out to ANALYTIC_GRID_MAX times the prior's
+    range, as the reference of the Monte Carlo quantiles. """
+    if grid_points is None:
+        grid_points = ANALYTIC_GRID_POINTS
+    reach = distance_engine.DISTANCE_MAX if prior == "uniform" else \
+        10*distance_engine.DISTANCE_LENGTH_SCALE
+    distance = np.linspace(1, ANALYTIC_GRID_MAX*reach, grid_points)
+    values = np.empty((len(parallax), len(quantiles)))
+    for row, (star_parallax, star_error) in enumerate(zip(parallax, parallax_error)):
+        observed = star_parallax + distance_engine.PARALLAX_ZEROPOINT
+        posterior = np.exp(-0.5*((1000/distance - observed)/star_error)**2)
+        if prior == "none":
+            # The inverted parallax draws: the likelihood times 1/distance^2.
+            posterior /= distance**2
+        elif prior == "uniform":
+            posterior *= np.where(distance <= distance_engine.DISTANCE_MAX, distance**2, 0)
+        else:
+            posterior *= distance**2*np.exp(-distance/distance_engine.DISTANCE_LENGTH_SCALE)
+        cumulative = np.cumsum(posterior)
+        values[row] = np.interp(quantiles, cumulative/cumulative[-1], distance)
+    return values
+
+
+def distance_comparison(star_counts=DISTANCE_STAR_COUNTS, seed=0):
+    """ Times the direct parallax inversion and the Monte Carlo distances under every
+    prior, and returns the table of their speed, median fractional error against the
+    true distances (of every star, and of the stars with a parallax error ratio above
+    cluster_hdbscan.PARALLAX_RATIO_CUT), the fraction of stars with no distance, the
+    fraction of true distances within the 16th to 84th percentiles, and the median
+    largest fractional difference of the percentiles of ANALYTIC_STARS stars above the
+    ratio cut from those of the numerically integrated posterior of the prior. """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for star_count in star_counts:
+        true_distance = rng.gamma(3, distance_engine.DISTANCE_LENGTH_SCALE, star_count)
+        parallax_error = rng.uniform(DISTANCE_ERROR_RANGE[0], DISTANCE_ERROR_RANGE[1], star_count)
+        parallax = 1000/true_distance + rng.normal(0, 1, star_count)*parallax_error - \
+            distance_engine.PARALLAX_ZEROPOINT
+        precise = parallax/parallax_error > cluster_hdbscan.PARALLAX_RATIO_CUT
+        for method in ["direct"]+distance_engine.PRIORS:
+            start = time.perf_counter()
+            if method == "direct":
+                with np.errstate(divide="ignore"):
+                    median = 1/((parallax+0.03)*0.001)
+                lower = upper = None
+                median[median <= 0] = np.nan
+            else:
+                lower, median, upper = distance_engine.star_distances(parallax, parallax_error,\
+                 method, quantiles=[0.16, 0.5, 0.84]).T
+            seconds = time.perf_counter() - start
+            error = np.abs(median - true_distance)/true_distance
+            row = {"stars": star_count, "method": method, "s": round(seconds, 3),\
+             "mstars_per_s": round(star_count/seconds/1e6, 2),\
+             "median_error": round(np.nanmedian(error), 4),\
+             "median_error_precise": round(np.nanmedian(error[precise]), 4),\
+             "undefined": round(np.mean(np.isnan(median)), 4)}
+            if lower is not None:
+                row["coverage_68"] = round(np.mean((lower <= true_distance) & (true_distance <= upper)), 3)
+                checked = np.flatnonzero(precise)[:ANALYTIC_STARS]
+                expected = analytic_quantiles(parallax[checked], parallax_error[checked], method,\
+                 [0.16, 0.5, 0.84])
+                found = np.column_stack([lower[checked], median[checked], upper[checked]])
+                row["analytic_error"] = round(np.median(np.abs(found/expected - 1).max(axis=1)), 4)
+            rows.append(row)
+            print(str(star_count)+" stars, "+method+": "+str(row["s"])+" s, median error "+\
+             str(row["median_error"]))
+    return pd.DataFrame(rows)
+
+
+def _feature_peak(method, star_count, results):
+    """ Builds the HDBSCAN input and attaches dummy labels with one method, and reports
+    the peak memory above that of the input field itself. """
+    fieldpar = random_field(star_count)
+    labels = np.zeros(len(fieldpar), dtype=np.intp)
+    probabilities = np.zeros(len(fieldpar))
+    # The field generation peak is above that of the features, so the peaks are sampled.
+    meter = StageMeter()
+    with meter.stage(method):
+        if method == "dataframe":
+            fieldparscaled = fieldpar.copy()
+            fieldparscaled = cluster_hdbscan.ra_wrapper(fieldparscaled)
+            fieldparscaled = cluster_hdbscan.parameter_scaler(fieldparscaled, fieldpar)
+            features = np.asarray(fieldparscaled[["ra", "dec", "pmra", "pmdec", "parallax"]],\
+             dtype=np.float64)
+            fieldpar["clusternum"] = labels.tolist()
+            fieldpar["clusterprob"] = probabilities.tolist()
+            fieldpar["ratransform"] = fieldparscaled["ratransform"]
+            fieldpar["rawrapped"] = fieldparscaled["rawrapped"]
+        else:
+            features = cluster_hdbscan.scaled_features(fieldpar, dtype=np.dtype(method))
+            # The conversion HDBSCAN applies to any input that is not float64.
+            features = np.asarray(features, dtype=np.float64)
+            fieldpar["clusternum"] = labels
+            fieldpar["clusterprob"] = probabilities
+    meter.close()
+    results.put(meter.peak_mb[method])
+
+
+def feature_memory(star_counts=MEMORY_STAR_COUNTS, methods=FEATURE_METHODS):
+    """ Measures the peak memory of every method for every field size and returns the
+    table (MB above the input field). """
+    context = multiprocessing.get_context("spawn")
+    rows = []
+    for star_count in star_counts:
+        row = {"stars": star_count}
+        for method in methods:
+            results = context.Queue()
+            process = context.Process(target=_feature_peak, args=(method, star_count, results))
+            process.start()
+            row[method+"_mb"] = round(results.get(), 1)
+            process.join()
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main():
+    """ Parses the command line, runs the benchmarks, and outputs the results to screen
+    (and the scaling table to SCALING_OUTPUT). """
+    parser = argparse.ArgumentParser(description="Benchmark the clustering pipeline.")
+    parser.add_argument("benchmark", nargs="?", default="all", choices=["scaling", "prefilter", "distance",\
+     "memory", "all"])
+    parser.add_argument("--stars", type=int, nargs="+", default=None,\
+     help="field sizes (default: SCALING_STAR_COUNTS, PREFILTER_STAR_COUNTS,\
+     DISTANCE_STAR_COUNTS, or MEMORY_STAR_COUNTS)")
+    parser.add_argument("--algorithms", nargs="+", default=SCALING_ALGORITHMS,\
+     help="HDBSCAN algorithms of the scaling benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="synthetic field seed")
+    args = parser.parse_args()
+    if args.benchmark in ["scaling", "all"]:
+        print("Stage wall time (s), peak memory (MB), and injected cluster recovery:")
+        table = scaling(args.stars or SCALING_STAR_COUNTS, args.algorithms, args.seed)
+        print(table.to_string(index=False))
+        table.to_csv(SCALING_OUTPUT, index=False)
+    if args.benchmark in ["prefilter", "all"]:
+        print("HDBSCAN time (s) and injected cluster recovery with and without the prefilter:")
+        print(prefilter_comparison(args.stars or PREFILTER_STAR_COUNTS).to_string(index=False))
+    if args.benchmark in ["distance", "all"]:
+        print("Time (s) and accuracy of the Monte Carlo distances against the direct inversion:")
+        print(distance_comparison(args.stars or DISTANCE_STAR_COUNTS, args.seed).to_string(index=False))
+    if args.benchmark in ["memory", "all"]:
+        print("Peak memory (MB) of the HDBSCAN input above the input field:")
+        print(feature_memory(args.stars or MEMORY_STAR_COUNTS).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
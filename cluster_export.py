@@ -0,0 +1,113 @@
+""" Exports every cluster of a clustered field at once, so that a different cluster number
+    never needs another HDBSCAN run.  The labelled stars are grouped by clusternum with
+    one stable sort, and each column is gathered once into cluster order and then
+    written cluster by cluster, as one .npy file per column in a directory per field and
+    cluster:
+
+    <EXPORT_DIR>/field=<CLUSTER_NAME>/clusternum=<N>/<column>.npy
+
+    The field directory also holds the per-cluster summary table (the ClusterSummary
+    medians and IQRs and the real cluster flag) as summary.csv, and a manifest of the
+    columns and cluster sizes.  load_cluster reads (memory-maps) only the files of the
+    requested cluster. """
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+from cluster_summary import ClusterSummary
+import pipeline_profile
+
+EXPORT_DIR = "cluster_export"
+
+# The exported columns (when present); the csv row number is kept as the row column.
+EXPORT_COLUMNS = ["ra", "dec", "pmra", "pmdec", "parallax", "phot_g_mean_mag", "bp_rp",\
+ "distance", "clusterprob", "M_G", "ratransform", "rawrapped"]
+
+# This flag determines whether or not the unclustered stars (clusternum -1) are exported
+# as their own partition.  Enter 1 for yes and 0 for no.
+EXPORT_NOISE = 0
+
+MANIFEST_NAME = "manifest.json"
+EXPORT_VERSION = 1
+
+
+def field_dir(field, export_dir=None):
+    """ The directory of a field's export. """
+    if export_dir is None:
+        export_dir = EXPORT_DIR
+    return os.path.join(export_dir, "field="+str(field))
+
+
+def cluster_dir(field, clusternum, export_dir=None):
+    """ The directory of one cluster's partition. """
+    return os.path.join(field_dir(field, export_dir), "clusternum="+str(int(clusternum)))
+
+
+def export_clusters(fieldpar, field, export_dir=None, summary=None, include_noise=None):
+    """ Writes every cluster of a clustered field (with the clusternum column) and its
+    summary table (summary, default the ClusterSummary with the cluster_plot cuts).  The
+    export is built in a temporary directory that replaces any earlier export of the
+    field only once it is complete.  Returns the summary table. """
+    if include_noise is None:
+        include_noise = EXPORT_NOISE == 1
+    if summary is None:
+        summary = ClusterSummary(fieldpar)
+    with pipeline_profile.stage("export_clusters", len(fieldpar)) as stage:
+        labels = fieldpar["clusternum"].to_numpy()
+        exported = np.flatnonzero(labels >= (-1 if include_noise else 0))
+        # One stable sort groups the stars by cluster, keeping their field order.
+        order = exported[np.argsort(labels[exported], kind="stable")]
+        numbers, starts, counts = np.unique(labels[order], return_index=True, return_counts=True)
+        columns = {"row": fieldpar.index.to_numpy()}
+        for name in EXPORT_COLUMNS:
+            if name in fieldpar:
+                columns[name] = fieldpar[name].to_numpy()
+
+        final_dir = field_dir(field, export_dir)
+        build_dir = final_dir+".tmp"
+        shutil.rmtree(build_dir, ignore_errors=True)
+        partitions = [os.path.join(build_dir, "clusternum="+str(int(clusternum))) for clusternum in numbers]
+        for partition in partitions:
+            os.makedirs(partition)
+        for name, values in columns.items():
+            grouped = values[order]
+            for partition, start, count in zip(partitions, starts, counts):
+                np.save(os.path.join(partition, name+".npy"), grouped[start:start + count])
+        summary.table.to_csv(os.path.join(build_dir, "summary.csv"))
+        manifest = {"version": EXPORT_VERSION, "field": str(field), "columns": list(columns),\
+         "clusters": {str(int(clusternum)): int(count) for clusternum, count in zip(numbers, counts)}}
+        with open(os.path.join(build_dir, MANIFEST_NAME), "w") as outfile:
+            json.dump(manifest, outfile, indent=1)
+        old_dir = final_dir+".old"
+        if os.path.exists(final_dir):
+            os.replace(final_dir, old_dir)
+        os.replace(build_dir, final_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        stage.rows_out = len(order)
+    return summary.table
+
+
+def read_manifest(field, export_dir=None):
+    """ The manifest of a field's export. """
+    with open(os.path.join(field_dir(field, export_dir), MANIFEST_NAME)) as infile:
+        return json.load(infile)
+
+
+def load_summary(field, export_dir=None):
+    """ The per-cluster summary table of a field's export. """
+    return pd.read_csv(os.path.join(field_dir(field, export_dir), "summary.csv"),\
+     index_col="clusternum")
+
+
+def load_cluster(field, clusternum, export_dir=None, columns=None):
+    """ The stars of one exported cluster as a dataframe indexed by csv row number, read
+    from that cluster's files only (all exported columns, or just columns). """
+    directory = cluster_dir(field, clusternum, export_dir)
+    if columns is None:
+        columns = [name for name in read_manifest(field, export_dir)["columns"] if name != "row"]
+    rows = np.load(os.path.join(directory, "row.npy"))
+    stars = pd.DataFrame({name: np.load(os.path.join(directory, name+".npy"), mmap_mode="r")\
+     for name in columns}, index=pd.Index(rows))
+    stars["clusternum"] = int(clusternum)
+    return stars
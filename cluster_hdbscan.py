@@ -1,11 +1,17 @@
 """Clusters Gaia DR2 data into groups with open cluster characteristics"""
-import hdbscan
-import numpy as np
-import pandas as pd
+import time
 import warnings
+import numpy as np
 from cluster_plot import cluster_plot
+from cluster_summary import ClusterSummary
+from field_store import field_dataframe, field_filename, source_hash
+import density_prefilter
+from lazy_import import lazy_module
+import pipeline_profile
+import result_cache
 
-warnings.filterwarnings("ignore")
+# HDBSCAN is only imported when a field is clustered.
+hdbscan = lazy_module("hdbscan")
 
 # This selects which output cluster data the program will write to a csv file
 # for subsequent analysis.  The star cluster of interest is commonly "0", but
@@ -30,37 +36,97 @@ FIELD_RADIUS = 2
 
 MIN_SAMPLE = 98
 
-def gaia_dr2_read_setup():
+# Stars with a parallax/parallax_error ratio at or below PARALLAX_RATIO_CUT are dropped.
+PARALLAX_RATIO_CUT = 5
+
+# The default parameter_scaler scalings: the distance (pc) is divided by DISTANCE_SCALE
+# and the proper motions (mas/yr) are multiplied by PM_SCALE.
+DISTANCE_SCALE = 5
+PM_SCALE = 35
+
+# The data type of the scaled_features array handed to HDBSCAN.  HDBSCAN converts its
+# input to float64 internally, so float64 avoids a second copy of the array; float32
+# halves the array itself but HDBSCAN then makes its own float64 copy.
+FEATURE_DTYPE = np.float64
+
+# This flag determines whether or not the HDBSCAN results are saved to and re-used from
+# the result cache (see result_cache.py), so that re-plotting or extracting a different
+# cluster does not re-run HDBSCAN.  Enter 1 for yes and 0 for no.
+USE_RESULT_CACHE = 1
+
+# This flag determines whether or not stars in the sparsest parts of the scaled
+# parameter space are labelled as field stars before HDBSCAN is run, which shrinks the
+# HDBSCAN input of large fields (see density_prefilter.py).  Enter 1 for yes and 0 for no.
+USE_DENSITY_PREFILTER = 0
+
+# This flag determines whether or not DISTANCE_SCALE and PM_SCALE are replaced by the
+# scalings chosen by scale_optimizer.py, which are written to "<CLUSTER_NAME>scales.json".
+# Enter 1 for yes and 0 for no.
+AUTO_SCALE = 0
+
+# This flag determines whether or not every cluster (not only CLUSTER_EXTRACT_NUM) and
+# the cluster summary table are exported to the partitioned cluster_export directory
+# (see cluster_export.py).  Enter 1 for yes and 0 for no.
+EXPORT_ALL_CLUSTERS = 0
+
+# This flag determines whether or not the real clusters are cross-matched against the
+# reference cluster catalogue and the exported clusters of earlier runs, and their
+# nearest known counterparts printed (see cross_match.py; the earlier runs are only there
+# with EXPORT_ALL_CLUSTERS set, and nothing is printed without any known clusters from
+# other fields).  Enter 1 for yes and 0 for no.
+CROSS_MATCH_CLUSTERS = 0
+
+# This flag determines whether or not the distance column is the median of Monte Carlo
+# draws from each star's parallax error under a space density prior, instead of the
+# direct inversion of the parallax (see distance_engine.py for the prior and the
+# number of draws).  Enter 1 for yes and 0 for no.
+USE_DISTANCE_ENGINE = 0
+
+# This flag determines whether or not the HDBSCAN tree algorithm, leaf size, and number
+# of core distance threads are chosen from the field size, the number of features, and
+# the cores, using the timings calibrated on this machine by "python hdbscan_backend.py
+# calibrate" (see hdbscan_backend.py).  Enter 1 for yes, or 0 for the HDBSCAN defaults
+# with 4 threads (which are also used on a machine that has not been calibrated).
+AUTO_BACKEND = 1
+
+def gaia_dr2_read_setup(cluster_name=None, field_radius=None, parallax_ratio_cut=PARALLAX_RATIO_CUT):
     """ Read the input csv file (from GaiaSearch.py) into a dataframe.  Return the
     calculated distance and further important parameters and drop stars that are
-    missing these parameters.  """
-    clusterfull = pd.read_csv(CLUSTER_NAME+"gaiafield"+str(FIELD_RADIUS)+".csv", delimiter=",")
+    missing these parameters.  The csv is only parsed on the first run of a field;
+    later runs memory-map the columnar store built from it (see field_store.py).
+    cluster_name and field_radius default to CLUSTER_NAME and FIELD_RADIUS, and a
+    parallax_ratio_cut of None keeps every parallax error ratio. """
+    if cluster_name is None:
+        cluster_name = CLUSTER_NAME
+    if field_radius is None:
+        field_radius = FIELD_RADIUS
 
-# A second dataframe is created that only contains the parameters that will
-# be used to base the HDBSCAN clustering on and for analyzing the results, and this command
+# A dataframe is created that only contains the parameters that will be used to
+# base the HDBSCAN clustering on and for analyzing the results, and this command
 # also allows the user to make further parallax error ratio cuts beyond the standard < 3; lastly, 
-# stars that are missing a parameter are dropped.
-    clusterfull["parallax_ratio"] = clusterfull["parallax"] / clusterfull["parallax_error"]
-    fieldparfull = clusterfull.loc[clusterfull["parallax_ratio"] > 5, ["ra", "dec", "pmra",\
-     "pmdec", "parallax", "phot_g_mean_mag", "bp_rp"]]
-    fieldpar = fieldparfull.dropna().copy()
-
-# A new distance (pc) column is created in the dataframe based on the observed
-# parallax.  A 0.03 zeropoint correction is applied.
-    fieldpar['distance'] = 1/((fieldpar['parallax']+0.03)*0.001)
+# stars that are missing a parameter are dropped.  A new distance (pc) column is
+# included based on the observed parallax, with a 0.03 zeropoint correction applied.
+    with pipeline_profile.stage("read_field") as stage:
+        fieldpar = field_dataframe(field_filename(cluster_name, field_radius),\
+         parallax_ratio_cut=parallax_ratio_cut,\
+         extra_columns=["parallax_error"] if USE_DISTANCE_ENGINE == 1 else [])
+        stage.rows_out = len(fieldpar)
+    if USE_DISTANCE_ENGINE == 1:
+        import distance_engine
+
+        fieldpar = distance_engine.add_distances(fieldpar)
     return fieldpar
 
 
-def ra_wrapper(ra_dataframe):
-    """ The input RA are checked to see if they wrap around RA=0,360 and are
-    corrected.  In either case, the RA is also transformed to a uniform scale
-    and added to the main dataframe and returned.  Note that this program may
-    have some difficulty around the poles, but there are no clusters to analyze
-    in those regions."""
-    ramax = max(ra_dataframe["ra"])
-    ramin = min(ra_dataframe["ra"])
+def ra_center(ra):
+    """ The numpy core of ra_wrapper.  Returns the RA center (degrees) the RA are
+    transformed about, whether the RA wrap around RA=0,360, and the wrapped and
+    transformed RA arrays. """
+    ra = np.asarray(ra, dtype=np.float64)
+    ramax = ra.max()
+    ramin = ra.min()
     wrap_check = 0
-    ra_dataframe["rawrapped"] = ra_dataframe["ra"]
+    rawrapped = ra.copy()
     # If the maximum and minimum RA are more than 200 degrees apart, it is safe to
     # assume that this is because they span RA=0,360.  In this case, the minimum
     # of the large values (~355 deg) and the maximum of the small value (~5 deg)
@@ -68,49 +134,155 @@ def ra_wrapper(ra_dataframe):
     # together the RA.
     if ramax - ramin > 200:
         wrap_check = 1
-        ramax = ra_dataframe.loc[ra_dataframe["ra"] < 200, ["ra"]].max().at["ra"]
-        ramin = ra_dataframe.loc[ra_dataframe["ra"] > 200, ["ra"]].min().at["ra"]
+        ramax = ra[ra < 200].max()
+        ramin = ra[ra > 200].min()
         if ramin < (360 - ramax):
             ramax += 360
-            ra_dataframe.loc[ra_dataframe['rawrapped'] >= 0, 'rawrapped'] = \
-             ra_dataframe['rawrapped']+360
+            rawrapped[rawrapped >= 0] += 360
         else:
             ramin -= 360
-            ra_dataframe.loc[ra_dataframe['rawrapped'] > 180, 'rawrapped'] = \
-             ra_dataframe['rawrapped']-360
+            rawrapped[rawrapped > 180] -= 360
     racen = (ramin + ramax)/2
-    ra_dataframe["ratransform"] = ra_dataframe["ra"] - racen
+    ratransform = ra - racen
     if wrap_check == 1:
-        ra_dataframe.loc[ra_dataframe['ratransform'] > 180, 'ratransform'] = \
-         ra_dataframe['ratransform']-360
-        ra_dataframe.loc[ra_dataframe['ratransform'] < -180, 'ratransform'] = \
-         ra_dataframe['ratransform']+360
+        ratransform[ratransform > 180] -= 360
+        ratransform[ratransform < -180] += 360
+    return racen, wrap_check, rawrapped, ratransform
+
+
+def ra_wrapper(ra_dataframe):
+    """ The input RA are checked to see if they wrap around RA=0,360 and are
+    corrected.  In either case, the RA is also transformed to a uniform scale
+    and added to the main dataframe and returned.  Note that this program may
+    have some difficulty around the poles, but there are no clusters to analyze
+    in those regions."""
+    _, _, ra_dataframe["rawrapped"], ra_dataframe["ratransform"] = ra_center(ra_dataframe["ra"])
     return ra_dataframe
 
 
-def parameter_scaler(fieldparscaled, fieldpar):
+def parameter_scaler(fieldparscaled, fieldpar, distance_scale=None, pm_scale=None):
     """ Apply appropriate scales to normalize the parameters or place them in a
      uniform space.  The most appropriate scaling can be cluster dependent.  Most
      notably with increasing distance, the cluster distance and PM variations of
      true members increase due to increased errors. I recommend scaling these so
      that the output unscaled IQRs of the cluster members for each parameter are
      roughly equal by adjusting what fieldpar['distance'] is divided by and what
-     fieldpar['pmra'] and ['pmdec'] are multiplied by. """
+     fieldpar['pmra'] and ['pmdec'] are multiplied by (distance_scale and pm_scale,
+     which default to DISTANCE_SCALE and PM_SCALE). """
+    if distance_scale is None:
+        distance_scale = DISTANCE_SCALE
+    if pm_scale is None:
+        pm_scale = PM_SCALE
 
-    fieldparscaled['parallax'] = fieldpar['distance']/5
+    fieldparscaled['parallax'] = fieldpar['distance']/distance_scale
     fieldparscaled['ratransform'] = fieldparscaled['ratransform']* \
         np.cos(fieldpar["dec"]*3.14159/180)
     fieldparscaled['ra'] = fieldparscaled['ratransform']*3.14159/180* \
         fieldpar['distance']
     fieldparscaled['dec'] = fieldpar['dec']*3.14159/180*fieldpar['distance']
-    fieldparscaled['pmra'] = fieldpar['pmra']*35
-    fieldparscaled['pmdec'] = fieldpar['pmdec']*35
+    fieldparscaled['pmra'] = fieldpar['pmra']*pm_scale
+    fieldparscaled['pmdec'] = fieldpar['pmdec']*pm_scale
     return fieldparscaled
 
 
-def clustering_algorithm(fieldparscaled, fieldpar):
-    """ The scaled parameters are applied to the hdbscan function. A minimum cluster
-     and sample size are set.  64 is typically an appropriate min_samples for a
+def scaling_parameters(fieldpar, distance_scale=None, pm_scale=None):
+    """ The parameters that fix the scaled_features transformation of a field: the RA
+    center and wrap state from ra_center, and the distance and PM scalings (defaulting
+    to DISTANCE_SCALE and PM_SCALE).  Passing them back to scaled_features scales new
+    stars exactly as the field was. """
+    if distance_scale is None:
+        distance_scale = DISTANCE_SCALE
+    if pm_scale is None:
+        pm_scale = PM_SCALE
+    racen, wrap_check, rawrapped, _ = ra_center(fieldpar["ra"])
+    # Which of the two ra_center wrap corrections was applied to the wrapped RA.
+    rawrap_shift = 0
+    if wrap_check == 1:
+        rawrap_shift = 360 if rawrapped.min() >= 360 else -360
+    return {"racen": float(racen), "wrap_check": wrap_check, "rawrap_shift": rawrap_shift,\
+     "distance_scale": distance_scale, "pm_scale": pm_scale}
+
+
+def scaled_features(fieldpar, distance_scale=None, pm_scale=None, dtype=None, scaling=None):
+    """ The ra_wrapper and parameter_scaler transformations in a single pass that writes
+    the five scaled HDBSCAN parameters (RA, DEC, PM RA, PM DEC, and distance) straight
+    into one preallocated C-contiguous array, without copying the dataframe.  The
+    cos(DEC) scaled RA transform and the wrapped RA are added to fieldpar as the
+    ratransform and rawrapped columns.  dtype defaults to FEATURE_DTYPE.  When scaling
+    (see scaling_parameters) is given, its RA center, wrap state, and scalings are used
+    instead of those of fieldpar and the distance_scale and pm_scale arguments. """
+    if scaling is not None:
+        distance_scale = scaling["distance_scale"]
+        pm_scale = scaling["pm_scale"]
+    if distance_scale is None:
+        distance_scale = DISTANCE_SCALE
+    if pm_scale is None:
+        pm_scale = PM_SCALE
+    if dtype is None:
+        dtype = FEATURE_DTYPE
+
+    with pipeline_profile.stage("scaled_features", len(fieldpar)) as stage:
+        distance = fieldpar["distance"].to_numpy()
+        dec = fieldpar["dec"].to_numpy()
+        if scaling is None:
+            _, _, rawrapped, ratransform = ra_center(fieldpar["ra"])
+        else:
+            # The same RA transform as ra_center, about the given center.
+            ra = fieldpar["ra"].to_numpy(dtype=np.float64)
+            ratransform = ra - scaling["racen"]
+            rawrapped = ra.copy()
+            if scaling["rawrap_shift"] == 360:
+                rawrapped[rawrapped >= 0] += 360
+            elif scaling["rawrap_shift"] == -360:
+                rawrapped[rawrapped > 180] -= 360
+            if scaling["wrap_check"] == 1:
+                ratransform[ratransform > 180] -= 360
+                ratransform[ratransform < -180] += 360
+        ratransform *= np.cos(dec*3.14159/180)
+        features = np.empty((len(fieldpar), 5), dtype=dtype)
+        features[:, 0] = ratransform*3.14159/180*distance
+        features[:, 1] = dec*3.14159/180*distance
+        np.multiply(fieldpar["pmra"].to_numpy(), pm_scale, out=features[:, 2], casting="same_kind")
+        np.multiply(fieldpar["pmdec"].to_numpy(), pm_scale, out=features[:, 3], casting="same_kind")
+        np.divide(distance, distance_scale, out=features[:, 4], casting="same_kind")
+        stage.rows_out = len(features)
+    fieldpar["ratransform"] = ratransform
+    fieldpar["rawrapped"] = rawrapped
+    return features
+
+
+def feature_source(cluster_name=None, field_radius=None, distance_scale=None, pm_scale=None,\
+ dtype=None, parallax_ratio_cut=PARALLAX_RATIO_CUT):
+    """ Describes the scaled_features input for the result cache key: the content hash of
+    the field csv, the parallax error ratio cut, and the scalings and data type (each
+    defaulting as in gaia_dr2_read_setup and scaled_features). """
+    if cluster_name is None:
+        cluster_name = CLUSTER_NAME
+    if field_radius is None:
+        field_radius = FIELD_RADIUS
+    if distance_scale is None:
+        distance_scale = DISTANCE_SCALE
+    if pm_scale is None:
+        pm_scale = PM_SCALE
+    if dtype is None:
+        dtype = FEATURE_DTYPE
+    source = {"field_sha1": source_hash(field_filename(cluster_name, field_radius)),\
+     "parallax_ratio_cut": parallax_ratio_cut, "distance_scale": distance_scale,\
+     "pm_scale": pm_scale, "dtype": np.dtype(dtype).str}
+    # The engine settings only enter the key when it is on, so the keys of the direct
+    # distances are unchanged.
+    if USE_DISTANCE_ENGINE == 1:
+        import distance_engine
+
+        source["distance_engine"] = distance_engine.engine_settings()
+    return source
+
+
+def clustering_algorithm(features, fieldpar, min_samples=None, cluster_name=None,\
+ core_dist_n_jobs=None, algorithm=None, source=None, prefilter=None, extract_num=None,\
+ write_extract=True):
+    """ The scaled parameters (the scaled_features array) are applied to the hdbscan
+     function. A minimum cluster and sample size are set.  64 is typically an appropriate min_samples for a
      5-dimensional hdbscan, but I recommend looking at potential differences in
      output when this parameter is varied by up to a factor of 2 (if not more).
      Especially adjust min_samples if a clear cluster in PM space is missed in
@@ -119,40 +291,126 @@ def clustering_algorithm(fieldparscaled, fieldpar):
      Note that we can also use G magnitude and BP-RP color to increase clustering
      accuracy.  They are commented out in this input list, but they can help to
      create a cleaner cluster main sequence, BUT at the expense of removing many
-     cluster giants/subdwarfs/white dwarfs. """
+     cluster giants/subdwarfs/white dwarfs.  min_samples and cluster_name (the output
+     csv prefix) default to MIN_SAMPLE and CLUSTER_NAME, core_dist_n_jobs sets the
+     number of parallel jobs for the HDBSCAN core distances, and algorithm selects the
+     HDBSCAN tree algorithm (e.g., "boruvka_kdtree" or "prims_kdtree").  The algorithm
+     "auto" (the default with AUTO_BACKEND set) chooses the algorithm, leaf size, and
+     threads (up to core_dist_n_jobs) with hdbscan_backend.select_backend.  When source
+     (see feature_source) is given and USE_RESULT_CACHE is set, a cached result of the
+     same input and parameters is used instead of re-running HDBSCAN.  prefilter (default
+     USE_DENSITY_PREFILTER) drops the sparsest stars before the fit.  The members of
+     cluster extract_num (default CLUSTER_EXTRACT_NUM) are written to
+     "<cluster_name>clustering.csv" unless write_extract is False. """
+    if min_samples is None:
+        min_samples = MIN_SAMPLE
+    if cluster_name is None:
+        cluster_name = CLUSTER_NAME
+    if prefilter is None:
+        prefilter = USE_DENSITY_PREFILTER == 1
+    if extract_num is None:
+        extract_num = CLUSTER_EXTRACT_NUM
+    if algorithm is None:
+        algorithm = "auto" if AUTO_BACKEND == 1 else "best"
 
-    clustering = hdbscan.HDBSCAN(min_cluster_size=50, min_samples=MIN_SAMPLE, cluster_selection_method="leaf").\
-        fit(fieldparscaled[["ra", "dec", "pmra", "pmdec", "parallax"]])
-        # ,"phot_g_mean_mag","bp_rp"]])
+    settings = {"min_cluster_size": 50, "min_samples": min_samples,\
+     "cluster_selection_method": "leaf", "algorithm": algorithm}
+    backend = None
+    if algorithm == "auto":
+        import hdbscan_backend
 
-    # The cluster selection and probability results, plus transformed RA, are
-    # added as new columns to the original dataframe.
-    clusterselection = clustering.labels_
-    clusterprobabilities = clustering.probabilities_
-    fieldpar["clusternum"] = clusterselection.tolist()
-    fieldpar["clusterprob"] = clusterprobabilities.tolist()
-    fieldpar["ratransform"] = fieldparscaled["ratransform"]
-    fieldpar["rawrapped"] = fieldparscaled["rawrapped"]
+        # The backend is chosen for the whole field (before any prefilter), and a
+        # calibrated algorithm and leaf size are part of the result cache key, as the
+        # approximate boruvka trees can differ slightly between them.  Without a
+        # calibration the fit, its threads, and its cache key are those of AUTO_BACKEND
+        # off, and nothing is logged.
+        backend = hdbscan_backend.select_backend(len(features), features.shape[1], core_dist_n_jobs)
+        if backend["source"] == "calibrated":
+            settings["algorithm"] = backend["algorithm"]
+            settings["leaf_size"] = backend["leaf_size"]
+            core_dist_n_jobs = backend["core_dist_n_jobs"]
+        else:
+            settings["algorithm"] = "best"
+            backend = None
+    if core_dist_n_jobs is None:
+        core_dist_n_jobs = 4
+    key = None
+    if source is not None and USE_RESULT_CACHE == 1:
+        cache_settings = dict(settings)
+        if prefilter:
+            cache_settings["prefilter"] = density_prefilter.prefilter_settings()
+        key = result_cache.result_key(source, cache_settings)
+    with pipeline_profile.stage("hdbscan_fit", len(features)) as stage:
+        result = result_cache.load(key, len(features))
+        if result is None and prefilter:
+            # The prefilter is timed within the fit, as it only runs when HDBSCAN does.
+            keep = density_prefilter.dense_rows(features)
+            kept_count = int(np.count_nonzero(keep))
+            print("Density prefilter removed "+str(len(keep) - kept_count)+" of "+\
+             str(len(keep))+" stars")
+        if result is None:
+            start = time.perf_counter()
+            clustering = hdbscan.HDBSCAN(**settings, core_dist_n_jobs=core_dist_n_jobs).\
+                fit(features[keep] if prefilter else features)
+                # To add "phot_g_mean_mag" and "bp_rp", append them as columns of features.
+            if backend is not None:
+                hdbscan_backend.log_fit(backend, kept_count if prefilter else len(features),\
+                 features.shape[1], time.perf_counter() - start)
+            result = result_cache.clustering_result(clustering)
+            if prefilter:
+                result = density_prefilter.expand_result(result, keep)
+            result_cache.save(key, result)
+        stage.rows_out = int(np.count_nonzero(result["labels"] >= 0))
+
+    # The cluster selection and probability results are added as new columns to the
+    # original dataframe (which already holds the transformed RA).
+    fieldpar["clusternum"] = result["labels"]
+    fieldpar["clusterprob"] = result["probabilities"]
 
     # The stars absolute G (based on Gaia parallax) is calculated and the selected
-    # CLUSTER_EXTRACT_NUM cluster is output to a csv file.
-    fieldpar["M_G"] = fieldpar["phot_g_mean_mag"] - \
-        np.log10(fieldpar["distance"]/10)*5
-    fieldpar[fieldpar["clusternum"] == CLUSTER_EXTRACT_NUM]. \
-        to_csv(CLUSTER_NAME+"clustering.csv")
+    # extract_num cluster is output to a csv file.
+    with pipeline_profile.stage("write_extract", len(fieldpar)) as stage:
+        fieldpar["M_G"] = fieldpar["phot_g_mean_mag"] - \
+            np.log10(fieldpar["distance"]/10)*5
+        extract = fieldpar[fieldpar["clusternum"] == extract_num]
+        if write_extract:
+            extract.to_csv(cluster_name+"clustering.csv")
+        stage.rows_out = len(extract)
     return fieldpar
 
 
 def main():
     """ Main program series, which calls data and clustering functions and then plots
     them """
-    fieldpar = gaia_dr2_read_setup()
-    fieldparscaled = fieldpar.copy()
-    fieldparscaled = ra_wrapper(fieldparscaled)
-    fieldparscaled = parameter_scaler(fieldparscaled, fieldpar)
-    fieldpar = clustering_algorithm(fieldparscaled, fieldpar)
+    warnings.filterwarnings("ignore")
+    # The stages are recorded when GAIA_PROFILE is set (see pipeline_profile.py).
+    with pipeline_profile.run(CLUSTER_NAME):
+        fieldpar = gaia_dr2_read_setup()
+        distance_scale, pm_scale = DISTANCE_SCALE, PM_SCALE
+        if AUTO_SCALE == 1:
+            import scale_optimizer
+
+            (distance_scale, pm_scale), search = scale_optimizer.optimize_scales(fieldpar)
+            scale_optimizer.record_scales(CLUSTER_NAME, distance_scale, pm_scale, search)
+        features = scaled_features(fieldpar, distance_scale, pm_scale)
+        fieldpar = clustering_algorithm(features, fieldpar, source=feature_source(\
+         distance_scale=distance_scale, pm_scale=pm_scale))
+        summary = ClusterSummary(fieldpar)
+        if EXPORT_ALL_CLUSTERS == 1:
+            import cluster_export
+
+            cluster_export.export_clusters(fieldpar, CLUSTER_NAME, summary=summary)
+        if CROSS_MATCH_CLUSTERS == 1:
+            import cross_match
+
+            known = cross_match.known_clusters()
+            if (known["field"] != str(CLUSTER_NAME)).any():
+                matches = cross_match.ClusterIndex(known).match(cross_match.summary_clusters(\
+                 summary.table, CLUSTER_NAME))
+                print(matches[cross_match.PRINT_COLUMNS].to_string(index=False))
 
-    # Plots the output clustered data.  See clusterplot.py for details.
-    cluster_plot(fieldpar, PLOT_MEMBERSHIP_PROB)
+        # Plots the output clustered data.  See clusterplot.py for details.
+        cluster_plot(fieldpar, PLOT_MEMBERSHIP_PROB)
 
-main()
+if __name__ == "__main__":
+    main()
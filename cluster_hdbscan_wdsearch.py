@@ -1,10 +1,10 @@
 """Clusters Gaia DR2 data into groups with open cluster characteristics.  Outputs to
 screen objects consistent with white dwarf cluster members."""
-import hdbscan
-import scipy.stats as spy
-import numpy as np
-import pandas as pd
-from cluster_plot import cluster_plot, iqr_calc_angle
+import cluster_hdbscan
+from cluster_hdbscan import feature_source, scaled_features
+from cluster_plot import cluster_plot
+from cluster_summary import ClusterSummary
+import pipeline_profile
 
 # This selects which output cluster data the program will write to a csv file
 # for subsequent analysis.  The star cluster of interest is commonly "0", but
@@ -27,147 +27,84 @@ FIELD_RADIUS = 2
 
 MIN_SAMPLE = 64
 
-def gaia_dr2_read_setup():
-    """ Read the input csv file (from GaiaSearch.py) into a dataframe.  Return the
-    calculated distance and further important parameters and drop stars that are
-    missing these parameters.  """
-    clusterfull = pd.read_csv(CLUSTER_NAME+"gaiafield"+str(FIELD_RADIUS)+".csv", delimiter=",")
-
-# A second dataframe is created that only contains the parameters that will
-# be used to base the HDBSCAN clustering on and for analyzing the results; stars
-# that are missing a parameter are dropped.
-    fieldparfull = clusterfull[["ra", "dec", "pmra", "pmdec", "parallax", \
-        "phot_g_mean_mag", "bp_rp"]]
-    fieldpar = fieldparfull.dropna().copy()
-
-# A new distance (pc) column is created in the dataframe based on the observed
-# parallax.  A 0.03 zeropoint correction is applied.
-    fieldpar['distance'] = 1/((fieldpar['parallax']+0.03)*0.001)
-    return fieldpar
-
-
-def ra_wrapper(ra_dataframe):
-    """ The input RA are checked to see if they wrap around RA=0,360 and are
-    corrected.  In either case, the RA is also transformed to a uniform scale
-    and added to the main dataframe and returned.  Note that this program may
-    have some difficulty around the poles, but there are no clusters to analyze
-    in those regions."""
-    ramax = max(ra_dataframe["ra"])
-    ramin = min(ra_dataframe["ra"])
-    wrap_check = 0
-    ra_dataframe["rawrapped"] = ra_dataframe["ra"]
-    # If the maximum and minimum RA are more than 200 degrees apart, it is safe to
-    # assume that this is because they span RA=0,360.  In this case, the minimum
-    # of the large values (~355 deg) and the maximum of the small value (~5 deg)
-    # must be calculated/corrected and then applied to properly scale and tie
-    # together the RA.
-    if ramax - ramin > 200:
-        wrap_check = 1
-        ramax = ra_dataframe.loc[ra_dataframe["ra"] < 200, ["ra"]].max().at["ra"]
-        ramin = ra_dataframe.loc[ra_dataframe["ra"] > 200, ["ra"]].min().at["ra"]
-        if ramin < (360 - ramax):
-            ramax += 360
-            ra_dataframe.loc[ra_dataframe['rawrapped'] >= 0, 'rawrapped'] = \
-             ra_dataframe['rawrapped']+360
-        else:
-            ramin -= 360
-            ra_dataframe.loc[ra_dataframe['rawrapped'] > 180, 'rawrapped'] = \
-             ra_dataframe['rawrapped']-360
-    racen = (ramin + ramax)/2
-    ra_dataframe["ratransform"] = ra_dataframe["ra"] - racen
-    if wrap_check == 1:
-        ra_dataframe.loc[ra_dataframe['ratransform'] > 180, 'ratransform'] = \
-         ra_dataframe['ratransform']-360
-        ra_dataframe.loc[ra_dataframe['ratransform'] < -180, 'ratransform'] = \
-         ra_dataframe['ratransform']+360
-    return ra_dataframe
-
+# The parameter scalings (see parameter_scaler in cluster_hdbscan.py): the distance (pc)
+# is divided by DISTANCE_SCALE and the proper motions (mas/yr) are multiplied by PM_SCALE.
+# I recommend scaling these so that the output unscaled IQRs of the cluster members for
+# each parameter are roughly equal.
+DISTANCE_SCALE = 5
+PM_SCALE = 10
 
-def parameter_scaler(fieldparscaled, fieldpar):
-    """ Apply appropriate scales to normalize the parameters or place them in a
-     uniform space.  The most appropriate scaling can be cluster dependent.  Most
-     notably with increasing distance, the cluster distance and PM variations of
-     true members increase due to increased errors. I recommend scaling these so
-     that the output unscaled IQRs of the cluster members for each parameter are
-     roughly equal by adjusted what fieldpar['distance'] is divided by and what
-     fieldpar['pmra'] and ['pmdec'] are multiplied by. """
+# This flag determines whether or not the HDBSCAN results are saved to and re-used from
+# the result cache (see result_cache.py).  Enter 1 for yes and 0 for no.
+USE_RESULT_CACHE = 1
 
-    fieldparscaled['parallax'] = fieldpar['distance']/5
-    fieldparscaled['ratransform'] = fieldparscaled['ratransform']* \
-        np.cos(fieldpar["dec"]*3.14159/180)
-    fieldparscaled['ra'] = fieldparscaled['ratransform']*3.14159/180* \
-        fieldpar['distance']
-    fieldparscaled['dec'] = fieldpar['dec']*3.14159/180*fieldpar['distance']
-    fieldparscaled['pmra'] = fieldpar['pmra']*10
-    fieldparscaled['pmdec'] = fieldpar['pmdec']*10
-    return fieldparscaled
+# This flag determines whether or not DISTANCE_SCALE and PM_SCALE are replaced by the
+# scalings chosen by scale_optimizer.py (scored with the white dwarf search cluster
+# cuts).  Enter 1 for yes and 0 for no.
+AUTO_SCALE = 0
 
-
-def clustering_algorithm(fieldparscaled, fieldpar):
-    """ The scaled parameters are applied to the hdbscan function. A minimum cluster
-     and sample size are set.  64 is typically an appropriate min_samples for a
-     5-dimensional hdbscan, but I recommend looking at potential differences in
-     output when this parameter is varied by up to a factor of 2 (if not more).
-     Especially adjust min_samples if a clear cluster in PM space is missed in
-     the output.  A smaller min_samples increases noise but helps differentiate
-     from the field the clusters with proper motions comparable to the field.
-     Note that we can also use G magnitude and BP-RP color to increase clustering
-     accuracy.  They are commented out in this input list, but they can help to
-     create a cleaner cluster main sequence, BUT at the expense of removing many
-     cluster giants/subdwarfs/white dwarfs. """
-
-    clustering = hdbscan.HDBSCAN(min_cluster_size=50, min_samples=MIN_SAMPLE, cluster_selection_method="leaf").\
-        fit(fieldparscaled[["ra", "dec", "pmra", "pmdec", "parallax"]])
-        # ,"phot_g_mean_mag","bp_rp"]])
-
-    # The cluster selection and probability results, plus transformed RA, are
-    # added as new columns to the original dataframe.
-    clusterselection = clustering.labels_
-    clusterprobabilities = clustering.probabilities_
-    fieldpar["clusternum"] = clusterselection.tolist()
-    fieldpar["clusterprob"] = clusterprobabilities.tolist()
-    fieldpar["ratransform"] = fieldparscaled["ratransform"]
-    fieldpar["rawrapped"] = fieldparscaled["rawrapped"]
-
-    # The stars absolute G (based on Gaia parallax) is calculated and the selected
-    # CLUSTER_EXTRACT_NUM cluster is output to a csv file.
-    fieldpar["M_G"] = fieldpar["phot_g_mean_mag"] - \
-        np.log10(fieldpar["distance"]/10)*5
-    fieldpar[fieldpar["clusternum"] == CLUSTER_EXTRACT_NUM]. \
-        to_csv(CLUSTER_NAME+"clustering.csv")
-    return fieldpar
+def gaia_dr2_read_setup():
+    """ Read the input csv file (from GaiaSearch.py) into a dataframe, as in
+    cluster_hdbscan.py but without the parallax error ratio cut.  The csv is only parsed
+    on the first run of a field; later runs memory-map the columnar store built from it
+    (see field_store.py). """
+    return cluster_hdbscan.gaia_dr2_read_setup(CLUSTER_NAME, FIELD_RADIUS, parallax_ratio_cut=None)
+
+
+def clustering_algorithm(features, fieldpar, source=None):
+    """ The scaled parameters (the scaled_features array) are applied to the hdbscan
+     function with this script's MIN_SAMPLE (see clustering_algorithm in
+     cluster_hdbscan.py for the choice of min_samples), and the CLUSTER_EXTRACT_NUM
+     cluster is written to a csv file.  When source (see feature_source in
+     cluster_hdbscan.py) is given and USE_RESULT_CACHE is set, a cached result of the
+     same input and parameters is used instead of re-running HDBSCAN. """
+    return cluster_hdbscan.clustering_algorithm(features, fieldpar, min_samples=MIN_SAMPLE,\
+     cluster_name=CLUSTER_NAME, source=source if USE_RESULT_CACHE == 1 else None,\
+     prefilter=False, extract_num=CLUSTER_EXTRACT_NUM)
 
 def white_dwarf_identification(fieldpar):
     """ This photometrically selects out the information on cluster members consistent with white
     dwarf photometry and prints them to screen.  Note that the output photometry assumes zero
-    reddening and adopts the white dwarf distance rather than the cluster distance. """
-    for step in range(max(fieldpar.clusternum.unique())+1):
-        distcen = np.median(fieldpar.loc[fieldpar["clusternum"] == step, ["distance"]])
-        distiqr = spy.iqr(fieldpar.loc[fieldpar["clusternum"] == step, ["distance"]])
-        pmraiqr = iqr_calc_angle(fieldpar.loc[fieldpar["clusternum"] == step], distcen,\
-         "pmra")*0.271795
-        pmdeciqr = iqr_calc_angle(fieldpar.loc[fieldpar["clusternum"] == step], distcen,\
-         "pmdec")*0.271795
-        true_cluster = []
-        if (pmraiqr < 3 and pmdeciqr < 3 and distiqr < 500):
-            true_cluster.append(step)
-        for _, row in fieldpar.iterrows():
-            if row["clusternum"] in true_cluster and row["bp_rp"] < 0.25 and row["M_G"] > 9 and\
-             row["M_G"] > row["bp_rp"] * 5.556 + 10.111:
-                print("WD in Cluster "+str(int(row["clusternum"]))+": Membership Prob. = "\
-                 +str(round(row["clusterprob"], 3))+", M_G = "+str(round(row["M_G"],\
-                 3))+" and BP-RP = "+str(round(row["bp_rp"], 3)))
+    reddening and adopts the white dwarf distance rather than the cluster distance.  The
+    candidates are also returned as a dataframe together with their cluster statistics.
+    True clusters must have PM IQRs below 3 km/s and a distance IQR below 500 pc. """
+    with pipeline_profile.stage("wd_search", len(fieldpar)) as stage:
+        summary = ClusterSummary(fieldpar, pm_iqr_cut=3, dist_iqr_cut=500, faint_cut=None)
+        true_cluster = summary.real_clusters
+        wd_mask = fieldpar["clusternum"].isin(true_cluster) & (fieldpar["bp_rp"] < 0.25) & \
+            (fieldpar["M_G"] > 9) & (fieldpar["M_G"] > fieldpar["bp_rp"] * 5.556 + 10.111)
+        candidates = fieldpar.loc[wd_mask].sort_values("clusternum", kind="mergesort")
+        candidates = candidates.join(summary.table[["distcen", "distiqr", "pmraiqr", "pmdeciqr"]],\
+         on="clusternum")
+        stage.rows_out = len(candidates)
+    for clusternum, prob, m_g, bp_rp in zip(candidates["clusternum"], candidates["clusterprob"],\
+     candidates["M_G"], candidates["bp_rp"]):
+        print("WD in Cluster "+str(int(clusternum))+": Membership Prob. = "\
+         +str(round(prob, 3))+", M_G = "+str(round(m_g,\
+         3))+" and BP-RP = "+str(round(bp_rp, 3)))
+    return candidates
 
 def main():
     """ Main program series, which calls data and clustering functions and then plots
     them """
-    fieldpar = gaia_dr2_read_setup()
-    fieldparscaled = fieldpar.copy()
-    fieldparscaled = ra_wrapper(fieldparscaled)
-    fieldparscaled = parameter_scaler(fieldparscaled, fieldpar)
-    fieldpar = clustering_algorithm(fieldparscaled, fieldpar)
-    white_dwarf_identification(fieldpar)
-    # Plots the output clustered data.  See clusterplot.py for details.
-    cluster_plot(fieldpar, PLOT_MEMBERSHIP_PROB)
-
-main()
+    # The stages are recorded when GAIA_PROFILE is set (see pipeline_profile.py).
+    with pipeline_profile.run(CLUSTER_NAME):
+        fieldpar = gaia_dr2_read_setup()
+        distance_scale, pm_scale = DISTANCE_SCALE, PM_SCALE
+        if AUTO_SCALE == 1:
+            import scale_optimizer
+
+            (distance_scale, pm_scale), search = scale_optimizer.optimize_scales(fieldpar,\
+             min_samples=MIN_SAMPLE, summary_cuts={"pm_iqr_cut": 3, "dist_iqr_cut": 500,\
+             "faint_cut": None})
+            scale_optimizer.record_scales(CLUSTER_NAME, distance_scale, pm_scale, search)
+        features = scaled_features(fieldpar, distance_scale, pm_scale)
+        fieldpar = clustering_algorithm(features, fieldpar, feature_source(CLUSTER_NAME,\
+         FIELD_RADIUS, distance_scale, pm_scale, parallax_ratio_cut=None))
+        # The white dwarf candidates and their cluster statistics are output to a csv file.
+        white_dwarf_identification(fieldpar).to_csv(CLUSTER_NAME+"wdcandidates.csv")
+        # Plots the output clustered data.  See clusterplot.py for details.
+        cluster_plot(fieldpar, PLOT_MEMBERSHIP_PROB)
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,26 @@
 """ The cluster_plot series of functions that plots all of the clustered stars and
     information. """
-import scipy.stats as spy
 import numpy as np
-import seaborn as sns
-import matplotlib.pyplot as plt
-import matplotlib.colors as pltc
-from mpl_toolkits import mplot3d
+from cluster_summary import ClusterSummary
+from lazy_import import lazy_module
+import pipeline_profile
+
+# The plotting libraries are only imported once a plot is drawn, so the clustering
+# scripts (and their worker processes) do not pay for them when they never plot.
+spy = lazy_module("scipy.stats")
+sns = lazy_module("seaborn")
+plt = lazy_module("matplotlib.pyplot")
+pltc = lazy_module("matplotlib.colors")
+
+# The field stars (the non-clustered stars and the groups that fail the real cluster
+# cuts, such as the disk star pseudo-cluster) are not drawn as points, but as a density
+# image binned once per panel and re-used in every cluster's figure, so each figure only
+# draws the real clusters' members.  The RA and DEC and CMD images
+# have FIELD_BINS bins per axis, and the PM images have PM_BIN_WIDTH (mas/yr) bins over
+# the zoomed PM windows of all the clusters (up to MAX_PM_BINS bins per axis).
+FIELD_BINS = 400
+PM_BIN_WIDTH = 0.05
+MAX_PM_BINS = 2000
 
 def iqr_calc_angle(selected_cluster, distcen, column):
     """ Calculated interquartile range of a cluster group and is scaled to distance
@@ -21,7 +36,8 @@ def color_setup(clustered_data, membership_plot, unique_group, palette):
     import pandas as pd
 
     if membership_plot == 1 or membership_plot == 2:
-        clustered_dict = {elem: pd.DataFrame for elem in unique_group}
+        # The field stars are drawn from the field images instead.
+        clustered_dict = {elem: pd.DataFrame for elem in unique_group if elem != -1}
         for key in clustered_dict.keys():
             clustered_dict[key] = clustered_data[:][clustered_data.clusternum == key]
         cmapdict = {-1:"Greys", 0:"Blues", 1:"Oranges", 2:"Greens", 3:"Reds",\
@@ -44,9 +60,10 @@ def distance_hist(selected_cluster, distcen, distiqr, step, palette):
     plt.gcf().text(0.32, 0.43, "Distance IQR = "+str(int(distiqr))+" pc", fontsize=12)
 
 
-def ra_dec_plot_setup(clustered_data, distcen, selected_cluster):
+def ra_dec_plot_setup(clustered_data, stats):
     """ A subplot illustrating the cluster scaled RA and DEC is setup.  The median cluster
-    RA and DEC and their IQR in pc space are plotted.  """
+    RA and DEC and their IQR in pc space (from the cluster's ClusterSummary row) are
+    plotted.  """
     plt.subplot(222)
     plt.ylabel("DEC", fontsize=15)
     plt.xlabel("RA Scaled", fontsize=15)
@@ -54,28 +71,30 @@ def ra_dec_plot_setup(clustered_data, distcen, selected_cluster):
     ramax = max(clustered_data["ratransform"])
     decmin = min(clustered_data["dec"])
     decmax = max(clustered_data["dec"])
-    raiqr = iqr_calc_angle(selected_cluster, distcen, "ratransform")
-    ramedian = np.median(selected_cluster["rawrapped"])
+    raiqr = stats["raiqr"]
+    ramedian = stats["ramedian"]
 
     # The texts are placed in data space, which pushes them outside the plot and automatically
     # rescales the plot positions to make space for the text.
     plt.text(ramin, decmax+(decmax-decmin)*0.16, "RA = "+str(round(ramedian, 3)), fontsize=12)
     plt.text(ramin+(ramax-ramin)*0.6, decmax+(decmax-decmin)*0.16, "RA IQR =\
      "+str(round(raiqr, 2))+" pc", fontsize=12)
-    decmedian = np.median(selected_cluster["dec"])
-    deciqr = iqr_calc_angle(selected_cluster, distcen, "dec")
+    decmedian = stats["dec_median"]
+    deciqr = stats["deciqr"]
     plt.text(ramin, decmax+(decmax-decmin)*0.08, "DEC = "+str(round(decmedian, 3)), fontsize=12)
     plt.text(ramin+(ramax-ramin)*0.6, decmax+(decmax-decmin)*0.08, "DEC IQR =\
      "+str(round(deciqr, 2))+" pc", fontsize=12)
 
-def pm_plot_setup(selected_cluster, pmraiqr, pmdeciqr):
+def pm_plot_setup(stats):
     """ A subplot illustrating the cluster proper motions is setup.  Additionally, the
     median cluster RA PM and DEC PM (in mas/yr) and their IQR (in km/s) space are plotted. """
     plt.subplot(221)
     plt.ylabel("DEC PM (mas/yr)", fontsize=15)
     plt.xlabel("RA PM (mas/yr)", fontsize=15)
-    pmramedian = np.median(selected_cluster["pmra"])
-    pmdecmedian = np.median(selected_cluster["pmdec"])
+    pmramedian = stats["pmra_median"]
+    pmdecmedian = stats["pmdec_median"]
+    pmraiqr = stats["pmraiqr"]
+    pmdeciqr = stats["pmdeciqr"]
     plt.gcf().text(0.08, 0.978, "RA PM = "+str(round(pmramedian, 2))+" mas/yr", fontsize=12)
     plt.gcf().text(0.08, 0.948, "DEC PM = "+str(round(pmdecmedian, 2))+" mas/yr", fontsize=12)
     plt.gcf().text(0.28, 0.978, "RA PM IQR = "+str(round(pmraiqr, 2))+" km/s", fontsize=12)
@@ -85,7 +104,7 @@ def pm_plot_setup(selected_cluster, pmraiqr, pmdeciqr):
     plt.ylim(pmdecmedian-10, pmdecmedian+10)
     plt.xlim(pmramedian-10, pmramedian+10)
 
-def cmd_plot_setup(clustered_data, selected_cluster):
+def cmd_plot_setup(clustered_data, stats):
     """ A subplot illustrating the cluster CMD is setup."""
     plt.subplot(224)
     plt.xlabel("BP-RP", fontsize=15)
@@ -94,17 +113,54 @@ def cmd_plot_setup(clustered_data, selected_cluster):
     ymax = max(clustered_data["M_G"])
     plt.ylim(ymax, ymin-1)
     plt.xlim(-0.6, 3.5)
-    return len(selected_cluster), ymin
+    return int(stats["count"]), ymin
+
+def field_image(field_stars, xvar_col, yvar_col, xrange, yrange, bins):
+    """ Bins the field stars of one panel into a 2D density image.  The
+    counts are log scaled, and empty bins are masked so they are transparent.  Returns
+    the image and its extent. """
+    counts, xedges, yedges = np.histogram2d(field_stars[xvar_col], field_stars[yvar_col],\
+     bins=bins, range=[xrange, yrange])
+    return np.ma.masked_equal(np.log1p(counts.T), 0), (xedges[0], xedges[-1], yedges[0],\
+     yedges[-1])
+
+def field_images(clustered_data, summary):
+    """ The field star images of the RA and DEC, PM, and CMD panels, keyed by their
+    (x, y) columns.  The field stars are all the stars outside the real clusters.  The
+    RA and DEC and CMD images span all of the data, while the PM image only spans the
+    +/- 10 mas/yr windows around the clusters' median PMs that the PM panels are zoomed
+    to. """
+    field_stars = clustered_data.loc[~clustered_data["clusternum"].isin(summary.real_clusters)]
+    images = {}
+    for xvar_col, yvar_col in [("ratransform", "dec"), ("bp_rp", "M_G")]:
+        images[(xvar_col, yvar_col)] = field_image(field_stars, xvar_col, yvar_col,\
+         (min(clustered_data[xvar_col]), max(clustered_data[xvar_col])),\
+         (min(clustered_data[yvar_col]), max(clustered_data[yvar_col])), FIELD_BINS)
+    real = summary.table.loc[summary.table["real_cluster"]]
+    if len(real):
+        pmrarange = (min(real["pmra_median"])-10, max(real["pmra_median"])+10)
+        pmdecrange = (min(real["pmdec_median"])-10, max(real["pmdec_median"])+10)
+    else:
+        pmrarange = (min(clustered_data["pmra"]), max(clustered_data["pmra"]))
+        pmdecrange = (min(clustered_data["pmdec"]), max(clustered_data["pmdec"]))
+    pmbins = [min(MAX_PM_BINS, max(1, int(np.ceil((high-low)/PM_BIN_WIDTH))))\
+     for low, high in (pmrarange, pmdecrange)]
+    images[("pmra", "pmdec")] = field_image(field_stars, "pmra", "pmdec", pmrarange,\
+     pmdecrange, pmbins)
+    return images
 
-def plot_map(unique_group, clustered_dict, cmapdict, normalize, step, xvar_col, yvar_col):
+def plot_field_image(image):
+    """ Draws a field star image beneath the cluster data points in the current panel. """
+    counts, extent = image
+    plt.imshow(counts, extent=extent, origin="lower", aspect="auto", cmap="Greys",\
+     interpolation="nearest", zorder=0)
+
+def plot_map(real_clusters, clustered_dict, cmapdict, normalize, step, xvar_col, yvar_col):
     """ For when a membership probability color map is desired (i.e., membership_plot == 1
-     or 2).  This function plots each cluster separately with its own separate color map, 
-     while it plots non-clustered data as simply black."""
-    for group in unique_group:
-        if group == -1:
-            plt.scatter(clustered_dict[group][xvar_col], clustered_dict[group][yvar_col], s=0.002,\
-             alpha=1, color="black")
-        elif group == step:
+     or 2).  This function plots each real cluster separately with its own separate color
+     map.  The field stars are drawn separately as a field image."""
+    for group in real_clusters:
+        if group == step:
             plt.scatter(clustered_dict[group][xvar_col], clustered_dict[group][yvar_col], s=6,\
              alpha=1, c=clustered_dict[group]["clusterprob"], cmap=cmapdict[group], norm=normalize)
             cbar = plt.colorbar()
@@ -117,6 +173,9 @@ def plot_map3D(real_clusters, clustered_dict, cmapdict, normalize, step, selecte
     """ For when a membership probability color map is desired (i.e., membership_plot == 1 or 2).
     This function plots each cluster separately with its own separate color map, while
     it plots non-clustered data as simply black."""
+    # Registers the 3d projection.
+    from mpl_toolkits import mplot3d
+
     ax=plt.axes(projection='3d')
     ax.set_xlabel("RA (pc)", fontsize=12)
     ax.set_ylabel("DEC (pc)", fontsize=12)
@@ -141,9 +200,10 @@ def plot_map3D(real_clusters, clustered_dict, cmapdict, normalize, step, selecte
              cmap=cmapdict[group], norm=normalize)
 
 
-def cluster_plot(clustered_data, membership_plot):
-    """ This main function sets up the colors, figures, and plots the data based on the
-    requested membership or not color scheme. """
+def plot_setup(clustered_data, membership_plot):
+    """ Everything shared by the cluster figures is set up once: the color palette and
+    color maps (or colors), the transformed DEC, and the ClusterSummary of the clusters.
+    Returns a dictionary that plot_cluster draws each cluster's figures from. """
 
 # We count the number of found clusters, set up the color palette, and set tick label
 # font size to 12 for clarity.
@@ -151,88 +211,111 @@ def cluster_plot(clustered_data, membership_plot):
     palette = sns.color_palette('bright', max(unique_group)+1)
     dec_median = np.median(clustered_data["dec"])
     clustered_data["dectransform"] = clustered_data["dec"] - dec_median
-    if membership_plot == 1 or membership_plot == 2:
-        clustered_dict, cmapdict = color_setup(clustered_data, membership_plot,\
-         unique_group, palette)
-    else:
-        colors = color_setup(clustered_data, membership_plot, unique_group, palette)
-    normalize = pltc.Normalize(vmin=0, vmax=1)
+    setup = {"data": clustered_data, "membership_plot": membership_plot,\
+     "unique_group": unique_group, "palette": palette,\
+     "normalize": pltc.Normalize(vmin=0, vmax=1)}
     plt.rcParams['xtick.labelsize'] = 12
     plt.rcParams['ytick.labelsize'] = 12
-    real_clusters = []
-
-# This loop iterates through all clustered groups found with hdbscan and plots the
-# requested clusters that pass the checks.
-    for step in range(max(unique_group)+1):
-
-        selected_cluster = clustered_data.loc[clustered_data["clusternum"] == step].copy()
-# The median stellar distance is found (in parsecs), which is used to transform proper
-# motions and RA and DEC into spatial scales.  Because these distributions are not
-# always Gaussian, the interquartile ranges are used to analyze parameter variations
-# throughout a cluster.
-        distcen = np.median(selected_cluster["distance"])
-        distiqr = spy.iqr(selected_cluster["distance"])
-        pmraiqr = iqr_calc_angle(selected_cluster, distcen, "pmra")*0.271795
-        pmdeciqr = iqr_calc_angle(selected_cluster, distcen, "pmdec")*0.271795
-        full_count = len(selected_cluster)
-        faint_count = len(selected_cluster.loc[selected_cluster["M_G"] > 10])
-        if (pmraiqr < 3 and pmdeciqr < 3 and distiqr < 300 and faint_count/full_count < 0.8):
-            real_clusters.append(step)
 
+# The statistics of all clustered groups found with hdbscan are calculated in a single
+# pass (see cluster_summary.py), and only the clusters that pass the checks are plotted.
 # Hdbscan will typically create a cluster from the overdensity in the field disk stars,
 # producing apparent clusters but with large PM variation.  Therefore, we require that
 # the transformed PM variation be less than 3 km/s in each axis to be displayed as a
 # valid cluster.  If a legitimate cluster is identified but retains a lot of
 # noise/non-members, a 3 km/s cut may remove it from display.  In these cases, you may
 # increase the cut to 4 or 5 km/s, etc., to first analyze its output, but in the end I
-# recommend adjusting the hdbscan min_samples or the parameter scalings.
-    for step in real_clusters:
-
-        selected_cluster = clustered_data.loc[clustered_data["clusternum"] == step].copy()
-# The median stellar distance is found (in parsecs), which is used to transform proper
-# motions and RA and DEC into spatial scales.  Because these distributions are not
-# always Gaussian, the interquartile ranges are used to analyze parameter variations
-# throughout a cluster.
-        distcen = np.median(selected_cluster["distance"])
-        distiqr = spy.iqr(selected_cluster["distance"])
-        pmraiqr = iqr_calc_angle(selected_cluster, distcen, "pmra")*0.271795
-        pmdeciqr = iqr_calc_angle(selected_cluster, distcen, "pmdec")*0.271795
-# To set up the plots, we set a separate Figure for each cluster.  For when membership
-# probability is not shown, we set all clustered data to a large size and nonclustered
-# data to small data size.
-        plt.figure(step, figsize=(14, 10))
-        if membership_plot != 1 or membership_plot != 2:
-            sizes = [4 if x == step else 0.003 for x in clustered_data["clusternum"]]
-    
-        distance_hist(selected_cluster, distcen, distiqr, step, palette)
-        ra_dec_plot_setup(clustered_data, distcen, selected_cluster)
-        if membership_plot == 1 or membership_plot == 2:
-            plot_map(unique_group, clustered_dict, cmapdict, normalize, step,\
-             "ratransform", "dec")
-        else:
-            plt.scatter(clustered_data["ratransform"], clustered_data["dec"],\
-             s=sizes, alpha=1, color=colors)
-        pm_plot_setup(selected_cluster, pmraiqr, pmdeciqr)
-        if membership_plot == 1 or membership_plot == 2:
-            plot_map(unique_group, clustered_dict, cmapdict, normalize, step, "pmra", "pmdec")
-        else:
-            plt.scatter(clustered_data["pmra"], clustered_data["pmdec"], s=sizes,\
-             alpha=1, color=colors)
-        number, ymin = cmd_plot_setup(clustered_data, selected_cluster)
-        if membership_plot == 1 or membership_plot == 2:
-            xlabelpos = 1.57
-            plot_map(unique_group, clustered_dict, cmapdict, normalize, step, "bp_rp", "M_G")
-        else:
-            xlabelpos = 1.95
-            plt.scatter(clustered_data["bp_rp"], clustered_data["M_G"], s=sizes,\
-             alpha=1, color=colors)
-        plt.text(xlabelpos, ymin+0.5, "Cluster Number "+str(step), fontsize=12)
-        plt.text(xlabelpos, ymin+1.68, "Cluster Count = "+str(number), fontsize=12)
-        plt.tight_layout()
-        if membership_plot == 2:
-            plt.figure(step+1+max(unique_group)+1, figsize=(10, 8))
-            plot_map3D(real_clusters, clustered_dict, cmapdict, normalize, step,\
-             selected_cluster, distcen)
-    
+# recommend adjusting the hdbscan min_samples or the parameter scalings.  Additionally,
+# the distance IQR must be less than 300 pc and fewer than 80% of the stars may have
+# M_G fainter than 10.
+    setup["summary"] = ClusterSummary(clustered_data)
+    setup["real_clusters"] = setup["summary"].real_clusters
+    setup["field_images"] = field_images(clustered_data, setup["summary"])
+    # Only the real clusters' members are drawn as points, so only they need colors.
+    clustered_stars = clustered_data.loc[clustered_data["clusternum"].isin(setup["real_clusters"])]
+    if membership_plot == 1 or membership_plot == 2:
+        setup["clustered_dict"], setup["cmapdict"] = color_setup(clustered_stars,\
+         membership_plot, setup["real_clusters"], palette)
+    else:
+        setup["clustered_stars"] = clustered_stars
+        setup["colors"] = color_setup(clustered_stars, membership_plot, unique_group, palette)
+    return setup
+
+
+def plot_cluster(setup, step):
+    """ Draws the four panel figure of cluster number step (and its 3D figure when
+    membership_plot == 2) from the plot_setup dictionary.  Returns the figures. """
+    clustered_data = setup["data"]
+    membership_plot = setup["membership_plot"]
+    unique_group = setup["unique_group"]
+    palette = setup["palette"]
+    normalize = setup["normalize"]
+    clustered_dict = setup.get("clustered_dict")
+    cmapdict = setup.get("cmapdict")
+    colors = setup.get("colors")
+    summary = setup["summary"]
+
+    selected_cluster = summary.members(step).copy()
+    stats = summary[step]
+    distcen = stats["distcen"]
+    distiqr = stats["distiqr"]
+# To set up the plots, we set a separate Figure for each cluster.  The field stars
+# (including the groups that fail the real cluster cuts) are drawn as density images, and for when membership probability is not
+# shown, we set the cluster's data to a large size and other clusters' data to small
+# data size.
+    figures = [plt.figure(step, figsize=(14, 10))]
+    images = setup["field_images"]
+    if membership_plot != 1 and membership_plot != 2:
+        clustered_stars = setup["clustered_stars"]
+        sizes = np.where(clustered_stars["clusternum"].to_numpy() == step, 4, 0.003)
+
+    distance_hist(selected_cluster, distcen, distiqr, step, palette)
+    ra_dec_plot_setup(clustered_data, stats)
+    plot_field_image(images[("ratransform", "dec")])
+    if membership_plot == 1 or membership_plot == 2:
+        plot_map(setup["real_clusters"], clustered_dict, cmapdict, normalize, step,\
+         "ratransform", "dec")
+    else:
+        plt.scatter(clustered_stars["ratransform"], clustered_stars["dec"],\
+         s=sizes, alpha=1, color=colors)
+    pm_plot_setup(stats)
+    plot_field_image(images[("pmra", "pmdec")])
+    if membership_plot == 1 or membership_plot == 2:
+        plot_map(setup["real_clusters"], clustered_dict, cmapdict, normalize, step, "pmra", "pmdec")
+    else:
+        plt.scatter(clustered_stars["pmra"], clustered_stars["pmdec"], s=sizes,\
+         alpha=1, color=colors)
+    number, ymin = cmd_plot_setup(clustered_data, stats)
+    plot_field_image(images[("bp_rp", "M_G")])
+    if membership_plot == 1 or membership_plot == 2:
+        xlabelpos = 1.57
+        plot_map(setup["real_clusters"], clustered_dict, cmapdict, normalize, step, "bp_rp", "M_G")
+    else:
+        xlabelpos = 1.95
+        plt.scatter(clustered_stars["bp_rp"], clustered_stars["M_G"], s=sizes,\
+         alpha=1, color=colors)
+    plt.text(xlabelpos, ymin+0.5, "Cluster Number "+str(step), fontsize=12)
+    plt.text(xlabelpos, ymin+1.68, "Cluster Count = "+str(number), fontsize=12)
+    plt.tight_layout()
+    if membership_plot == 2:
+        figures.append(plt.figure(step+1+max(unique_group)+1, figsize=(10, 8)))
+        plot_map3D(setup["real_clusters"], clustered_dict, cmapdict, normalize, step,\
+         selected_cluster, distcen)
+    return figures
+
+
+def cluster_plot(clustered_data, membership_plot):
+    """ This main function sets up the colors, figures, and plots the data based on the
+    requested membership or not color scheme.  The ClusterSummary of the clusters is
+    returned.  See figure_export.py for saving the figures without a display. """
+    with pipeline_profile.stage("plot_setup", len(clustered_data)):
+        setup = plot_setup(clustered_data, membership_plot)
+
+# This loop iterates through all clustered groups found with hdbscan that pass the
+# checks and plots them.
+    for step in setup["real_clusters"]:
+        with pipeline_profile.stage("plot_cluster", int(setup["summary"][step]["count"])):
+            plot_cluster(setup, step)
+
     plt.show()
-    
\ No newline at end of file
+    return setup["summary"]
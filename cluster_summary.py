@@ -0,0 +1,99 @@
+""" The ClusterSummary of a clustered field: the per-cluster medians, interquartile
+    ranges, and "real cluster" flag shared by cluster_plot and the white dwarf search. """
+import numpy as np
+import pandas as pd
+
+# Converts a proper motion IQR (mas/yr), scaled to distance like an angle by
+# iqr_calc_angle, into km/s.
+PM_KMS = 0.271795
+
+
+def _lerp(lower, upper, fraction):
+    """ Linear interpolation written the same way as numpy's percentile, so grouped
+    quantiles match np.percentile exactly. """
+    diff = upper - lower
+    return np.where(fraction >= 0.5, upper - diff*(1 - fraction), lower + diff*fraction)
+
+
+class ClusterSummary:
+    """ Groups the labelled stars by clusternum once and calculates every cluster's
+    statistics in a single vectorized pass.  The median distance (distcen) is used to
+    transform proper motion and RA and DEC variations into spatial scales, and because
+    these distributions are not always Gaussian, the interquartile ranges are used to
+    analyze parameter variations throughout a cluster.  A cluster is flagged as real
+    when both PM IQRs are below pm_iqr_cut (km/s), its distance IQR is below
+    dist_iqr_cut (pc), and fewer than faint_cut of its stars have M_G fainter than 10
+    (a faint_cut of None skips this last check).
+
+    The table attribute holds one row per cluster number (noise excluded), and
+    members(clusternum) returns that cluster's stars without scanning the field. """
+
+    def __init__(self, clustered_data, pm_iqr_cut=3, dist_iqr_cut=300, faint_cut=0.8):
+        self.data = clustered_data
+        labels = clustered_data["clusternum"].to_numpy()
+        clustered = np.flatnonzero(labels >= 0)
+        # A stable sort keeps each cluster's stars in their original order.
+        self._order = clustered[np.argsort(labels[clustered], kind="stable")]
+        numbers, self._starts, counts = np.unique(labels[self._order], return_index=True,\
+         return_counts=True)
+        self._stops = self._starts + counts
+        self._positions = dict(zip(numbers.tolist(), range(len(numbers))))
+
+        table = pd.DataFrame({"count": counts}, index=pd.Index(numbers, name="clusternum"))
+        for column in ["distance", "pmra", "pmdec", "dec", "rawrapped", "ratransform"]:
+            if column in clustered_data:
+                table[column+"_median"], table[column+"_iqr"] = \
+                    self._median_iqr(clustered_data[column].to_numpy(), counts)
+        table = table.rename(columns={"distance_median": "distcen", "distance_iqr": "distiqr"})
+        # The same arithmetic (and order) as iqr_calc_angle in cluster_plot.py.
+        table["pmraiqr"] = table.pop("pmra_iqr")*3.14159/180*table["distcen"]*PM_KMS
+        table["pmdeciqr"] = table.pop("pmdec_iqr")*3.14159/180*table["distcen"]*PM_KMS
+        table["deciqr"] = table.pop("dec_iqr")*3.14159/180*table["distcen"]
+        if "ratransform_iqr" in table:
+            table["raiqr"] = table.pop("ratransform_iqr")*3.14159/180*table["distcen"]
+            table = table.drop(columns="ratransform_median")
+        if "rawrapped_median" in table:
+            table["ramedian"] = table.pop("rawrapped_median")
+            table = table.drop(columns="rawrapped_iqr")
+        if "M_G" in clustered_data:
+            faint = clustered_data["M_G"].to_numpy()[self._order] > 10
+            table["faint_fraction"] = np.add.reduceat(faint, self._starts)/counts \
+                if len(counts) else np.zeros(0)
+        table["real_cluster"] = (table["pmraiqr"] < pm_iqr_cut) & \
+            (table["pmdeciqr"] < pm_iqr_cut) & (table["distiqr"] < dist_iqr_cut)
+        if faint_cut is not None:
+            table["real_cluster"] &= table["faint_fraction"] < faint_cut
+        self.table = table
+
+    def _median_iqr(self, values, counts):
+        """ The median and IQR of values within every cluster, from one sort of the
+        values by cluster number and then value. """
+        grouped = values[self._order]
+        labels = self.data["clusternum"].to_numpy()[self._order]
+        grouped = grouped[np.lexsort((grouped, labels))]
+        starts = self._starts
+
+        def quantile(fraction):
+            position = fraction*(counts - 1)
+            lower = np.floor(position).astype(np.int64)
+            upper = np.ceil(position).astype(np.int64)
+            return _lerp(grouped[starts + lower], grouped[starts + upper], position - lower)
+
+        middle_lower = grouped[starts + (counts - 1)//2]
+        middle_upper = grouped[starts + counts//2]
+        median = np.where(counts % 2 == 1, middle_lower, (middle_lower + middle_upper)/2)
+        return median, quantile(0.75) - quantile(0.25)
+
+    @property
+    def real_clusters(self):
+        """ The cluster numbers that pass the real cluster cut, in increasing order. """
+        return self.table.index[self.table["real_cluster"]].tolist()
+
+    def __getitem__(self, clusternum):
+        """ The statistics row of one cluster. """
+        return self.table.loc[clusternum]
+
+    def members(self, clusternum):
+        """ A copy of the stars labelled clusternum, in their original order. """
+        position = self._positions[clusternum]
+        return self.data.iloc[self._order[self._starts[position]:self._stops[position]]]
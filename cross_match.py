@@ -0,0 +1,246 @@
+""" Cross-matches the clusters found by the pipeline against a local reference cluster
+    catalogue and the cluster summary tables of earlier runs, instead of comparing the
+    printed RA/DEC, PM medians, and distance against known catalogues by hand.
+
+    Every cluster is placed in one space of its unit-sphere sky position, its proper
+    motion, and its log distance, scaled so that MATCH_ANGLE (degrees), MATCH_PM
+    (mas/yr), and a fractional distance difference of MATCH_DISTANCE are each one unit.
+    The known clusters are loaded into a KD-tree of this space once, and all the found
+    clusters are matched to their MATCH_COUNT nearest known clusters within MATCH_RADIUS
+    units in one bulk query, so large batches of fields are matched in logarithmic
+    rather than pairwise time.
+
+    The reference catalogue is a csv file with one cluster per row and the columns name,
+    ra, dec (degrees), pmra, pmdec (mas/yr), and distance (pc) or parallax (mas).  The
+    earlier runs are the summary.csv tables written by cluster_export.py (or the
+    "<label>_summary.csv" tables of batch_fields.py), whose real clusters are named
+    "<field>:<clusternum>".  A cluster is never matched to a cluster of its own field.
+
+    Usage: python cross_match.py SUMMARY_CSV [SUMMARY_CSV ...] [--reference CSV]
+            [--runs PATTERN ...] [--count N] [--all] [--output CSV] """
+import argparse
+import glob
+import os
+import numpy as np
+import pandas as pd
+import cluster_export
+import pipeline_profile
+
+# The local reference catalogue, and the earlier run summary tables (glob patterns)
+# that are matched as well.
+REFERENCE_CATALOGUE = "reference_clusters.csv"
+RUN_SUMMARIES = [os.path.join(cluster_export.EXPORT_DIR, "field=*", "summary.csv")]
+
+# The sky separation (degrees), proper motion difference (mas/yr), and fractional
+# distance difference that each count as one unit of the match space.
+MATCH_ANGLE = 0.5
+MATCH_PM = 1.0
+MATCH_DISTANCE = 0.2
+
+# The number of counterparts listed per cluster, and the largest match space
+# separation of a counterpart.
+MATCH_COUNT = 3
+MATCH_RADIUS = 3.0
+
+CLUSTER_COLUMNS = ["name", "field", "ra", "dec", "pmra", "pmdec", "distance"]
+
+# The columns printed for each matched cluster.
+PRINT_COLUMNS = ["name", "match_1", "score_1", "match_separation", "match_pm_difference",\
+ "match_distance_ratio"]
+
+
+def match_space(clusters):
+    """ The (n, 6) match space coordinates of a cluster dataframe with the ra, dec, pmra,
+    pmdec, and distance columns. """
+    ra = np.radians(clusters["ra"].to_numpy(dtype=np.float64))
+    dec = np.radians(clusters["dec"].to_numpy(dtype=np.float64))
+    # The chord between two unit vectors MATCH_ANGLE apart.
+    chord = 2*np.sin(np.radians(MATCH_ANGLE)/2)
+    points = np.empty((len(clusters), 6))
+    points[:, 0] = np.cos(dec)*np.cos(ra)/chord
+    points[:, 1] = np.cos(dec)*np.sin(ra)/chord
+    points[:, 2] = np.sin(dec)/chord
+    points[:, 3] = clusters["pmra"].to_numpy(dtype=np.float64)/MATCH_PM
+    points[:, 4] = clusters["pmdec"].to_numpy(dtype=np.float64)/MATCH_PM
+    points[:, 5] = np.log(clusters["distance"].to_numpy(dtype=np.float64))/np.log1p(MATCH_DISTANCE)
+    return points
+
+
+def read_reference(path=None):
+    """ The clusters of a reference catalogue csv (default REFERENCE_CATALOGUE).  The
+    distance is taken from the parallax when there is no distance column, and rows
+    missing any of the match columns are dropped. """
+    if path is None:
+        path = REFERENCE_CATALOGUE
+    catalogue = pd.read_csv(path)
+    if "distance" not in catalogue:
+        catalogue["distance"] = 1000/catalogue["parallax"]
+    catalogue["name"] = catalogue["name"].astype(str)
+    catalogue["field"] = ""
+    catalogue = catalogue[CLUSTER_COLUMNS].dropna()
+    return catalogue.loc[catalogue["distance"] > 0].reset_index(drop=True)
+
+
+def summary_clusters(table, field, real_only=True):
+    """ The clusters of a ClusterSummary table of field (only those passing the real
+    cluster cut unless real_only is False), named "<field>:<clusternum>". """
+    if real_only:
+        table = table.loc[table["real_cluster"].astype(bool)]
+    numbers = table.index.to_numpy()
+    clusters = pd.DataFrame({"name": [str(field)+":"+str(number) for number in numbers],\
+     "field": str(field), "clusternum": numbers,\
+     # The median of the wrapped RA can lie outside 0 to 360 degrees.
+     "ra": np.mod(table["ramedian"].to_numpy(), 360), "dec": table["dec_median"].to_numpy(),\
+     "pmra": table["pmra_median"].to_numpy(), "pmdec": table["pmdec_median"].to_numpy(),\
+     "distance": table["distcen"].to_numpy(), "count": table["count"].to_numpy()})
+    return clusters
+
+
+def summary_field(path):
+    """ The field name of a summary table file: the field of a cluster_export.py
+    directory, the label of a batch_fields.py summary, or else the file name. """
+    directory, filename = os.path.split(os.path.normpath(path))
+    if filename == "summary.csv" and os.path.basename(directory).startswith("field="):
+        return os.path.basename(directory)[len("field="):]
+    name = os.path.splitext(filename)[0]
+    if name.endswith("_summary"):
+        return name[:-len("_summary")]
+    return name
+
+
+def read_summaries(patterns, real_only=True):
+    """ The clusters of every summary table file matching the glob patterns.  Files
+    without a clusternum column (e.g., the batch_fields.py run summary, which
+    "batch_output/*_summary.csv" also matches) are not cluster tables and are skipped. """
+    paths = sorted({path for pattern in patterns for path in glob.glob(pattern)})
+    tables = [summary_clusters(pd.read_csv(path, index_col="clusternum"), summary_field(path),\
+     real_only) for path in paths if "clusternum" in pd.read_csv(path, nrows=0).columns]
+    if not tables:
+        return pd.DataFrame(columns=CLUSTER_COLUMNS)
+    return pd.concat(tables, ignore_index=True)
+
+
+class ClusterIndex:
+    """ A KD-tree of known clusters (a dataframe with the CLUSTER_COLUMNS) in the match
+    space.  match() labels any number of found clusters with their nearest known
+    counterparts. """
+
+    def __init__(self, known):
+        from scipy.spatial import cKDTree
+
+        self.known = known.reset_index(drop=True)
+        self._tree = cKDTree(match_space(self.known)) if len(self.known) else None
+
+    def match(self, clusters, count=None, radius=None):
+        """ The clusters with, for the nearest count (default MATCH_COUNT) known clusters
+        within radius (default MATCH_RADIUS) match space units, the match_<i> name and
+        score_<i> separation columns (empty and NaN where there are fewer), and the sky
+        separation (degrees), proper motion difference (mas/yr), and distance ratio of
+        the best match. """
+        if count is None:
+            count = MATCH_COUNT
+        if radius is None:
+            radius = MATCH_RADIUS
+        with pipeline_profile.stage("cross_match", len(clusters)) as stage:
+            clusters = clusters.reset_index(drop=True)
+            known_count = len(self.known)
+            scores = np.full((len(clusters), count), np.inf)
+            rows = np.full((len(clusters), count), known_count)
+            if self._tree is not None and len(clusters):
+                # A few more neighbors are queried so that the clusters of a found
+                # cluster's own field can be left out.
+                fields = self.known["field"].to_numpy()
+                own_field = clusters["field"].to_numpy()
+                field_counts = self.known["field"].value_counts()
+                own_count = field_counts.reindex(np.unique(own_field), fill_value=0).max()
+                extra = min(count + int(own_count), known_count)
+                found_scores, found_rows = self._tree.query(match_space(clusters), k=extra,\
+                 distance_upper_bound=radius, workers=-1)
+                found_scores = found_scores.reshape(len(clusters), extra)
+                found_rows = found_rows.reshape(len(clusters), extra)
+                padded_fields = np.append(fields, "")
+                found_scores[(padded_fields[found_rows] == own_field[:, None]) &\
+                 (found_rows < known_count)] = np.inf
+                ranks = np.argsort(found_scores, axis=1, kind="stable")[:, :count]
+                kept = min(count, extra)
+                scores[:, :kept] = np.take_along_axis(found_scores, ranks, axis=1)
+                rows[:, :kept] = np.take_along_axis(found_rows, ranks, axis=1)
+                rows[np.isinf(scores)] = known_count
+            names = np.append(self.known["name"].to_numpy(dtype=object), "")
+            matches = clusters.copy()
+            for rank in range(count):
+                matches["match_"+str(rank + 1)] = names[rows[:, rank]]
+                matches["score_"+str(rank + 1)] = np.where(np.isinf(scores[:, rank]), np.nan,\
+                 scores[:, rank])
+            best = rows[:, 0] < known_count
+            known = self.known.iloc[rows[best, 0]]
+            separation = np.full(len(clusters), np.nan)
+            pm_difference = np.full(len(clusters), np.nan)
+            distance_ratio = np.full(len(clusters), np.nan)
+            found = clusters.loc[best, CLUSTER_COLUMNS[2:]].to_numpy(dtype=np.float64)
+            known = known[CLUSTER_COLUMNS[2:]].to_numpy(dtype=np.float64)
+            separation[best] = angular_separation(found[:, 0], found[:, 1], known[:, 0], known[:, 1])
+            pm_difference[best] = np.hypot(found[:, 2] - known[:, 2], found[:, 3] - known[:, 3])
+            distance_ratio[best] = found[:, 4]/known[:, 4]
+            matches["match_separation"] = separation
+            matches["match_pm_difference"] = pm_difference
+            matches["match_distance_ratio"] = distance_ratio
+            stage.rows_out = int(best.sum())
+        return matches
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """ The angular separation (degrees) of two sets of positions (degrees), from the
+    haversine formula. """
+    ra1, dec1, ra2, dec2 = np.radians(ra1), np.radians(dec1), np.radians(ra2), np.radians(dec2)
+    haversine = np.sin((dec2 - dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2)**2
+    return np.degrees(2*np.arcsin(np.sqrt(np.clip(haversine, 0, 1))))
+
+
+def known_clusters(reference=None, runs=None):
+    """ The known clusters: the reference catalogue (default REFERENCE_CATALOGUE, skipped
+    when that file does not exist) and the real clusters of the earlier run summaries
+    (glob patterns, default RUN_SUMMARIES). """
+    if reference is None:
+        reference = REFERENCE_CATALOGUE
+    if runs is None:
+        runs = RUN_SUMMARIES
+    known = read_summaries(runs)
+    if reference and os.path.exists(reference):
+        catalogue = read_reference(reference)
+        known = pd.concat([catalogue, known], ignore_index=True) if len(known) else catalogue
+    return known[CLUSTER_COLUMNS]
+
+
+def cross_match(table, field, reference=None, runs=None, real_only=True, count=None):
+    """ The clusters of the ClusterSummary table of field labelled with their known
+    counterparts (see ClusterIndex.match). """
+    index = ClusterIndex(known_clusters(reference, runs))
+    return index.match(summary_clusters(table, field, real_only), count)
+
+
+def main():
+    """ Parses the command line, matches the clusters of every summary table, and
+    writes the matches. """
+    parser = argparse.ArgumentParser(description="Cross-match found clusters against known clusters.")
+    parser.add_argument("summaries", nargs="+", help="summary tables (or glob patterns) of the"\
+     " found clusters")
+    parser.add_argument("--reference", default=REFERENCE_CATALOGUE, help="reference cluster"\
+     " catalogue csv (default: "+REFERENCE_CATALOGUE+")")
+    parser.add_argument("--runs", nargs="*", default=RUN_SUMMARIES, help="summary tables (or glob"\
+     " patterns) of earlier runs (default: the cluster_export.py tables)")
+    parser.add_argument("--count", type=int, default=MATCH_COUNT, help="counterparts per cluster")
+    parser.add_argument("--all", action="store_true", help="also match the clusters that fail"\
+     " the real cluster cut")
+    parser.add_argument("--output", default="crossmatch.csv", help="output csv")
+    args = parser.parse_args()
+
+    index = ClusterIndex(known_clusters(args.reference, args.runs))
+    matches = index.match(read_summaries(args.summaries, not args.all), args.count)
+    matches.to_csv(args.output, index=False)
+    print(str(len(matches))+" clusters matched against "+str(len(index.known))+" known clusters")
+    print(matches[PRINT_COLUMNS].to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
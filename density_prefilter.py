@@ -0,0 +1,75 @@
+""" Optional density prefilter of the HDBSCAN input.  Most of the stars of a large field
+    are sparse disk field stars that HDBSCAN always labels as noise, so they are
+    removed before the fit.  The local density of every star in the 5D scaled feature
+    space is estimated from its distance to the PREFILTER_NEIGHBORS-th nearest star of a
+    random subsample of PREFILTER_SAMPLE stars, relative to the median density of the
+    field, and stars below PREFILTER_DENSITY_RATIO of the median are labelled as noise
+    without being clustered.  Clusters are overdensities of the field, so their
+    members lie far above this cut. """
+import numpy as np
+
+# The size of the random reference subsample, the neighbor rank of the density
+# estimate, and the density (relative to the field median) below which stars are
+# dropped.  0.1 keeps every injected cluster member of the benchmark.py fields.
+PREFILTER_SAMPLE = 20000
+PREFILTER_NEIGHBORS = 10
+PREFILTER_DENSITY_RATIO = 0.1
+PREFILTER_SEED = 0
+
+
+def prefilter_settings():
+    """ The prefilter parameters, for the result cache key. """
+    return {"sample": PREFILTER_SAMPLE, "neighbors": PREFILTER_NEIGHBORS,\
+     "density_ratio": PREFILTER_DENSITY_RATIO, "seed": PREFILTER_SEED}
+
+
+def relative_density(features, sample_size=None, neighbors=None, seed=None):
+    """ The local density of every row of features relative to the median density, from
+    the distance to the neighbors-th nearest row of a random subsample of sample_size
+    rows (each defaulting to its PREFILTER constant).  The density of the five
+    dimensional space scales as the inverse fifth power of that distance. """
+    if sample_size is None:
+        sample_size = PREFILTER_SAMPLE
+    if neighbors is None:
+        neighbors = PREFILTER_NEIGHBORS
+    if seed is None:
+        seed = PREFILTER_SEED
+    from scipy.spatial import cKDTree
+
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(features), min(sample_size, len(features)), replace=False)
+    # A sampled row finds itself at distance 0, so one more neighbor is queried.
+    neighbors = min(neighbors, len(sample) - 1)
+    distances, _ = cKDTree(features[np.sort(sample)]).query(features, k=neighbors + 1)
+    radius = np.maximum(distances[:, neighbors], np.finfo(np.float64).tiny)
+    return (np.median(radius)/radius)**features.shape[1]
+
+
+def dense_rows(features, density_ratio=None):
+    """ The boolean selection of the rows of features at or above density_ratio
+    (default PREFILTER_DENSITY_RATIO) of the median density. """
+    if density_ratio is None:
+        density_ratio = PREFILTER_DENSITY_RATIO
+    return relative_density(features) >= density_ratio
+
+
+def expand_result(result, keep):
+    """ Expands a result_cache result of the kept rows to the whole field: dropped rows
+    are labelled -1 with a membership probability of 0 and an outlier score of 1, and
+    the condensed tree points are renumbered to field rows (with the cluster numbers
+    shifted to follow them, as in a tree of the whole field). """
+    rows = np.flatnonzero(keep)
+    kept_count, star_count = len(rows), len(keep)
+    labels = np.full(star_count, -1, dtype=result["labels"].dtype)
+    labels[rows] = result["labels"]
+    probabilities = np.zeros(star_count)
+    probabilities[rows] = result["probabilities"]
+    outlier_scores = np.ones(star_count)
+    outlier_scores[rows] = result["outlier_scores"]
+    condensed_tree = result["condensed_tree"].copy()
+    condensed_tree["parent"] += star_count - kept_count
+    points = condensed_tree["child"] < kept_count
+    condensed_tree["child"][points] = rows[condensed_tree["child"][points]]
+    condensed_tree["child"][~points] += star_count - kept_count
+    return {"labels": labels, "probabilities": probabilities, "outlier_scores": outlier_scores,\
+     "condensed_tree": condensed_tree}
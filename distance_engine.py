@@ -0,0 +1,280 @@
+""" Monte Carlo distances from the Gaia parallaxes and their errors, as an optional
+    replacement of the direct inversion of the zeropoint corrected parallax in
+    gaia_dr2_read_setup (set USE_DISTANCE_ENGINE = 1 in cluster_hdbscan.py).
+
+    DISTANCE_SAMPLES parallaxes are drawn for every star from its Gaia parallax and
+    error, and each one is inverted into a distance sample.  The draws are stratified:
+    every star uses the same DISTANCE_SAMPLES standard normal nodes, one from each
+    equal probability stratum (randomly placed within it, per chunk), so a star's
+    distance samples come out already sorted and no per-star sort is needed.  The
+    samples are weighted towards the DISTANCE_PRIOR space density by importance
+    sampling (the inverted draws follow the parallax likelihood times 1/distance^2):
+
+    "none": the plain inverted draws, whose median is the direct inversion;
+    "uniform": a uniform space density out to DISTANCE_MAX (pc), whose posterior lies
+     in the far tail of the draws of a star with a large fractional parallax error, so
+     such stars need many more DISTANCE_SAMPLES;
+    "exponential": the exponentially decreasing space density of Bailer-Jones (2015),
+     with length scale DISTANCE_LENGTH_SCALE (pc).
+
+    Draws with a non-positive parallax carry no weight, so a star whose parallax is
+    nowhere positive within its errors has undefined (NaN) distances; the pipeline's
+    parallax error ratio cut keeps the fractional errors far from this.  The stars are
+    processed DISTANCE_CHUNK_ROWS at a time in float32 by DISTANCE_WORKERS threads,
+    which bounds the memory to a few (DISTANCE_CHUNK_ROWS, DISTANCE_SAMPLES) arrays per
+    thread whatever the field size.
+
+    Usage: python distance_engine.py CLUSTER_NAME FIELD_RADIUS [--prior PRIOR]
+            [--samples N] [--clusters]
+
+    writes each star's DISTANCE_QUANTILES to "<CLUSTER_NAME>distances.csv" and, with
+    --clusters, the quantiles of each cluster's pooled member samples to
+    "<CLUSTER_NAME>clusterdistances.csv". """
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import os
+from statistics import NormalDist
+import numpy as np
+import pandas as pd
+import pipeline_profile
+
+# The parallax draws per star, the prior ("none", "uniform", or "exponential"), and the
+# prior length scale and maximum distance (pc).
+DISTANCE_SAMPLES = 32
+DISTANCE_PRIOR = "exponential"
+DISTANCE_LENGTH_SCALE = 1350
+DISTANCE_MAX = 10000
+
+# The distance quantiles of each star (the median replaces the distance column and
+# the others are added as distance_<percent> columns).
+DISTANCE_QUANTILES = [0.16, 0.5, 0.84]
+
+# The stars processed at once (small enough for the chunk arrays to stay in cache), the
+# worker threads (None for one per core), and the seed of the stratum offsets.
+DISTANCE_CHUNK_ROWS = 8192
+DISTANCE_WORKERS = None
+DISTANCE_SEED = 0
+
+# The same 0.03 mas zeropoint correction as the direct inversion.
+PARALLAX_ZEROPOINT = 0.03
+
+# The log-spaced distance bins (pc) in which the member samples of each cluster are
+# pooled for the cluster quantiles.
+CLUSTER_BINS = 5000
+CLUSTER_RANGE = (1, 100000)
+
+PRIORS = ["none", "uniform", "exponential"]
+
+
+def engine_settings(prior=None, samples=None):
+    """ The engine parameters, for the result cache key. """
+    return {"prior": prior or DISTANCE_PRIOR, "samples": samples or DISTANCE_SAMPLES,\
+     "length_scale": DISTANCE_LENGTH_SCALE, "max": DISTANCE_MAX, "seed": DISTANCE_SEED,\
+     "zeropoint": PARALLAX_ZEROPOINT}
+
+
+def sample_nodes(samples, rng):
+    """ The standard normal nodes of one draw per equal probability stratum, each at a
+    random position within its stratum, in decreasing order (so that the parallax draws
+    decrease and the distance samples increase). """
+    normal = NormalDist()
+    positions = (np.arange(samples) + rng.random())/samples
+    return -np.array([normal.inv_cdf(position) for position in positions], dtype=np.float32)
+
+
+def chunk_weights(parallax, parallax_error, nodes, prior):
+    """ The distance samples (pc) of a chunk of stars, increasing along each row, and the
+    cumulative sample weights normalized to 1 per row. """
+    distance = np.multiply(parallax_error.astype(np.float32)[:, None], nodes)
+    distance += (parallax + PARALLAX_ZEROPOINT).astype(np.float32)[:, None]
+    positive = distance > 0
+    with np.errstate(divide="ignore"):
+        np.divide(np.float32(1000), distance, out=distance)
+    distance[~positive] = np.inf
+    if prior == "none":
+        weights = positive.astype(np.float32)
+    elif prior == "uniform":
+        # The draws already follow the likelihood times 1/distance^2, so a constant space
+        # density (distance^2 per unit distance) takes distance^4.
+        with np.errstate(over="ignore"):
+            weights = np.power(distance, 4)
+        weights[distance > DISTANCE_MAX] = 0
+    elif prior == "exponential":
+        # distance^4 exp(-distance/DISTANCE_LENGTH_SCALE) peaks at 4 DISTANCE_LENGTH_SCALE
+        # well within float32, so no per-row rescaling is needed (infinite distances
+        # give exp(-inf) = 0).
+        with np.errstate(invalid="ignore"):
+            weights = np.log(distance)
+            weights *= 4
+            weights -= distance/np.float32(DISTANCE_LENGTH_SCALE)
+        weights[~positive] = -np.inf
+        np.exp(weights, out=weights)
+    else:
+        raise ValueError("unknown distance prior "+repr(prior)+" (expected one of "+\
+         ", ".join(PRIORS)+")")
+    cumulative = np.cumsum(weights, axis=1, out=weights)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cumulative /= cumulative[:, -1:]
+    return distance, cumulative
+
+
+def weighted_quantiles(distance, cumulative, quantiles):
+    """ The quantiles of each row of weighted, increasing distance samples, linearly
+    interpolated between the samples placed at the midpoints of their weights. """
+    rows, samples = distance.shape
+    midpoints = np.empty_like(cumulative)
+    midpoints[:, 0] = cumulative[:, 0]/2
+    np.add(cumulative[:, 1:], cumulative[:, :-1], out=midpoints[:, 1:])
+    midpoints[:, 1:] /= 2
+    # The samples are gathered through flat indices of the row-major arrays.
+    row_starts = np.arange(0, rows*samples, samples)
+    midpoints, distance = midpoints.ravel(), distance.ravel()
+    values = np.empty((rows, len(quantiles)))
+    for column, quantile in enumerate(quantiles):
+        upper = np.minimum(np.count_nonzero((midpoints < quantile).reshape(rows, samples), axis=1),\
+         samples - 1)
+        lower = row_starts + np.maximum(upper - 1, 0)
+        upper += row_starts
+        mid_lower, mid_upper = midpoints.take(lower), midpoints.take(upper)
+        low, high = distance.take(lower), distance.take(upper)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fraction = np.clip((quantile - mid_lower)/(mid_upper - mid_lower), 0, 1)
+        fraction[~np.isfinite(fraction)] = 0
+        # Zero weight samples (at infinite distance) are never interpolated towards.
+        high = np.where(np.isfinite(high), high, low)
+        with np.errstate(invalid="ignore"):
+            values[:, column] = low + fraction*(high - low)
+    values[~np.isfinite(cumulative[:, -1])] = np.nan
+    return values
+
+
+def star_distances(parallax, parallax_error, prior=None, samples=None, quantiles=None,\
+ chunk_rows=None, seed=None, workers=None):
+    """ The (stars, quantiles) distance quantiles (pc) of every star from its parallax
+    and parallax error (mas), each setting defaulting to its DISTANCE constant.  The
+    chunks are spread over worker threads (numpy releases the GIL in its array
+    operations), each holding one chunk at a time. """
+    prior = prior or DISTANCE_PRIOR
+    samples = samples or DISTANCE_SAMPLES
+    quantiles = DISTANCE_QUANTILES if quantiles is None else quantiles
+    chunk_rows = chunk_rows or DISTANCE_CHUNK_ROWS
+    workers = workers or DISTANCE_WORKERS or os.cpu_count() or 1
+    rng = np.random.default_rng(DISTANCE_SEED if seed is None else seed)
+    parallax = np.asarray(parallax, dtype=np.float64)
+    parallax_error = np.asarray(parallax_error, dtype=np.float64)
+    values = np.empty((len(parallax), len(quantiles)))
+    starts = range(0, len(parallax), chunk_rows)
+    # The nodes are drawn up front so the result does not depend on the workers.
+    nodes = [sample_nodes(samples, rng) for _ in starts]
+
+    def run_chunk(start, chunk_nodes):
+        stop = start + chunk_rows
+        distance, cumulative = chunk_weights(parallax[start:stop], parallax_error[start:stop],\
+         chunk_nodes, prior)
+        values[start:stop] = weighted_quantiles(distance, cumulative, quantiles)
+
+    if workers == 1 or len(starts) == 1:
+        for start, chunk_nodes in zip(starts, nodes):
+            run_chunk(start, chunk_nodes)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for _ in executor.map(run_chunk, starts, nodes):
+                pass
+    return values
+
+
+def add_distances(fieldpar, prior=None, samples=None):
+    """ Replaces the distance column of a gaia_dr2_read_setup dataframe (with the
+    parallax_error column) by the median Monte Carlo distance, and adds the other
+    DISTANCE_QUANTILES as distance_<percent> columns. """
+    quantiles = sorted(set(DISTANCE_QUANTILES) | {0.5})
+    with pipeline_profile.stage("distances", len(fieldpar)) as stage:
+        values = star_distances(fieldpar["parallax"].to_numpy(), fieldpar["parallax_error"].to_numpy(),\
+         prior, samples, quantiles)
+        for column, quantile in enumerate(quantiles):
+            name = "distance" if quantile == 0.5 else "distance_"+format(100*quantile, "g")
+            fieldpar[name] = values[:, column]
+        stage.rows_out = len(fieldpar)
+    return fieldpar
+
+
+def cluster_distances(fieldpar, prior=None, samples=None, quantiles=None, chunk_rows=None,\
+ seed=None):
+    """ The distance quantiles (pc) of the pooled member samples of each cluster of a
+    clustered dataframe (with the parallax_error column), one row per clusternum with
+    the member count.  Every member contributes equal total weight, and the samples are
+    accumulated chunk by chunk into CLUSTER_BINS log-spaced bins, within which the
+    quantiles are interpolated. """
+    prior = prior or DISTANCE_PRIOR
+    samples = samples or DISTANCE_SAMPLES
+    quantiles = DISTANCE_QUANTILES if quantiles is None else quantiles
+    chunk_rows = chunk_rows or DISTANCE_CHUNK_ROWS
+    rng = np.random.default_rng(DISTANCE_SEED if seed is None else seed)
+    labels = fieldpar["clusternum"].to_numpy()
+    members = np.flatnonzero(labels >= 0)
+    numbers, positions, counts = np.unique(labels[members], return_inverse=True, return_counts=True)
+    parallax = fieldpar["parallax"].to_numpy(dtype=np.float64)[members]
+    parallax_error = fieldpar["parallax_error"].to_numpy(dtype=np.float64)[members]
+    edges = np.geomspace(CLUSTER_RANGE[0], CLUSTER_RANGE[1], CLUSTER_BINS + 1)
+    log_low, log_step = np.log(CLUSTER_RANGE[0]), np.log(CLUSTER_RANGE[1]/CLUSTER_RANGE[0])/CLUSTER_BINS
+    histogram = np.zeros(len(numbers)*CLUSTER_BINS)
+    for start in range(0, len(members), chunk_rows):
+        stop = start + chunk_rows
+        distance, cumulative = chunk_weights(parallax[start:stop], parallax_error[start:stop],\
+         sample_nodes(samples, rng), prior)
+        weights = np.diff(cumulative, axis=1, prepend=0)
+        usable = np.isfinite(distance) & (weights > 0)
+        with np.errstate(divide="ignore"):
+            bins = np.clip(((np.log(distance) - log_low)/log_step).astype(np.int64), 0, CLUSTER_BINS - 1)
+        bins += (positions[start:stop]*CLUSTER_BINS)[:, None]
+        histogram += np.bincount(bins[usable], weights=weights[usable], minlength=len(histogram))
+    histogram = histogram.reshape(len(numbers), CLUSTER_BINS)
+    cumulative = np.cumsum(histogram, axis=1)
+    cumulative /= np.maximum(cumulative[:, -1:], np.finfo(np.float64).tiny)
+    table = pd.DataFrame({"count": counts}, index=pd.Index(numbers, name="clusternum"))
+    for quantile in quantiles:
+        upper = np.minimum((cumulative < quantile).sum(axis=1), CLUSTER_BINS - 1)
+        below = np.where(upper > 0, cumulative[np.arange(len(numbers)), upper - 1], 0)
+        within = histogram[np.arange(len(numbers)), upper]
+        fraction = np.clip((quantile - below)/np.where(within > 0, within, 1), 0, 1)
+        # Log-linear interpolation within the bin.
+        table["distance_"+format(100*quantile, "g")] = \
+            edges[upper]*(edges[upper + 1]/edges[upper])**fraction
+    return table
+
+
+def main():
+    """ Parses the command line and writes the star (and cluster) distances. """
+    import cluster_hdbscan
+    from field_store import field_dataframe, field_filename
+
+    parser = argparse.ArgumentParser(description="Monte Carlo distances of a Gaia field.")
+    parser.add_argument("name", help="CLUSTER_NAME of the input \"<name>gaiafield<radius>.csv\"")
+    parser.add_argument("radius", help="FIELD_RADIUS of the input csv")
+    parser.add_argument("--prior", choices=PRIORS, default=DISTANCE_PRIOR)
+    parser.add_argument("--samples", type=int, default=DISTANCE_SAMPLES, help="parallax draws per star")
+    parser.add_argument("--clusters", action="store_true", help="also write the distances of each"\
+     " cluster of the cluster_hdbscan.py fit")
+    args = parser.parse_args()
+
+    with pipeline_profile.run(args.name):
+        fieldpar = field_dataframe(field_filename(args.name, args.radius),\
+         parallax_ratio_cut=cluster_hdbscan.PARALLAX_RATIO_CUT, extra_columns=["parallax_error"])
+        fieldpar["direct_distance"] = fieldpar["distance"]
+        fieldpar = add_distances(fieldpar, args.prior, args.samples)
+        distance_columns = [name for name in fieldpar if name.startswith("distance")]
+        fieldpar[["direct_distance"]+distance_columns].to_csv(args.name+"distances.csv")
+        if args.clusters:
+            # The cluster_hdbscan.py fit, re-used from the result cache when possible.
+            clustered = cluster_hdbscan.gaia_dr2_read_setup(args.name, args.radius)
+            clustered = cluster_hdbscan.clustering_algorithm(\
+             cluster_hdbscan.scaled_features(clustered), clustered,\
+             source=cluster_hdbscan.feature_source(args.name, args.radius), write_extract=False)
+            clustered["parallax_error"] = fieldpar.loc[clustered.index, "parallax_error"]
+            table = cluster_distances(clustered, args.prior, args.samples)
+            table.to_csv(args.name+"clusterdistances.csv")
+            print(table.to_string())
+
+
+if __name__ == "__main__":
+    main()
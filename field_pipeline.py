@@ -0,0 +1,345 @@
+""" Runs the fields of a batch_fields.py manifest through the pipeline stages
+    concurrently: while one field is being clustered, the next one is already being
+    read and the previous one is being summarized and rendered, instead of every stage
+    of every field running one after another.
+
+    The stages (ingest: gaia_dr2_read_setup; scale: scaled_features; hdbscan:
+    clustering_algorithm; statistics: the ClusterSummary table and the white dwarf
+    search; render: the cluster_export.py export and the figure_export.py figures) are
+    connected by queues of at most QUEUE_SIZE fields, and each stage has its own number
+    of worker threads (STAGE_WORKERS).  A stage whose downstream queue is full waits,
+    so at most QUEUE_SIZE fields wait between two stages and memory stays bounded
+    however long the manifest is.  The HDBSCAN fits run in a pool of worker processes
+    (one per hdbscan stage worker) so that they never hold the GIL while the other
+    stages parse, scale, and render, and the figures are rendered in figure_export.py's
+    own processes.
+
+    Each stage's utilization (the fraction of its workers' time spent working, rather
+    than waiting for a field or for room downstream) is printed and written to
+    "<output_dir>/pipeline_utilization.csv", next to the batch_fields.py run summary.
+    A field that fails in any stage is recorded (with its traceback in
+    "<prefix>error.txt") and skips the remaining stages, holding none of its data.
+
+    The white dwarf search runs on its own fit of the field with the settings of
+    cluster_hdbscan_wdsearch.py (no parallax error ratio cut, its MIN_SAMPLE, scalings,
+    and no density prefilter), since the faint white dwarfs have large parallax errors
+    and most would be cut from the cluster_hdbscan.py fit.  The ingest, scale, and hdbscan
+    stages prepare both fits, and the two HDBSCAN fits of a field run side by side in the
+    process pool.
+
+    Usage: python field_pipeline.py manifest.csv [--output-dir DIR] [--queue-size N]
+            [--stage-workers STAGE=N [STAGE=N ...]] [--no-figures] [--no-wd-search] """
+import argparse
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import batch_fields
+import cluster_export
+import cluster_hdbscan
+import cluster_hdbscan_wdsearch
+from cluster_summary import ClusterSummary
+from figure_export import export_figures
+
+# The most fields waiting between two stages, and the worker threads of each stage
+# (None for the hdbscan stage is half the cores).
+QUEUE_SIZE = 2
+STAGE_WORKERS = {"ingest": 1, "scale": 1, "hdbscan": None, "statistics": 1, "render": 1}
+
+# These flags determine whether or not the white dwarf search and the figure export are
+# run for every field.  Enter 1 for yes and 0 for no.
+WD_SEARCH = 1
+RENDER_FIGURES = 1
+
+UTILIZATION_NAME = "pipeline_utilization.csv"
+
+# The keys of a field job that a failed job keeps (the rest is its data).
+JOB_KEYS = ["field", "prefix", "row"]
+
+# The end-of-input marker passed down the queues.
+_DONE = object()
+
+
+class StageFailure:
+    """ An item that raised an exception in a stage, passed on through the remaining
+    stages without being processed. """
+
+    def __init__(self, item, stage, error, trace):
+        self.item = item
+        self.stage = stage
+        self.error = error
+        self.traceback = trace
+
+
+class StagePipeline:
+    """ Runs items through a chain of stages, given as (name, function, workers) tuples,
+    where each function takes an item and returns the item for the next stage.  Every
+    stage runs on its own worker threads, connected by queues of at most queue_size
+    items, so a stage blocks when the next one falls behind. """
+
+    def __init__(self, stages, queue_size=None):
+        self.stages = stages
+        self.queue_size = queue_size or QUEUE_SIZE
+        self.utilization = None
+
+    def run(self, items):
+        """ Runs every item through the stages and returns the results in input order (a
+        StageFailure for an item that raised).  The stage utilization table is kept in
+        the utilization attribute. """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]+[queue.Queue()]
+        lock = threading.Lock()
+        remaining = [workers for _, _, workers in self.stages]
+        stats = [{"stage": name, "workers": workers, "items": 0, "busy_s": 0.0, "waiting_s": 0.0,\
+         "blocked_s": 0.0, "max_queue": 0} for name, _, workers in self.stages]
+
+        def feed():
+            for position, item in enumerate(items):
+                queues[0].put((position, item))
+            for _ in range(self.stages[0][2]):
+                queues[0].put(_DONE)
+
+        def work(index):
+            name, function, _ = self.stages[index]
+            inbox, outbox = queues[index], queues[index + 1]
+            busy = waiting = blocked = 0.0
+            count = depth = 0
+            while True:
+                start = time.perf_counter()
+                entry = inbox.get()
+                waiting += time.perf_counter() - start
+                if entry is _DONE:
+                    break
+                position, item = entry
+                depth = max(depth, inbox.qsize() + 1)
+                start = time.perf_counter()
+                if not isinstance(item, StageFailure):
+                    try:
+                        item = function(item)
+                    except Exception as error:
+                        item = StageFailure(item, name, error, traceback.format_exc())
+                    count += 1
+                busy += time.perf_counter() - start
+                start = time.perf_counter()
+                outbox.put((position, item))
+                blocked += time.perf_counter() - start
+            with lock:
+                stat = stats[index]
+                stat["items"] += count
+                stat["busy_s"] += busy
+                stat["waiting_s"] += waiting
+                stat["blocked_s"] += blocked
+                stat["max_queue"] = max(stat["max_queue"], depth)
+                remaining[index] -= 1
+                last = remaining[index] == 0
+            # The last worker of a stage passes the end of the input on.
+            if last:
+                for _ in range(self.stages[index + 1][2] if index + 1 < len(self.stages) else 1):
+                    outbox.put(_DONE)
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for index, (_, _, workers) in enumerate(self.stages):
+            threads += [threading.Thread(target=work, args=(index,), daemon=True)\
+             for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall = time.perf_counter() - start
+
+        results = []
+        while True:
+            entry = queues[-1].get()
+            if entry is _DONE:
+                break
+            results.append(entry)
+        for stat in stats:
+            stat["utilization"] = round(stat["busy_s"]/(wall*stat["workers"]), 3) if wall > 0 else 0.0
+            for key in ["busy_s", "waiting_s", "blocked_s"]:
+                stat[key] = round(stat[key], 3)
+        self.utilization = pd.DataFrame(stats)
+        self.utilization.attrs["wall_s"] = round(wall, 3)
+        return [item for _, item in sorted(results, key=lambda entry: entry[0])]
+
+
+def _fit_field(features, fieldpar, min_samples, prefix, core_dist_n_jobs, source, prefilter=None,\
+ write_extract=True):
+    """ Runs clustering_algorithm in a worker process and returns the columns it adds. """
+    warnings.filterwarnings("ignore")
+    fieldpar = cluster_hdbscan.clustering_algorithm(features, fieldpar, min_samples, prefix,\
+     core_dist_n_jobs, source=source, prefilter=prefilter, write_extract=write_extract)
+    return {name: fieldpar[name].to_numpy() for name in ["clusternum", "clusterprob", "M_G"]}
+
+
+def field_stages(output_dir, stage_workers=None, wd_search=None, render_figures=None):
+    """ The (name, function, workers) stages of a field, and the HDBSCAN process pool
+    (shut down by the caller).  Each stage function takes and returns a field job: a
+    dictionary of the manifest field, its output prefix, its summary row, and the data
+    the later stages need (which each stage drops once used, and which is dropped
+    when a stage fails). """
+    workers = dict(STAGE_WORKERS, **(stage_workers or {}))
+    cores = os.cpu_count() or 1
+    if workers["hdbscan"] is None:
+        workers["hdbscan"] = max(1, cores//2)
+    wd_search = WD_SEARCH == 1 if wd_search is None else wd_search
+    render_figures = RENDER_FIGURES == 1 if render_figures is None else render_figures
+    # Each hdbscan worker runs its field's fits (two with the white dwarf search) at once.
+    processes = workers["hdbscan"]*(2 if wd_search else 1)
+    core_dist_n_jobs = max(1, cores//processes)
+    pool = ProcessPoolExecutor(max_workers=processes,\
+     mp_context=multiprocessing.get_context("spawn"))
+
+    def ingest(job):
+        field = job["field"]
+        job["started"] = time.time()
+        job["fieldpar"] = cluster_hdbscan.gaia_dr2_read_setup(field["name"], field["radius"])
+        job["row"]["stars"] = len(job["fieldpar"])
+        if wd_search:
+            job["wd_fieldpar"] = cluster_hdbscan.gaia_dr2_read_setup(field["name"], field["radius"],\
+             parallax_ratio_cut=None)
+        return job
+
+    def scale(job):
+        field = job["field"]
+        job["features"] = cluster_hdbscan.scaled_features(job["fieldpar"], field["distance_scale"],\
+         field["pm_scale"])
+        job["source"] = cluster_hdbscan.feature_source(field["name"], field["radius"],\
+         field["distance_scale"], field["pm_scale"])
+        if wd_search:
+            job["wd_features"] = cluster_hdbscan.scaled_features(job["wd_fieldpar"],\
+             cluster_hdbscan_wdsearch.DISTANCE_SCALE, cluster_hdbscan_wdsearch.PM_SCALE)
+            job["wd_source"] = cluster_hdbscan.feature_source(field["name"], field["radius"],\
+             cluster_hdbscan_wdsearch.DISTANCE_SCALE, cluster_hdbscan_wdsearch.PM_SCALE,\
+             parallax_ratio_cut=None)
+        return job
+
+    def fit(job):
+        fits = {"fieldpar": pool.submit(_fit_field, job.pop("features"), job["fieldpar"],\
+         job["field"]["min_samples"], job["prefix"], core_dist_n_jobs, job.pop("source"))}
+        if wd_search:
+            fits["wd_fieldpar"] = pool.submit(_fit_field, job.pop("wd_features"), job["wd_fieldpar"],\
+             cluster_hdbscan_wdsearch.MIN_SAMPLE, job["prefix"], core_dist_n_jobs, job.pop("wd_source"),\
+             prefilter=False, write_extract=False)
+        for key, columns in fits.items():
+            for name, values in columns.result().items():
+                job[key][name] = values
+        return job
+
+    def statistics(job):
+        job["summary"] = ClusterSummary(job["fieldpar"])
+        job["summary"].table.to_csv(job["prefix"]+"summary.csv")
+        job["row"]["clusters"] = len(job["summary"].table)
+        job["row"]["real_clusters"] = len(job["summary"].real_clusters)
+        if wd_search:
+            candidates = cluster_hdbscan_wdsearch.white_dwarf_identification(job.pop("wd_fieldpar"))
+            candidates.to_csv(job["prefix"]+"wdcandidates.csv")
+            job["row"]["wd_candidates"] = len(candidates)
+        return job
+
+    def render(job):
+        fieldpar, summary = job.pop("fieldpar"), job.pop("summary")
+        cluster_export.export_clusters(fieldpar, job["field"]["label"],\
+         os.path.join(output_dir, cluster_export.EXPORT_DIR), summary)
+        if render_figures:
+            export_figures(fieldpar, cluster_hdbscan.PLOT_MEMBERSHIP_PROB, job["prefix"], workers=1)
+        job["row"]["seconds"] = round(time.time() - job["started"], 2)
+        return job
+
+    def release(function):
+        # A failed job drops its data, so that it holds no memory while it waits for
+        # the end of the run.
+        def run(job):
+            try:
+                return function(job)
+            except Exception:
+                for key in [key for key in job if key not in JOB_KEYS]:
+                    del job[key]
+                raise
+        return run
+
+    stages = [("ingest", ingest, workers["ingest"]), ("scale", scale, workers["scale"]),\
+     ("hdbscan", fit, workers["hdbscan"]), ("statistics", statistics, workers["statistics"]),\
+     ("render", render, workers["render"])]
+    return [(name, release(function), count) for name, function, count in stages], pool
+
+
+def run_pipeline(fields, output_dir="batch_output", queue_size=None, stage_workers=None,\
+ wd_search=None, render_figures=None):
+    """ Runs every field through the pipelined stages and writes the run summary (as in
+    batch_fields.run_batch) and the stage utilization table.  Returns both. """
+    warnings.filterwarnings("ignore")
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = [{"field": field, "prefix": batch_fields.field_prefix(field, output_dir),\
+     "row": {"label": field["label"], "name": field["name"], "radius": field["radius"],\
+     "status": "ok", "stars": 0, "clusters": 0, "real_clusters": 0, "seconds": 0.0, "error": ""}}\
+     for field in fields]
+    stages, pool = field_stages(output_dir, stage_workers, wd_search, render_figures)
+    pipeline = StagePipeline(stages, queue_size)
+    try:
+        results = pipeline.run(jobs)
+    finally:
+        pool.shutdown()
+    rows = []
+    for result in results:
+        if isinstance(result, StageFailure):
+            job = result.item
+            job["row"]["status"] = "failed"
+            job["row"]["error"] = result.stage+": "+repr(result.error)
+            with open(job["prefix"]+"error.txt", "w") as outfile:
+                outfile.write(result.traceback)
+        else:
+            job = result
+        print(job["row"]["label"]+": "+job["row"]["status"]+\
+         (" "+job["row"]["error"] if job["row"]["status"] != "ok" else ""))
+        rows.append(job["row"])
+    summary = pd.DataFrame(rows)
+    summary.to_csv(os.path.join(output_dir, batch_fields.SUMMARY_NAME), index=False)
+    utilization = pipeline.utilization
+    utilization.to_csv(os.path.join(output_dir, UTILIZATION_NAME), index=False)
+    print("Stage utilization ("+str(utilization.attrs["wall_s"])+" s wall):")
+    print(utilization.to_string(index=False))
+    return summary, utilization
+
+
+def parse_stage_workers(settings):
+    """ The STAGE=N command line settings as a dictionary. """
+    workers = {}
+    for setting in settings or []:
+        name, _, count = setting.partition("=")
+        if name not in STAGE_WORKERS or not count.isdigit() or int(count) < 1:
+            raise argparse.ArgumentTypeError("expected STAGE=N with STAGE one of "+\
+             ", ".join(STAGE_WORKERS)+", got "+repr(setting))
+        workers[name] = int(count)
+    return workers
+
+
+def main():
+    """ Parses the command line and runs the pipelined batch. """
+    parser = argparse.ArgumentParser(description="Cluster every Gaia field in a manifest with"\
+     " overlapping pipeline stages.")
+    parser.add_argument("manifest", help="csv file of fields (see batch_fields.py)")
+    parser.add_argument("--output-dir", default="batch_output", help="output directory")
+    parser.add_argument("--queue-size", type=int, default=QUEUE_SIZE,\
+     help="most fields waiting between two stages")
+    parser.add_argument("--stage-workers", nargs="+", default=None, metavar="STAGE=N",\
+     help="worker threads of a stage (ingest, scale, hdbscan, statistics, or render)")
+    parser.add_argument("--no-figures", action="store_true", help="skip the figure export")
+    parser.add_argument("--no-wd-search", action="store_true", help="skip the white dwarf search")
+    args = parser.parse_args()
+    try:
+        stage_workers = parse_stage_workers(args.stage_workers)
+    except argparse.ArgumentTypeError as error:
+        parser.error(str(error))
+    summary, _ = run_pipeline(batch_fields.read_manifest(args.manifest), args.output_dir,\
+     args.queue_size, stage_workers, False if args.no_wd_search else None,\
+     False if args.no_figures else None)
+    print(summary.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
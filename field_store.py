@@ -0,0 +1,241 @@
+""" Columnar binary cache of the Gaia field csv files.  The first read of a field
+    converts the csv into one .npy file per needed column (plus the derived distance),
+    and later runs memory-map those columns instead of re-parsing the csv.  The csv is
+    always parsed in chunks of CSV_CHUNK_ROWS rows, so reading a multi-GB ADQL dump
+    never holds more than one chunk of it in memory. """
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# The csv columns kept in the store.  parallax_error is only needed for the parallax
+# error ratio cut, but it is cheap to keep and lets both clustering scripts share one
+# store for the same field.
+FIELD_COLUMNS = ["ra", "dec", "pmra", "pmdec", "parallax", "parallax_error",\
+ "phot_g_mean_mag", "bp_rp"]
+
+# The columns (and their order) of the dataframe returned to the clustering scripts.
+SETUP_COLUMNS = ["ra", "dec", "pmra", "pmdec", "parallax", "phot_g_mean_mag", "bp_rp"]
+
+# The store for "field.csv" is written to the directory "field.csv.cache".
+CACHE_SUFFIX = ".cache"
+MANIFEST_NAME = "manifest.json"
+STORE_VERSION = 1
+
+# The number of csv rows parsed at once.
+CSV_CHUNK_ROWS = 500000
+
+# This flag determines whether or not field_dataframe reads through the columnar store.
+# Enter 1 for yes, or 0 to stream the csv every time without writing a store (e.g., when
+# the csv directory is read-only).
+USE_STORE = 1
+
+# The .npy header of a float64 column; its padded length is the same for any row count,
+# so it can be written before the rows are counted and rewritten afterwards.
+NPY_HEADER = {"descr": "<f8", "fortran_order": False}
+
+
+def field_filename(cluster_name, field_radius):
+    """ The input csv filename used by gaia_search.py and the clustering scripts. """
+    return cluster_name+"gaiafield"+str(field_radius)+".csv"
+
+
+def file_hash(path, block_size=1 << 20):
+    """ SHA-1 of the file contents, read in blocks so large ADQL dumps are never held
+    in memory. """
+    sha = hashlib.sha1()
+    with open(path, "rb") as infile:
+        for block in iter(lambda: infile.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def source_signature(csv_path):
+    """ The modification time and size of the source csv, which are checked on every
+    read to decide if the store is still valid. """
+    stat = os.stat(csv_path)
+    return {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+
+def _read_manifest(store_dir):
+    """ Returns the store manifest, or None if the store is missing or unreadable. """
+    try:
+        with open(os.path.join(store_dir, MANIFEST_NAME)) as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(store_dir, manifest):
+    """ The manifest is written last (and atomically), so a partially built store is
+    never mistaken for a valid one. """
+    tmp_path = os.path.join(store_dir, MANIFEST_NAME+".tmp")
+    with open(tmp_path, "w") as outfile:
+        json.dump(manifest, outfile)
+    os.replace(tmp_path, os.path.join(store_dir, MANIFEST_NAME))
+
+
+def csv_chunks(csv_path, chunk_rows=None):
+    """ Iterates over the csv in chunks of chunk_rows (default CSV_CHUNK_ROWS) rows,
+    parsing only FIELD_COLUMNS, as float64.  The chunk indexes continue from one chunk
+    to the next, so they are the csv row numbers. """
+    if chunk_rows is None:
+        chunk_rows = CSV_CHUNK_ROWS
+    return pd.read_csv(csv_path, delimiter=",", usecols=FIELD_COLUMNS,\
+     dtype={name: np.float64 for name in FIELD_COLUMNS}, chunksize=chunk_rows)
+
+
+def chunk_distance(parallax):
+    """ The same 0.03 mas zeropoint corrected parallax inversion as the clustering
+    scripts. """
+    return 1/((parallax+0.03)*0.001)
+
+
+def _write_npy_header(outfile, rows):
+    """ Writes (or rewrites) the .npy header of a float64 column of rows values. """
+    outfile.seek(0)
+    np.lib.format.write_array_header_1_0(outfile, dict(NPY_HEADER, shape=(rows,)))
+    return outfile.tell()
+
+
+def build_store(csv_path, store_dir, chunk_rows=None):
+    """ Parses the csv chunk by chunk, keeping only FIELD_COLUMNS as float64, and appends
+    each column plus the derived distance (pc) to its own .npy file.  The csv is
+    checked first, so a missing field leaves no empty store directory behind. """
+    signature = source_signature(csv_path)
+    os.makedirs(store_dir, exist_ok=True)
+    manifest_path = os.path.join(store_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    names = FIELD_COLUMNS+["distance"]
+    outfiles = {name: open(os.path.join(store_dir, name+".npy"), "wb") for name in names}
+    rows = 0
+    try:
+        header_length = {name: _write_npy_header(outfile, 0) for name, outfile in outfiles.items()}
+        for chunk in csv_chunks(csv_path, chunk_rows):
+            columns = {name: chunk[name].to_numpy(dtype=np.float64) for name in FIELD_COLUMNS}
+            columns["distance"] = chunk_distance(columns["parallax"])
+            for name in names:
+                outfiles[name].write(columns[name].astype("<f8", copy=False).tobytes())
+            rows += len(chunk)
+        for name, outfile in outfiles.items():
+            if _write_npy_header(outfile, rows) != header_length[name]:
+                raise ValueError("The .npy header length changed for "+str(rows)+" rows")
+    finally:
+        for outfile in outfiles.values():
+            outfile.close()
+    manifest = dict(signature, sha1=file_hash(csv_path), version=STORE_VERSION,\
+     rows=rows, columns=names)
+    _write_manifest(store_dir, manifest)
+    return manifest
+
+
+def store_is_valid(csv_path, store_dir, verify_hash=False):
+    """ The store is valid if it was built by this version from a source csv with the
+    same modification time and size.  If the modification time changed but the size
+    did not (e.g., the file was copied or touched), the content hash decides, and the
+    manifest is refreshed when the contents are unchanged.  verify_hash forces the
+    hash comparison even when the modification time matches. """
+    manifest = _read_manifest(store_dir)
+    if manifest is None or manifest.get("version") != STORE_VERSION:
+        return False
+    signature = source_signature(csv_path)
+    if signature["size"] != manifest["size"]:
+        return False
+    if signature["mtime_ns"] == manifest["mtime_ns"] and not verify_hash:
+        return True
+    if file_hash(csv_path) != manifest["sha1"]:
+        return False
+    if signature["mtime_ns"] != manifest["mtime_ns"]:
+        manifest.update(signature)
+        _write_manifest(store_dir, manifest)
+    return True
+
+
+def load_field_columns(csv_path, store_dir=None, verify_hash=False):
+    """ Returns a dictionary of read-only memory-mapped column arrays for the csv,
+    (re)building the store first if it is missing or stale. """
+    if store_dir is None:
+        store_dir = csv_path+CACHE_SUFFIX
+    if not store_is_valid(csv_path, store_dir, verify_hash):
+        build_store(csv_path, store_dir)
+    return {name: np.load(os.path.join(store_dir, name+".npy"), mmap_mode="r")\
+     for name in FIELD_COLUMNS+["distance"]}
+
+
+def source_hash(csv_path, store_dir=None):
+    """ The SHA-1 of the csv contents, taken from the store manifest (building the store
+    if it is missing or stale) so that the csv is not re-read.  With USE_STORE off, the
+    csv is hashed directly and no store is written. """
+    if USE_STORE != 1:
+        return file_hash(csv_path)
+    if store_dir is None:
+        store_dir = csv_path+CACHE_SUFFIX
+    if not store_is_valid(csv_path, store_dir):
+        build_store(csv_path, store_dir)
+    return _read_manifest(store_dir)["sha1"]
+
+
+def stream_field_dataframe(csv_path, parallax_ratio_cut=None, chunk_rows=None, extra_columns=()):
+    """ Reads the gaia_dr2_read_setup dataframe straight from the csv without a store.
+    The column selection, parallax error ratio cut, missing value drop, and distance are
+    applied to each chunk as it is parsed, and only the surviving rows are copied into
+    growing column buffers, so the peak memory is set by the output (plus one chunk)
+    rather than by the csv.  The output is identical to field_dataframe. """
+    kept_columns = SETUP_COLUMNS+list(extra_columns)
+    names = kept_columns+["distance"]
+    buffers = {name: np.empty(0) for name in names}
+    rows = np.empty(0, dtype=np.int64)
+    size = 0
+    for chunk in csv_chunks(csv_path, chunk_rows):
+        keep = np.ones(len(chunk), dtype=bool)
+        for name in SETUP_COLUMNS:
+            keep &= chunk[name].notna().to_numpy()
+        if parallax_ratio_cut is not None:
+            with np.errstate(divide="ignore", invalid="ignore"):
+                keep &= (chunk["parallax"]/chunk["parallax_error"]).to_numpy() > parallax_ratio_cut
+        kept = int(np.count_nonzero(keep))
+        if size + kept > len(rows):
+            # The buffers grow by a quarter (one at a time) so the slack stays small.
+            capacity = max(size + kept, len(rows) + len(rows)//4)
+            for name in names:
+                grown = np.empty(capacity)
+                grown[:size] = buffers[name][:size]
+                buffers[name] = grown
+            grown = np.empty(capacity, dtype=np.int64)
+            grown[:size] = rows[:size]
+            rows = grown
+        stop = size + kept
+        for name in kept_columns:
+            np.compress(keep, chunk[name].to_numpy(), out=buffers[name][size:stop])
+        buffers["distance"][size:stop] = chunk_distance(buffers["parallax"][size:stop])
+        np.compress(keep, chunk.index.to_numpy(), out=rows[size:stop])
+        size = stop
+    # The buffers are trimmed to the output one at a time.
+    columns = {}
+    for name in names:
+        columns[name] = buffers.pop(name)[:size].copy()
+    return pd.DataFrame(columns, index=pd.Index(rows[:size].copy()), copy=False)
+
+
+def field_dataframe(csv_path, parallax_ratio_cut=None, store_dir=None, verify_hash=False,\
+ extra_columns=()):
+    """ The cached equivalent of reading the csv in gaia_dr2_read_setup: stars below
+    the optional parallax/parallax_error ratio cut or missing any SETUP_COLUMNS are
+    dropped, and the distance column is added.  The index matches the csv row numbers
+    so the output is identical to the pandas path.  Any extra_columns (other
+    FIELD_COLUMNS, e.g. parallax_error) are kept before the distance column.  With
+    USE_STORE off, the csv is streamed by stream_field_dataframe instead. """
+    if USE_STORE != 1:
+        return stream_field_dataframe(csv_path, parallax_ratio_cut, extra_columns=extra_columns)
+    columns = load_field_columns(csv_path, store_dir, verify_hash)
+    keep = np.ones(len(columns["ra"]), dtype=bool)
+    for name in SETUP_COLUMNS:
+        keep &= ~np.isnan(columns[name])
+    if parallax_ratio_cut is not None:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            keep &= columns["parallax"]/columns["parallax_error"] > parallax_ratio_cut
+    rows = np.flatnonzero(keep)
+    return pd.DataFrame({name: columns[name][rows] for name in\
+     SETUP_COLUMNS+list(extra_columns)+["distance"]}, index=pd.Index(rows))
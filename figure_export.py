@@ -0,0 +1,120 @@
+""" Headless export of the cluster_plot figures.  Each real cluster's four panel figure
+    (and 3D figure when membership_plot == 2) is rendered with the non-interactive Agg
+    backend and saved to a png or pdf file, with the clusters spread across worker
+    processes.  The labelled data are copied once into shared memory that every worker
+    attaches to, rather than being pickled for every figure, and the render time of
+    each figure is reported. """
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+
+# The output figure format ("png" or "pdf") and resolution, and the number of worker
+# processes (None for one per core, up to the number of clusters).
+EXPORT_FORMAT = "png"
+EXPORT_DPI = 100
+EXPORT_WORKERS = None
+
+# The cluster_plot columns placed in shared memory.
+SHARED_COLUMNS = ["ra", "dec", "pmra", "pmdec", "distance", "ratransform", "rawrapped",\
+ "phot_g_mean_mag", "bp_rp", "M_G", "clusternum", "clusterprob"]
+
+# The worker process state, set once by _attach_worker.
+_WORKER = {}
+
+
+def share_columns(clustered_data):
+    """ Copies the SHARED_COLUMNS into a new shared memory block, one contiguous
+    float64 row per column, and returns the block. """
+    block = shared_memory.SharedMemory(create=True, size=max(1, len(SHARED_COLUMNS)*\
+     len(clustered_data)*8))
+    shared = np.ndarray((len(SHARED_COLUMNS), len(clustered_data)), dtype=np.float64,\
+     buffer=block.buf)
+    for row, column in enumerate(SHARED_COLUMNS):
+        shared[row] = clustered_data[column].to_numpy(dtype=np.float64)
+    return block
+
+
+def _attach_worker(block_name, star_count, membership_plot):
+    """ Worker initializer: selects the Agg backend, attaches to the shared columns, and
+    builds the plot_setup that all of this worker's figures are drawn from. """
+    import matplotlib
+    matplotlib.use("Agg", force=True)
+    from cluster_plot import plot_setup
+
+    # The workers share the parent's resource tracker, which the parent's unlink clears.
+    block = shared_memory.SharedMemory(name=block_name)
+    shared = np.ndarray((len(SHARED_COLUMNS), star_count), dtype=np.float64, buffer=block.buf)
+    clustered_data = pd.DataFrame({column: shared[row] for row, column in\
+     enumerate(SHARED_COLUMNS)}, copy=False)
+    clustered_data["clusternum"] = clustered_data["clusternum"].astype(np.int64)
+    _WORKER["block"] = block
+    _WORKER["setup"] = plot_setup(clustered_data, membership_plot)
+
+
+def _render_cluster(step, output_prefix, fmt, dpi):
+    """ Draws and saves one cluster's figures, returning a (cluster, figure file,
+    seconds) row for each. """
+    import matplotlib.pyplot as plt
+    from cluster_plot import plot_cluster
+
+    start = time.perf_counter()
+    figures = plot_cluster(_WORKER["setup"], step)
+    rows = []
+    for figure, suffix in zip(figures, ["", "_3d"]):
+        filename = output_prefix+"cluster"+str(step)+suffix+"."+fmt
+        figure.savefig(filename, format=fmt, dpi=dpi)
+        plt.close(figure)
+        rows.append((step, filename, time.perf_counter() - start))
+        start = time.perf_counter()
+    return rows
+
+
+def export_figures(clustered_data, membership_plot, output_prefix, fmt=EXPORT_FORMAT,\
+ dpi=EXPORT_DPI, workers=EXPORT_WORKERS):
+    """ Renders every real cluster's figures (see cluster_plot) to files named
+    "<output_prefix>cluster<number>.<fmt>" and "<output_prefix>cluster<number>_3d.<fmt>"
+    across worker processes.  Returns a dataframe of each figure's render time (s), which
+    includes drawing and saving the figure. """
+    from cluster_summary import ClusterSummary
+
+    real_clusters = ClusterSummary(clustered_data).real_clusters
+    if not real_clusters:
+        return pd.DataFrame(columns=["clusternum", "filename", "seconds"])
+    if workers is None:
+        workers = min(len(real_clusters), os.cpu_count() or 1)
+    block = share_columns(clustered_data)
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach_worker,\
+         initargs=(block.name, len(clustered_data), membership_plot)) as executor:
+            results = executor.map(_render_cluster, real_clusters,\
+             [output_prefix]*len(real_clusters), [fmt]*len(real_clusters),\
+             [dpi]*len(real_clusters))
+            timings = pd.DataFrame([row for rows in results for row in rows],\
+             columns=["clusternum", "filename", "seconds"])
+    finally:
+        block.close()
+        block.unlink()
+    for clusternum, filename, seconds in timings.itertuples(index=False):
+        print("Cluster "+str(clusternum)+": "+filename+" rendered in "+str(round(seconds, 2))+" s")
+    print(str(len(timings))+" figures in "+str(round(time.perf_counter() - start, 2))+" s")
+    return timings
+
+
+def main():
+    """ Clusters the cluster_hdbscan.py field (re-using a cached result) and exports its
+    figures rather than displaying them. """
+    import cluster_hdbscan
+
+    fieldpar = cluster_hdbscan.gaia_dr2_read_setup()
+    features = cluster_hdbscan.scaled_features(fieldpar)
+    fieldpar = cluster_hdbscan.clustering_algorithm(features, fieldpar,\
+     source=cluster_hdbscan.feature_source(), write_extract=False)
+    export_figures(fieldpar, cluster_hdbscan.PLOT_MEMBERSHIP_PROB, cluster_hdbscan.CLUSTER_NAME)
+
+
+if __name__ == "__main__":
+    main()
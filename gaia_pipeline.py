@@ -0,0 +1,209 @@
+""" The pipeline stages as one importable module.  Every stage takes its settings as
+    explicit arguments (defaulting to the cluster_hdbscan.py values) instead of the
+    module constants the scripts are configured with, and importing this module (or
+    any pipeline module) neither runs anything nor imports the heavy dependencies:
+    hdbscan, matplotlib, seaborn, astroquery, and pyvo are only imported by the stage
+    that uses them.  Worker processes can therefore import the pipeline and call the
+    stages they need.
+
+    Usage: python gaia_pipeline.py search OBJECT_NAME FIELD_RADIUS [--name CLUSTER_NAME]
+           python gaia_pipeline.py cluster CLUSTER_NAME FIELD_RADIUS [--distance-scale S]
+            [--pm-scale S] [--min-samples N] [--no-parallax-cut] [--white-dwarfs] [--export]
+            [--cross-match] [--plot N]
+           python gaia_pipeline.py importtime
+
+    importtime reports the time to import each pipeline module in a fresh interpreter
+    and any heavy dependency the import pulled in. """
+import argparse
+import os
+import subprocess
+import sys
+import cluster_hdbscan
+from cluster_summary import ClusterSummary
+from field_store import field_filename
+import pipeline_profile
+
+# The pipeline modules timed by importtime, and the dependencies none of them should
+# import until they are used.
+PIPELINE_MODULES = ["gaia_pipeline", "gaia_search", "query_cache", "cluster_hdbscan",\
+ "cluster_hdbscan_wdsearch", "cluster_plot", "cluster_summary", "batch_fields",\
+ "membership_model", "membership_stability", "tiled_clustering", "cluster_export",\
+ "cross_match", "distance_engine", "hdbscan_backend", "field_pipeline", "scale_optimizer",\
+ "hdbscan_sweep"]
+HEAVY_MODULES = ["hdbscan", "matplotlib", "seaborn", "astroquery", "pyvo", "astropy", "sklearn"]
+
+
+def read_field(cluster_name, field_radius, parallax_ratio_cut=cluster_hdbscan.PARALLAX_RATIO_CUT):
+    """ The gaia_dr2_read_setup dataframe of "<cluster_name>gaiafield<field_radius>.csv"
+    (a parallax_ratio_cut of None keeps every star). """
+    return cluster_hdbscan.gaia_dr2_read_setup(cluster_name, field_radius, parallax_ratio_cut)
+
+
+def scale_features(fieldpar, distance_scale=cluster_hdbscan.DISTANCE_SCALE,\
+ pm_scale=cluster_hdbscan.PM_SCALE, dtype=cluster_hdbscan.FEATURE_DTYPE):
+    """ The scaled HDBSCAN input array of a field (see scaled_features in
+    cluster_hdbscan.py). """
+    return cluster_hdbscan.scaled_features(fieldpar, distance_scale, pm_scale, dtype)
+
+
+def cluster_field(features, fieldpar, min_samples=cluster_hdbscan.MIN_SAMPLE, core_dist_n_jobs=None,\
+ algorithm=None, source=None, prefilter=False, extract_num=cluster_hdbscan.CLUSTER_EXTRACT_NUM,\
+ output_prefix=None):
+    """ Clusters the scaled features and adds the clusternum, clusterprob, and M_G columns
+    to fieldpar.  The algorithm, leaf size, and threads (up to core_dist_n_jobs) are
+    chosen by hdbscan_backend.py unless algorithm is given.  A source description (see
+    feature_source in cluster_hdbscan.py) lets the result cache skip the fit, and the
+    extract_num cluster is written to "<output_prefix>clustering.csv" when output_prefix
+    is given. """
+    return cluster_hdbscan.clustering_algorithm(features, fieldpar, min_samples,\
+     output_prefix or "", core_dist_n_jobs, algorithm, source, prefilter, extract_num,\
+     write_extract=output_prefix is not None)
+
+
+def summarize(fieldpar, pm_iqr_cut=3, dist_iqr_cut=300, faint_cut=0.8):
+    """ The ClusterSummary of a clustered field, with the cluster_plot real cluster cuts
+    by default. """
+    return ClusterSummary(fieldpar, pm_iqr_cut, dist_iqr_cut, faint_cut)
+
+
+def find_white_dwarfs(fieldpar):
+    """ The white dwarf candidates of a clustered field (see cluster_hdbscan_wdsearch.py). """
+    from cluster_hdbscan_wdsearch import white_dwarf_identification
+
+    return white_dwarf_identification(fieldpar)
+
+
+def export_clusters(fieldpar, cluster_name, summary=None, export_dir=None):
+    """ Writes every cluster of a clustered field and its summary table to the
+    partitioned export directory (see cluster_export.py). """
+    import cluster_export
+
+    return cluster_export.export_clusters(fieldpar, cluster_name, export_dir, summary)
+
+
+def match_clusters(summary, cluster_name, reference=None, runs=None):
+    """ The real clusters of a ClusterSummary labelled with their nearest counterparts in
+    the reference catalogue and earlier runs (see cross_match.py). """
+    import cross_match
+
+    return cross_match.cross_match(summary.table, cluster_name, reference, runs)
+
+
+def plot_clusters(fieldpar, membership_plot=1):
+    """ Shows the cluster figures of a clustered field (see cluster_plot.py). """
+    from cluster_plot import cluster_plot
+
+    return cluster_plot(fieldpar, membership_plot)
+
+
+def resolve(object_name, use_cache=True):
+    """ The RA and DEC (degrees) of an object from SIMBAD, through the query cache unless
+    use_cache is False. """
+    import query_cache
+
+    if use_cache:
+        return query_cache.resolve_object(object_name)
+    return query_cache.simbad_coordinates(object_name)
+
+
+def search_field(ra_obj, dec_obj, field_radius, filename, tap_url=None, use_cache=True):
+    """ Writes the Gaia stars within field_radius (degrees) of a position to filename,
+    through the query cache unless use_cache is False. """
+    import gaia_search
+    import query_cache
+
+    if tap_url is None:
+        tap_url = gaia_search.TAP_URL
+    if use_cache:
+        query_cache.cached_cone(ra_obj, dec_obj, field_radius, filename, tap_url)
+    else:
+        gaia_search.gaia_call(ra_obj, dec_obj, field_radius, filename, tap_url)
+
+
+def cluster_pipeline(cluster_name, field_radius, parallax_ratio_cut=cluster_hdbscan.PARALLAX_RATIO_CUT,\
+ distance_scale=cluster_hdbscan.DISTANCE_SCALE, pm_scale=cluster_hdbscan.PM_SCALE,\
+ min_samples=cluster_hdbscan.MIN_SAMPLE, core_dist_n_jobs=None, output_prefix=None):
+    """ Reads, scales, and clusters a field (re-using a cached result when possible), and
+    returns the clustered field and its ClusterSummary. """
+    fieldpar = read_field(cluster_name, field_radius, parallax_ratio_cut)
+    features = scale_features(fieldpar, distance_scale, pm_scale)
+    source = cluster_hdbscan.feature_source(cluster_name, field_radius, distance_scale, pm_scale,\
+     parallax_ratio_cut=parallax_ratio_cut)
+    fieldpar = cluster_field(features, fieldpar, min_samples, core_dist_n_jobs, source=source,\
+     output_prefix=output_prefix)
+    return fieldpar, summarize(fieldpar)
+
+
+def import_times(modules=None, repeats=5):
+    """ The median time (s) to import each module in a fresh interpreter, and the heavy
+    modules each import loaded, as a list of (module, seconds, heavy modules). """
+    if modules is None:
+        modules = PIPELINE_MODULES
+    script = "import sys, time\nstart = time.perf_counter()\nimport {}\n"\
+     "print(time.perf_counter() - start)\nprint(' '.join(name for name in "+repr(HEAVY_MODULES)+\
+     " if name in sys.modules))"
+    rows = []
+    for module in modules:
+        seconds = []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, "-c", script.format(module)], check=True,\
+             capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            lines = output.stdout.split("\n")
+            seconds.append(float(lines[0]))
+        rows.append((module, sorted(seconds)[len(seconds)//2], lines[1]))
+    return rows
+
+
+def main():
+    """ Parses the command line and runs the requested stage. """
+    parser = argparse.ArgumentParser(description="Run the Gaia cluster pipeline stages.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    search_parser = commands.add_parser("search", help="download the Gaia field of an object")
+    search_parser.add_argument("object", help="SIMBAD name of the object (e.g., Collinder173)")
+    search_parser.add_argument("radius", help="search radius (degrees)")
+    search_parser.add_argument("--name", default=None, help="CLUSTER_NAME of the output csv"\
+     " (default: the object name)")
+    cluster_parser = commands.add_parser("cluster", help="cluster a downloaded field")
+    cluster_parser.add_argument("name", help="CLUSTER_NAME of the input \"<name>gaiafield<radius>.csv\"")
+    cluster_parser.add_argument("radius", help="FIELD_RADIUS of the input csv")
+    cluster_parser.add_argument("--distance-scale", type=float, default=cluster_hdbscan.DISTANCE_SCALE)
+    cluster_parser.add_argument("--pm-scale", type=float, default=cluster_hdbscan.PM_SCALE)
+    cluster_parser.add_argument("--min-samples", type=int, default=cluster_hdbscan.MIN_SAMPLE)
+    cluster_parser.add_argument("--no-parallax-cut", action="store_true",\
+     help="keep every parallax error ratio (as the white dwarf search does)")
+    cluster_parser.add_argument("--white-dwarfs", action="store_true",\
+     help="also write the white dwarf candidates")
+    cluster_parser.add_argument("--export", action="store_true",\
+     help="also export every cluster and the summary table (see cluster_export.py)")
+    cluster_parser.add_argument("--cross-match", action="store_true",\
+     help="print the known counterparts of the real clusters (see cross_match.py)")
+    cluster_parser.add_argument("--plot", type=int, default=None,\
+     help="show the cluster figures with this PLOT_MEMBERSHIP_PROB setting")
+    commands.add_parser("importtime", help="time the import of every pipeline module")
+    args = parser.parse_args()
+
+    if args.command == "search":
+        name = args.name or args.object
+        ra_obj, dec_obj = resolve(args.object)
+        search_field(ra_obj, dec_obj, float(args.radius), field_filename(name, args.radius))
+    elif args.command == "cluster":
+        with pipeline_profile.run(args.name):
+            fieldpar, summary = cluster_pipeline(args.name, args.radius,\
+             None if args.no_parallax_cut else cluster_hdbscan.PARALLAX_RATIO_CUT,\
+             args.distance_scale, args.pm_scale, args.min_samples, output_prefix=args.name)
+            print(summary.table.loc[summary.table["real_cluster"]].to_string())
+            if args.white_dwarfs:
+                find_white_dwarfs(fieldpar).to_csv(args.name+"wdcandidates.csv")
+            if args.export:
+                export_clusters(fieldpar, args.name, summary)
+            if args.cross_match:
+                print(match_clusters(summary, args.name).to_string(index=False))
+            if args.plot is not None:
+                plot_clusters(fieldpar, args.plot)
+    else:
+        for module, seconds, heavy in import_times():
+            print(module.ljust(28)+str(round(seconds, 3)).rjust(7)+" s  "+(heavy or "-"))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,15 @@
 """ Script for calling Gaia DR2 API and outputs searched parameters results surrounding
  either an input cluster name or a set RA and DEC position."""
 import warnings
+import math
+import os
 import os.path
-import pyvo as vo
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from lazy_import import lazy_module
 
-# These modules output a multiple Warnings that are currently unavoidable yet do
-# not affect the output.  Hence, I have filtered them out.
-warnings.filterwarnings("ignore", module='astropy.io.votable.tree')
-warnings.filterwarnings("ignore", module='astropy.io.votable.converters')
-warnings.filterwarnings("ignore", module='astropy.extern.six')
+# pyvo (and astropy) are only imported when a query is made.
+vo = lazy_module("pyvo")
 
 # The result outputs a circular search of radius (degrees).  Note: Radii larger
 # than 1.5 degrees typically will time out and the DR2 website must be used
@@ -16,6 +17,25 @@ warnings.filterwarnings("ignore", module='astropy.extern.six')
 # hdbscan analysis.
 FIELD_RADIUS = 0.15
 
+# Large searches can instead be split into RA and DEC tiles of roughly TILE_SIZE
+# (degrees) on a side that are clipped to the search circle and queried concurrently
+# by TILE_WORKERS threads.  Each failed tile query is retried up to TILE_RETRIES
+# times, waiting TILE_BACKOFF seconds (doubled each retry) between attempts.  Enter 1
+# for TILED_DOWNLOAD to use tiles, or 0 for the original single query.
+TILED_DOWNLOAD = 1
+TILE_SIZE = 0.5
+TILE_WORKERS = 4
+TILE_RETRIES = 3
+TILE_BACKOFF = 2
+
+# The Gaia DR2 TAP service.  tap_standin.py can serve synthetic rows locally in its place.
+TAP_URL = 'https://gaia.aip.de/tap'
+
+# This flag determines whether or not searches go through the query_cache.py cache of
+# SIMBAD coordinates and downloaded sky tiles.  Enter 1 for yes, or 0 to always query
+# SIMBAD and the TAP service directly.
+USE_QUERY_CACHE = 1
+
 # The cluster name that will be searched for in SIMBAD to find its central coordinates.
 CLUSTER_NAME_SEARCH = "Collinder173"
 CLUSTER_NAME = "c173"
@@ -29,6 +49,15 @@ PARALLAX_ERROR_RATIO = 3
 FILENAME = CLUSTER_NAME+"gaiafield"+str(FIELD_RADIUS)+".csv"
 
 
+def quiet_votable_warnings():
+    """ These modules output a multiple Warnings that are currently unavoidable yet do
+    not affect the output.  Hence, I have filtered them out (when a query is made,
+    rather than on import). """
+    warnings.filterwarnings("ignore", module='astropy.io.votable.tree')
+    warnings.filterwarnings("ignore", module='astropy.io.votable.converters')
+    warnings.filterwarnings("ignore", module='astropy.extern.six')
+
+
 def coordconv(ra_input, dec_input):
     """ Takes input RA and DEC from H:M:S (or H:M) and returns in decimal degrees. """
     ra_output = 0
@@ -49,27 +78,160 @@ def coordconv(ra_input, dec_input):
     return ra_output, dec_output
 
 
-def gaia_call(ra_obj, dec_obj):
+def gaia_query(ra_obj, dec_obj, radius, tile=None):
+    """ The ADQL query for the columns of interest for a circular search of defined
+    radius and parallax cuts.  If an RA and DEC tile (ramin, ramax, decmin, decmax) is
+    given, only the part of the circle within it is selected.  Tiles include their
+    lower bounds and exclude their upper bounds, so neighbouring tiles never overlap. """
+    query = "SELECT gaia_source.source_id, gaia_source.ra,\
+    gaia_source.dec,gaia_source.parallax,gaia_source.parallax_error,gaia_source.pmra,\
+    gaia_source.pmra_error,gaia_source.pmdec,gaia_source.pmdec_error,gaia_source.\
+    phot_g_mean_mag,gaia_source.bp_rp FROM gdr2.gaia_source WHERE 1=CONTAINS(POINT('ICRS',\
+    ra, dec),CIRCLE('ICRS',"+str(ra_obj)+","+str(dec_obj)+","+str(radius)+")) AND\
+    gaia_source.parallax>="+str(PARALLAX_CUT)+" AND\
+    gaia_source.parallax_over_error>="+str(PARALLAX_ERROR_RATIO)
+    if tile is not None:
+        query += " AND gaia_source.ra>="+repr(tile[0])+" AND gaia_source.ra<"+repr(tile[1])+\
+         " AND gaia_source.dec>="+repr(tile[2])+" AND gaia_source.dec<"+repr(tile[3])
+    return query
+
+
+def angular_separation(ra1, dec1, ra2, dec2):
+    """ Angular separation (degrees) between two positions in decimal degrees. """
+    ra1, dec1, ra2, dec2 = map(math.radians, (ra1, dec1, ra2, dec2))
+    hav = math.sin((dec2-dec1)/2)**2 + math.cos(dec1)*math.cos(dec2)*math.sin((ra2-ra1)/2)**2
+    return math.degrees(2*math.asin(min(1, math.sqrt(hav))))
+
+
+def sky_tiles(ra_obj, dec_obj, radius, tile_size=TILE_SIZE):
+    """ Splits the search circle into RA and DEC boxes of roughly tile_size degrees on
+    the sky.  The circle is first cut into DEC bands, and each band is cut into RA
+    boxes spanning the full RA width of the circle.  Boxes that cross RA=0,360 are
+    split in two, and boxes that lie clearly outside the circle are dropped.  If the
+    circle contains a pole, the bands cover all RA. """
+    decmin = max(dec_obj - radius, -90.0)
+    decmax = min(dec_obj + radius, 90.0)
+    if dec_obj + radius >= 90 or dec_obj - radius <= -90:
+        ra_halfwidth = 180.0
+    else:
+        ra_halfwidth = math.degrees(math.asin(min(1, math.sin(math.radians(radius))/\
+         math.cos(math.radians(dec_obj)))))
+    dec_count = max(1, math.ceil((decmax - decmin)/tile_size))
+    tiles = []
+    for band in range(dec_count):
+        declow = decmin + (decmax - decmin)*band/dec_count
+        dechigh = decmin + (decmax - decmin)*(band + 1)/dec_count
+        # The last band includes the top of the circle (or the pole).
+        if band == dec_count - 1:
+            dechigh = math.nextafter(dechigh, math.inf)
+        widest = max(math.cos(math.radians(declow)), math.cos(math.radians(dechigh)))
+        if declow < 0 < dechigh:
+            widest = 1.0
+        if ra_halfwidth >= 180:
+            ra_start, ra_width = 0.0, 360.0
+        else:
+            ra_start, ra_width = ra_obj - ra_halfwidth, 2*ra_halfwidth
+        ra_count = max(1, math.ceil(ra_width*widest/tile_size))
+        for step in range(ra_count):
+            ralow = ra_start + ra_width*step/ra_count
+            rahigh = ra_start + ra_width*(step + 1)/ra_count
+            if step == ra_count - 1:
+                rahigh = 360.0 if ra_width >= 360 else math.nextafter(rahigh, math.inf)
+            shift = math.floor(ralow/360)*360
+            ralow, rahigh = ralow - shift, rahigh - shift
+            boxes = [(ralow, rahigh)] if rahigh <= 360 else [(ralow, 360.0), (0.0, rahigh - 360)]
+            for box_ralow, box_rahigh in boxes:
+                # The nearest point of the box to the circle centre is estimated by
+                # clamping, and a margin of one tile keeps this check conservative.
+                offset = (ra_obj - box_ralow) % 360
+                if offset <= box_rahigh - box_ralow:
+                    nearest_ra = ra_obj
+                elif offset - (box_rahigh - box_ralow) < 360 - offset:
+                    nearest_ra = box_rahigh
+                else:
+                    nearest_ra = box_ralow
+                nearest_dec = min(max(dec_obj, declow), dechigh)
+                if angular_separation(ra_obj, dec_obj, nearest_ra, nearest_dec) <= radius + tile_size:
+                    tiles.append((box_ralow, box_rahigh, declow, dechigh))
+    return tiles
+
+
+def tile_call(ra_obj, dec_obj, radius, tile, tap_url=TAP_URL, retries=TILE_RETRIES,\
+ backoff=TILE_BACKOFF):
+    """ Queries a single tile, retrying on failure, and returns its rows as a dataframe. """
+    quiet_votable_warnings()
+    for attempt in range(retries + 1):
+        try:
+            tap_service = vo.dal.TAPService(tap_url)
+            tap_result = tap_service.search(gaia_query(ra_obj, dec_obj, radius, tile))
+            return tap_result.to_table().to_pandas()
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff*2**attempt)
+
+
+def gaia_call_tiled(ra_obj, dec_obj, radius=FIELD_RADIUS, filename=FILENAME, tap_url=TAP_URL,\
+ tile_size=TILE_SIZE, workers=TILE_WORKERS, retries=TILE_RETRIES, backoff=TILE_BACKOFF):
+    """ Searches the Gaia DR2 database tile by tile with a bounded pool of worker
+    threads.  Each tile's rows are appended to the output csv as soon as they arrive,
+    skipping any source_id already written.  The csv is written to a temporary file
+    that only replaces filename once every tile has succeeded, so an incomplete
+    search is never mistaken for a finished one.  Returns the number of rows written. """
+    tiles = sky_tiles(ra_obj, dec_obj, radius, tile_size)
+    partial_name = filename+".partial"
+    seen_ids = set()
+    row_count = 0
+    failed_tiles = []
+    start = time.time()
+    with open(partial_name, "w", newline="") as outfile, \
+     ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(tile_call, ra_obj, dec_obj, radius, tile, tap_url, retries,\
+         backoff): tile for tile in tiles}
+        for future in as_completed(futures):
+            try:
+                tile_rows = future.result()
+            except Exception as error:
+                failed_tiles.append((futures[future], error))
+                continue
+            tile_rows = tile_rows.drop_duplicates("source_id")
+            tile_rows = tile_rows[~tile_rows["source_id"].isin(seen_ids)]
+            seen_ids.update(tile_rows["source_id"].tolist())
+            # The running index reproduces the index column of the single query csv.
+            tile_rows.index = range(row_count, row_count+len(tile_rows))
+            tile_rows.to_csv(outfile, header=(outfile.tell() == 0))
+            row_count += len(tile_rows)
+    if failed_tiles:
+        raise RuntimeError(str(len(failed_tiles))+" of "+str(len(tiles))+" tiles failed after "+\
+         str(retries)+" retries (partial output kept in "+partial_name+"): "+\
+         "; ".join(str(tile)+": "+repr(error) for tile, error in failed_tiles))
+    os.replace(partial_name, filename)
+    elapsed = time.time() - start
+    print(str(row_count)+" stars from "+str(len(tiles))+" tiles in "+str(round(elapsed, 1))+\
+     " s ("+str(int(row_count/max(elapsed, 1e-9)))+" stars/s)")
+    return row_count
+
+
+def gaia_call(ra_obj, dec_obj, radius=FIELD_RADIUS, filename=FILENAME, tap_url=TAP_URL):
     """ Initilize and search Gaia DR2 database with API based on input parameters
      and outputs csv file. """
+    quiet_votable_warnings()
+
+    if TILED_DOWNLOAD == 1:
+        gaia_call_tiled(ra_obj, dec_obj, radius, filename, tap_url)
+        return
 
 # Initialize tap service.
-    tap_service = vo.dal.TAPService('https://gaia.aip.de/tap')
+    tap_service = vo.dal.TAPService(tap_url)
 
 # optional: Use your API token to use your account.
     #vo.utils.http.session.headers['Authorization'] = 'Token input'
 
 # Search Gaia database and return to csv (FILENAME) the columns of interest for a
 # circular search of defined radius and parallax cuts around CLUSTER_NAME_SEARCH.
-    tap_result = tap_service.search("SELECT gaia_source.source_id, gaia_source.ra,\
-    gaia_source.dec,gaia_source.parallax,gaia_source.parallax_error,gaia_source.pmra,\
-    gaia_source.pmra_error,gaia_source.pmdec,gaia_source.pmdec_error,gaia_source.\
-    phot_g_mean_mag,gaia_source.bp_rp FROM gdr2.gaia_source WHERE 1=CONTAINS(POINT('ICRS',\
-    ra, dec),CIRCLE('ICRS',"+str(ra_obj)+","+str(dec_obj)+","+str(FIELD_RADIUS)+")) AND\
-    gaia_source.parallax>="+str(PARALLAX_CUT)+" AND\
-    gaia_source.parallax_over_error>="+str(PARALLAX_ERROR_RATIO))
+    tap_result = tap_service.search(gaia_query(ra_obj, dec_obj, radius))
 
-    tap_result.to_table().to_pandas().to_csv(FILENAME)
+    tap_result.to_table().to_pandas().to_csv(filename)
 
 
 def main():
@@ -79,17 +241,21 @@ def main():
 # Checks if file already exists, if not, continues search for SIMBAD coordinates
 # of CLUSTER_NAME_SEARCH and outputs it for conversion.
     if not os.path.exists(FILENAME):
-        from astroquery.simbad import Simbad
+        import query_cache
 
-        result_table = Simbad.query_object(CLUSTER_NAME_SEARCH)
-
-        ra_obj, dec_obj = coordconv(result_table["RA"][0].split(),\
-        result_table["DEC"][0].split())
+        if USE_QUERY_CACHE == 1:
+            ra_obj, dec_obj = query_cache.resolve_object(CLUSTER_NAME_SEARCH)
+        else:
+            ra_obj, dec_obj = query_cache.simbad_coordinates(CLUSTER_NAME_SEARCH)
 
 # If you want to define RA and DEC directly, uncomment them and define them here (degrees)
         #ra_obj = 116
         #dec_obj = -38
 
-        gaia_call(ra_obj, dec_obj)
+        if USE_QUERY_CACHE == 1:
+            query_cache.cached_cone(ra_obj, dec_obj, FIELD_RADIUS, FILENAME)
+        else:
+            gaia_call(ra_obj, dec_obj)
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+""" Chooses the HDBSCAN tree algorithm, leaf size, and number of core distance threads of
+    a fit from its number of rows and features and the available cores, instead of
+    fitting every field with the HDBSCAN defaults.
+
+    The choice is based on fit times measured once per machine: "python hdbscan_backend.py
+    calibrate" fits synthetic fields (see synthetic_field.py) of every CALIBRATION_SIZES
+    star count, with the 5 scaled features or the 7 with the photometry, using every
+    algorithm, leaf size, and thread count, and stores the timings in CALIBRATION_FILE
+    along with a signature of the machine (its CPU model, core count, and the HDBSCAN
+    version, so a calibration survives hostname and interpreter changes).  A
+    configuration more than PRUNE_FACTOR times slower than the best at one size is not
+    timed at the larger sizes.  The time of a fit is predicted from a power law in the
+    row count fitted to each configuration's timings at the nearest calibrated number
+    of features, and the fastest prediction is chosen, with its thread count clamped to
+    the threads allowed for the fit.  Without a calibration of this machine, the fit
+    keeps the HDBSCAN defaults (DEFAULT_BACKEND) and the requested or DEFAULT_JOBS
+    threads, exactly as with AUTO_BACKEND off, and a calibration file of another
+    machine is reported.
+
+    Each calibrated fit's configuration, predicted time, and measured time are printed
+    and appended to BACKEND_LOG.  The prims algorithms compute their core distances on
+    one thread, so only the boruvka algorithms are timed with more.
+
+    Usage: python hdbscan_backend.py calibrate [--sizes N [N ...]] [--dimensions D [D ...]]
+           python hdbscan_backend.py show ROWS [DIMENSIONS] """
+import argparse
+import csv
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+
+# The calibration timings of this machine, and the log of every fit's configuration.
+CALIBRATION_FILE = "hdbscan_calibration.json"
+BACKEND_LOG = "hdbscan_backend_log.csv"
+
+# The synthetic field star counts (before the gaia_search.py parallax cuts), feature
+# counts, algorithms, and leaf sizes timed by the calibration.
+CALIBRATION_SIZES = [4000, 16000, 64000]
+CALIBRATION_DIMENSIONS = [5, 7]
+CALIBRATION_ALGORITHMS = ["boruvka_kdtree", "boruvka_balltree", "prims_kdtree", "prims_balltree"]
+CALIBRATION_LEAF_SIZES = [20, 40, 80]
+CALIBRATION_SEED = 0
+
+# A configuration this many times slower than the best at one calibration size is not
+# timed at the larger sizes.
+PRUNE_FACTOR = 3
+
+# The configuration and core distance threads used when this machine has not been
+# calibrated: the HDBSCAN defaults of clustering_algorithm with AUTO_BACKEND off (the
+# leaf size is left to HDBSCAN).
+DEFAULT_BACKEND = {"algorithm": "best", "leaf_size": None}
+DEFAULT_JOBS = 4
+
+LOG_COLUMNS = ["time", "rows", "dimensions", "algorithm", "leaf_size", "core_dist_n_jobs",\
+ "source", "predicted_seconds", "seconds"]
+
+
+# The calibration files already reported as belonging to another machine.
+_rejected = set()
+
+
+def cpu_model():
+    """ The CPU model name (from /proc/cpuinfo where there is one). """
+    try:
+        with open("/proc/cpuinfo") as infile:
+            for line in infile:
+                if line.startswith("model name"):
+                    return line.partition(":")[2].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def machine_signature():
+    """ The machine (CPU model and cores) and HDBSCAN version a calibration is valid
+    for. """
+    from importlib.metadata import version
+
+    return {"cpu": cpu_model(), "cores": os.cpu_count() or 1, "hdbscan": version("hdbscan")}
+
+
+def thread_counts(cores):
+    """ The core distance thread counts timed on a machine with cores cores. """
+    return sorted({1, max(1, cores//2), cores})
+
+
+def calibration_features(star_count, dimensions, seed=CALIBRATION_SEED):
+    """ The scaled features of a synthetic field, with the G magnitude and BP-RP color
+    appended as columns when dimensions is 7 (as the clustering_algorithm comment
+    describes). """
+    import cluster_hdbscan
+    from synthetic_field import synthetic_field
+
+    field = synthetic_field(star_count, seed=seed)
+    field = field[["ra", "dec", "pmra", "pmdec", "parallax", "phot_g_mean_mag", "bp_rp"]].dropna()
+    field["distance"] = 1/((field["parallax"]+0.03)*0.001)
+    features = cluster_hdbscan.scaled_features(field)
+    if dimensions == 7:
+        features = np.column_stack([features, field["phot_g_mean_mag"], field["bp_rp"]])
+    return features
+
+
+def time_fit(features, algorithm, leaf_size, core_dist_n_jobs, min_samples):
+    """ The wall time (s) of one HDBSCAN fit with the clustering_algorithm settings. """
+    import hdbscan
+
+    start = time.perf_counter()
+    hdbscan.HDBSCAN(min_cluster_size=50, min_samples=min_samples, cluster_selection_method="leaf",\
+     algorithm=algorithm, leaf_size=leaf_size, core_dist_n_jobs=core_dist_n_jobs).fit(features)
+    return time.perf_counter() - start
+
+
+def calibrate(sizes=None, dimensions=None, min_samples=None):
+    """ Times every configuration on synthetic fields of every size and feature count,
+    and returns the calibration (the machine signature and the timings). """
+    import cluster_hdbscan
+
+    sizes = sorted(sizes or CALIBRATION_SIZES)
+    dimensions = dimensions or CALIBRATION_DIMENSIONS
+    if min_samples is None:
+        min_samples = cluster_hdbscan.MIN_SAMPLE
+    signature = machine_signature()
+    configurations = [(algorithm, leaf_size, jobs) for algorithm in CALIBRATION_ALGORITHMS\
+     for leaf_size in CALIBRATION_LEAF_SIZES for jobs in (thread_counts(signature["cores"])\
+     if algorithm.startswith("boruvka") else [1])]
+    # The first fit of a process carries a one-off start-up cost, so it is not timed.
+    time_fit(calibration_features(2000, 5), "boruvka_kdtree", 40, 1, min_samples)
+    timings = []
+    for dimension in dimensions:
+        remaining = configurations
+        for size in sizes:
+            features = calibration_features(size, dimension)
+            measured = {}
+            for algorithm, leaf_size, jobs in remaining:
+                seconds = time_fit(features, algorithm, leaf_size, jobs, min_samples)
+                measured[(algorithm, leaf_size, jobs)] = seconds
+                timings.append({"rows": len(features), "dimensions": dimension,\
+                 "algorithm": algorithm, "leaf_size": leaf_size, "core_dist_n_jobs": jobs,\
+                 "seconds": round(seconds, 4)})
+            best = min(measured.values())
+            remaining = [configuration for configuration in remaining\
+             if measured[configuration] <= PRUNE_FACTOR*best]
+            print(str(dimension)+" features, "+str(len(features))+" rows: "+\
+             str(len(measured))+" configurations, fastest "+str(round(best, 3))+" s")
+    return {"machine": signature, "created": time.strftime("%Y-%m-%dT%H:%M:%S"),\
+     "min_samples": min_samples, "timings": timings}
+
+
+def save_calibration(calibration, path=None):
+    """ Writes a calibration (atomically) to path (default CALIBRATION_FILE). """
+    path = path or CALIBRATION_FILE
+    with open(path+".partial", "w") as outfile:
+        json.dump(calibration, outfile, indent=1)
+    os.replace(path+".partial", path)
+
+
+def load_calibration(path=None):
+    """ The calibration in path (default CALIBRATION_FILE), or None when there is none
+    or it was measured on another machine (reported once per file). """
+    path = path or CALIBRATION_FILE
+    if not os.path.exists(path):
+        return None
+    with open(path) as infile:
+        calibration = json.load(infile)
+    signature = machine_signature()
+    if calibration.get("machine") != signature:
+        if path not in _rejected:
+            _rejected.add(path)
+            print("Warning: "+path+" was calibrated for "+json.dumps(calibration.get("machine"))+\
+             ", not this machine ("+json.dumps(signature)+"); the HDBSCAN defaults are used until"\
+             " \"python hdbscan_backend.py calibrate\" is run", file=sys.stderr)
+        return None
+    return calibration
+
+
+def predict_times(calibration, rows, dimensions):
+    """ The predicted fit time (s) of every calibrated configuration for rows rows and
+    the nearest calibrated number of features, as a dictionary keyed by (algorithm,
+    leaf_size, core_dist_n_jobs).  Each configuration's times follow a power law in
+    the row count fitted in log space (or the fastest configuration's exponent when it
+    was timed at one size only). """
+    calibrated = sorted({timing["dimensions"] for timing in calibration["timings"]})
+    dimension = min(calibrated, key=lambda calibrated_dimension: abs(calibrated_dimension - dimensions))
+    measured = {}
+    for timing in calibration["timings"]:
+        if timing["dimensions"] == dimension:
+            configuration = (timing["algorithm"], timing["leaf_size"], timing["core_dist_n_jobs"])
+            measured.setdefault(configuration, []).append((timing["rows"], timing["seconds"]))
+    laws = {}
+    for configuration, points in measured.items():
+        if len({point[0] for point in points}) > 1:
+            log_rows, log_seconds = np.log(np.array(points, dtype=np.float64)).T
+            laws[configuration] = np.polyfit(log_rows, log_seconds, 1)
+    default_slope = min(laws.values(), key=lambda law: np.polyval(law, np.log(rows)))[0]\
+     if laws else 1.0
+    predictions = {}
+    for configuration, points in measured.items():
+        if configuration in laws:
+            predictions[configuration] = float(np.exp(np.polyval(laws[configuration], np.log(rows))))
+        else:
+            size, seconds = points[-1]
+            predictions[configuration] = seconds*(rows/size)**default_slope
+    return predictions
+
+
+def select_backend(rows, dimensions, max_jobs=None, calibration=None):
+    """ The HDBSCAN configuration of a fit of rows rows and dimensions features with at
+    most max_jobs (default all cores) core distance threads: a dictionary of the
+    algorithm, leaf_size, and core_dist_n_jobs, with the predicted_seconds and the
+    source ("calibrated" or "default") of the choice.  Calibrated thread counts above
+    max_jobs are clamped to max_jobs (predicted with the timings of the smallest of
+    them), and a multi-threaded choice uses every allowed thread.  Without a
+    calibration, the DEFAULT_BACKEND is returned with max_jobs (or DEFAULT_JOBS)
+    threads. """
+    if calibration is None:
+        calibration = load_calibration()
+    if calibration is None:
+        return dict(DEFAULT_BACKEND, core_dist_n_jobs=max_jobs or DEFAULT_JOBS,\
+         predicted_seconds=None, source="default")
+    cores = os.cpu_count() or 1
+    max_jobs = min(max_jobs or cores, cores)
+    # A thread count above max_jobs is clamped rather than dropped, so that a capped fit
+    # (e.g. 2 of 8 cores) is still compared with the multi-threaded timings; of the
+    # counts clamped together, the nearest to max_jobs (set last) gives the prediction.
+    predictions = {}
+    for (algorithm, leaf_size, jobs), seconds in sorted(predict_times(calibration, rows,\
+     dimensions).items(), key=lambda item: -item[0][2]):
+        predictions[(algorithm, leaf_size, min(jobs, max_jobs))] = seconds
+    (algorithm, leaf_size, jobs), seconds = min(predictions.items(), key=lambda item: item[1])
+    return {"algorithm": algorithm, "leaf_size": leaf_size,\
+     "core_dist_n_jobs": max_jobs if jobs > 1 else 1, "predicted_seconds": round(seconds, 3),\
+     "source": "calibrated"}
+
+
+def log_fit(backend, rows, dimensions, seconds, path=None):
+    """ Prints a fit's configuration and times, and appends them to path (default
+    BACKEND_LOG). """
+    path = path or BACKEND_LOG
+    row = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "rows": rows, "dimensions": dimensions,\
+     "algorithm": backend["algorithm"], "leaf_size": backend["leaf_size"],\
+     "core_dist_n_jobs": backend["core_dist_n_jobs"], "source": backend["source"],\
+     "predicted_seconds": backend["predicted_seconds"], "seconds": round(seconds, 3)}
+    print("HDBSCAN "+row["algorithm"]+" (leaf size "+str(row["leaf_size"])+", "+\
+     str(row["core_dist_n_jobs"])+" threads, "+row["source"]+"): "+str(row["seconds"])+" s"+\
+     ("" if row["predicted_seconds"] is None else " (predicted "+str(row["predicted_seconds"])+" s)"))
+    new_log = not os.path.exists(path)
+    with open(path, "a", newline="") as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=LOG_COLUMNS)
+        if new_log:
+            writer.writeheader()
+        writer.writerow(row)
+
+
+def main():
+    """ Parses the command line, and calibrates this machine or shows the choice for a
+    fit size. """
+    parser = argparse.ArgumentParser(description="Calibrate and show the HDBSCAN backend choice.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    calibrate_parser = commands.add_parser("calibrate", help="time every configuration on this machine")
+    calibrate_parser.add_argument("--sizes", type=int, nargs="+", default=CALIBRATION_SIZES,\
+     help="synthetic field star counts")
+    calibrate_parser.add_argument("--dimensions", type=int, nargs="+", default=CALIBRATION_DIMENSIONS,\
+     choices=[5, 7], help="feature counts")
+    show_parser = commands.add_parser("show", help="show the configuration chosen for a fit")
+    show_parser.add_argument("rows", type=int, help="rows of the fit")
+    show_parser.add_argument("dimensions", type=int, nargs="?", default=5, help="features of the fit")
+    args = parser.parse_args()
+
+    if args.command == "calibrate":
+        import warnings
+
+        warnings.filterwarnings("ignore")
+        save_calibration(calibrate(args.sizes, args.dimensions))
+        print("Calibration written to "+CALIBRATION_FILE)
+    else:
+        calibration = load_calibration()
+        if calibration is not None:
+            predictions = predict_times(calibration, args.rows, args.dimensions)
+            for (algorithm, leaf_size, jobs), seconds in sorted(predictions.items(),\
+             key=lambda item: item[1]):
+                print(algorithm.ljust(18)+str(leaf_size).rjust(4)+str(jobs).rjust(4)+\
+                 str(round(seconds, 3)).rjust(10)+" s")
+        print(select_backend(args.rows, args.dimensions, calibration=calibration))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+""" Sweeps the HDBSCAN hyperparameters for the cluster_hdbscan.py field.  The core
+    distances and mutual reachability minimum spanning tree only depend on min_samples,
+    so each min_samples value is fit once and its single linkage tree is re-used to
+    extract the clusters for every min_cluster_size and cluster selection method.  The
+    min_samples values are fit in parallel processes, and the output is a table of how
+    many clusters pass the cluster_plot real cluster cuts for each setting. """
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import cluster_hdbscan
+from cluster_summary import ClusterSummary
+
+# The hyperparameter grid.  Following the clustering_algorithm docstring, min_samples
+# should be varied by at least a factor of 2 around the typical 64.
+SWEEP_MIN_SAMPLES = [32, 64, 128]
+SWEEP_MIN_CLUSTER_SIZES = [25, 50, 100]
+SWEEP_SELECTION_METHODS = ["leaf", "eom"]
+
+# The number of min_samples values fit at once.  The cores are split between them for
+# the HDBSCAN core distance calculation.
+SWEEP_WORKERS = min(len(SWEEP_MIN_SAMPLES), os.cpu_count() or 1)
+
+SUMMARY_COLUMNS = ["distance", "pmra", "pmdec", "dec", "M_G"]
+
+
+def scaled_field():
+    """ Reads and scales the cluster_hdbscan.py field exactly as its main() does, and
+    returns the HDBSCAN input array and the columns needed for the cluster cuts. """
+    fieldpar = cluster_hdbscan.gaia_dr2_read_setup()
+    features = cluster_hdbscan.scaled_features(fieldpar)
+    fieldpar["M_G"] = fieldpar["phot_g_mean_mag"] - np.log10(fieldpar["distance"]/10)*5
+    return features, fieldpar[SUMMARY_COLUMNS]
+
+
+def setting_row(summary_data, labels, min_samples, min_cluster_size, selection_method):
+    """ One output table row: the number of clusters, the number passing the real
+    cluster cuts, and those clusters' sizes and IQRs (space separated, by cluster). """
+    summary = ClusterSummary(summary_data.assign(clusternum=labels))
+    real = summary.table.loc[summary.table["real_cluster"]]
+    row = {"min_samples": min_samples, "min_cluster_size": min_cluster_size,\
+     "selection_method": selection_method, "clusters": len(summary.table),\
+     "real_clusters": len(real), "sizes": " ".join(str(count) for count in real["count"])}
+    for column in ["distcen", "distiqr", "pmraiqr", "pmdeciqr"]:
+        row[column] = " ".join(str(round(value, 2)) for value in real[column])
+    return row
+
+
+def sweep_min_samples(features, summary_data, min_samples, min_cluster_sizes=SWEEP_MIN_CLUSTER_SIZES,\
+ selection_methods=SWEEP_SELECTION_METHODS, core_dist_n_jobs=1):
+    """ Fits HDBSCAN once for min_samples and extracts the clusters from its single
+    linkage tree for every min_cluster_size and selection method. """
+    import hdbscan
+    # _tree_to_labels is the step HDBSCAN.fit itself uses to turn a single linkage tree
+    # into labels and probabilities, so re-using it reproduces a full fit exactly.
+    from hdbscan.hdbscan_ import _tree_to_labels
+
+    clustering = hdbscan.HDBSCAN(min_cluster_size=min(min_cluster_sizes), min_samples=min_samples,\
+     core_dist_n_jobs=core_dist_n_jobs).fit(features)
+    tree = clustering.single_linkage_tree_.to_numpy()
+    rows = []
+    for min_cluster_size in min_cluster_sizes:
+        for selection_method in selection_methods:
+            labels = _tree_to_labels(features, tree, min_cluster_size, selection_method)[0]
+            rows.append(setting_row(summary_data, labels, min_samples, min_cluster_size,\
+             selection_method))
+    return rows
+
+
+def hyperparameter_sweep(features, summary_data, min_samples_values=SWEEP_MIN_SAMPLES,\
+ min_cluster_sizes=SWEEP_MIN_CLUSTER_SIZES, selection_methods=SWEEP_SELECTION_METHODS,\
+ workers=SWEEP_WORKERS):
+    """ Runs sweep_min_samples for every min_samples value across a process pool and
+    returns the combined table, ordered by setting. """
+    core_dist_n_jobs = max(1, (os.cpu_count() or 1)//workers)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(sweep_min_samples, features, summary_data, min_samples,\
+         min_cluster_sizes, selection_methods, core_dist_n_jobs) for min_samples in min_samples_values]
+        rows = [row for future in futures for row in future.result()]
+    return pd.DataFrame(rows)
+
+
+def main():
+    """ Sweeps the cluster_hdbscan.py field and outputs the table to screen and to a
+    csv file. """
+    features, summary_data = scaled_field()
+    sweep = hyperparameter_sweep(features, summary_data)
+    print(sweep.to_string(index=False))
+    sweep.to_csv(cluster_hdbscan.CLUSTER_NAME+"sweep.csv", index=False)
+
+
+if __name__ == "__main__":
+    main()
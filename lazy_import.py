@@ -0,0 +1,27 @@
+""" Deferred imports of the heavy optional dependencies (hdbscan, matplotlib, seaborn,
+    scipy, pyvo).  lazy_module returns a stand-in that imports the real module on first
+    attribute access, so importing a pipeline module stays cheap for workers and tools
+    that never fit, plot, or query. """
+import importlib
+
+
+class LazyModule:
+    """ A module that is imported when one of its attributes is first used. """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
+
+    def __repr__(self):
+        state = "imported" if self._module is not None else "not yet imported"
+        return "<lazy module "+repr(self._name)+" ("+state+")>"
+
+
+def lazy_module(name):
+    """ The LazyModule of name (e.g., "matplotlib.pyplot"). """
+    return LazyModule(name)
@@ -0,0 +1,172 @@
+""" Saved clustering models for assigning cluster membership to new stars without
+    re-clustering the field.  fit_model clusters a field as cluster_hdbscan.py does, but
+    with the HDBSCAN prediction data kept, and saves the fitted model together with the
+    exact feature scaling of the field (the ra_center RA center and wrap state, and the
+    distance and PM scalings).  Stars added later (e.g., a deeper magnitude limit) are
+    then scaled identically and assigned labels and membership probabilities in batches
+    with hdbscan.approximate_predict, at a cost proportional to the number of new stars
+    rather than a full refit.  New stars without a positive zeropoint corrected parallax,
+    or (with a parallax_error column) at or below PREDICT_PARALLAX_RATIO_CUT, are not
+    predicted and are labelled -1; set it to None to also predict the stars dropped by
+    the field's parallax error ratio cut.
+
+    Usage: python membership_model.py fit CLUSTER_NAME FIELD_RADIUS
+           python membership_model.py predict CLUSTER_NAME new_stars.csv [--batch-size N]
+
+    The model is saved to "<CLUSTER_NAME>model.pkl", and the predictions for a csv in
+    the gaia_search.py format are written to "<CLUSTER_NAME>predicted.csv".  The model is
+    a pickle, so only load models you created. """
+import argparse
+import pickle
+import numpy as np
+import pandas as pd
+import cluster_hdbscan
+from field_store import SETUP_COLUMNS, field_filename
+
+# The number of new stars predicted at once.
+PREDICT_BATCH_SIZE = 100000
+
+# The parallax error ratio cut of the new stars (as in gaia_dr2_read_setup), or None to
+# predict every star with a positive parallax.
+PREDICT_PARALLAX_RATIO_CUT = cluster_hdbscan.PARALLAX_RATIO_CUT
+MODEL_VERSION = 1
+
+
+def model_filename(cluster_name):
+    """ The saved model file of a field. """
+    return cluster_name+"model.pkl"
+
+
+def fit_model(cluster_name=None, field_radius=None, distance_scale=None, pm_scale=None,\
+ min_samples=None, core_dist_n_jobs=4):
+    """ Reads and clusters a field with the cluster_hdbscan.py settings (each defaulting
+    to its cluster_hdbscan.py value), keeping the HDBSCAN prediction data.  Returns the
+    model dictionary (the fitted HDBSCAN, the scaling parameters, and the field hash)
+    and the clustered field. """
+    import hdbscan
+
+    if cluster_name is None:
+        cluster_name = cluster_hdbscan.CLUSTER_NAME
+    if field_radius is None:
+        field_radius = cluster_hdbscan.FIELD_RADIUS
+    if min_samples is None:
+        min_samples = cluster_hdbscan.MIN_SAMPLE
+    fieldpar = cluster_hdbscan.gaia_dr2_read_setup(cluster_name, field_radius)
+    scaling = cluster_hdbscan.scaling_parameters(fieldpar, distance_scale, pm_scale)
+    features = cluster_hdbscan.scaled_features(fieldpar, scaling=scaling)
+    clustering = hdbscan.HDBSCAN(min_cluster_size=50, min_samples=min_samples,\
+     cluster_selection_method="leaf", core_dist_n_jobs=core_dist_n_jobs,\
+     prediction_data=True).fit(features)
+    fieldpar["clusternum"] = clustering.labels_
+    fieldpar["clusterprob"] = clustering.probabilities_
+    model = {"version": MODEL_VERSION, "clustering": clustering, "scaling": scaling,\
+     "dtype": features.dtype.str, "source": cluster_hdbscan.feature_source(cluster_name,\
+     field_radius, scaling["distance_scale"], scaling["pm_scale"], features.dtype)}
+    return model, fieldpar
+
+
+def save_model(model, path):
+    """ Writes the model to path. """
+    with open(path, "wb") as outfile:
+        pickle.dump(model, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_model(path):
+    """ Reads a model written by save_model. """
+    with open(path, "rb") as infile:
+        model = pickle.load(infile)
+    if model.get("version") != MODEL_VERSION:
+        raise ValueError(path+" was saved by a different membership_model version")
+    return model
+
+
+def predictable(stars, parallax_ratio_cut=PREDICT_PARALLAX_RATIO_CUT):
+    """ The mask of the new stars with a finite, positive distance and (when stars has a
+    parallax_error column and parallax_ratio_cut is not None) a parallax error ratio
+    above parallax_ratio_cut. """
+    distance = stars["distance"].to_numpy(dtype=np.float64)
+    keep = np.isfinite(distance) & (distance > 0)
+    if parallax_ratio_cut is not None and "parallax_error" in stars:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            keep &= (stars["parallax"]/stars["parallax_error"]).to_numpy() > parallax_ratio_cut
+    return keep
+
+
+def predict_membership(model, stars, batch_size=PREDICT_BATCH_SIZE,\
+ parallax_ratio_cut=PREDICT_PARALLAX_RATIO_CUT):
+    """ The predicted cluster labels (-1 for the field) and membership probabilities of
+    new stars (a dataframe with the gaia_dr2_read_setup columns), scaled with the
+    model's field scaling and predicted batch_size stars at a time.  Stars failing the
+    predictable cuts are labelled -1 with probability 0.  The ratransform and rawrapped
+    columns are added to stars as for the field. """
+    import hdbscan
+
+    features = cluster_hdbscan.scaled_features(stars, dtype=np.dtype(model["dtype"]),\
+     scaling=model["scaling"])
+    labels = np.full(len(stars), -1, dtype=np.int64)
+    probabilities = np.zeros(len(stars))
+    rows = np.flatnonzero(predictable(stars, parallax_ratio_cut))
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        labels[batch], probabilities[batch] = hdbscan.approximate_predict(model["clustering"],\
+         features[batch])
+    return labels, probabilities
+
+
+def new_stars(chunk):
+    """ The source_id and gaia_dr2_read_setup columns (and the parallax_error, for the
+    predictable cuts) of a chunk of a gaia_search.py csv, dropping stars missing a
+    parameter and adding the same 0.03 mas zeropoint corrected distance. """
+    stars = chunk[[column for column in ["source_id"] if column in chunk]+SETUP_COLUMNS+\
+     [column for column in ["parallax_error"] if column in chunk]]
+    stars = stars.dropna(subset=SETUP_COLUMNS)
+    with np.errstate(divide="ignore"):
+        stars["distance"] = 1/((stars["parallax"]+0.03)*0.001)
+    return stars
+
+
+def predict_csv(model, csv_path, output_path, batch_size=PREDICT_BATCH_SIZE):
+    """ Streams a gaia_search.py csv of new stars batch_size rows at a time, writing each
+    star's predicted clusternum and clusterprob (and M_G) to output_path, indexed by
+    the csv row number as in the clustering output.  Returns the number of stars
+    assigned to each cluster. """
+    counts = {}
+    header = True
+    for chunk in pd.read_csv(csv_path, chunksize=batch_size):
+        stars = new_stars(chunk)
+        stars["clusternum"], stars["clusterprob"] = predict_membership(model, stars, batch_size)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            stars["M_G"] = stars["phot_g_mean_mag"] - np.log10(stars["distance"]/10)*5
+        stars.to_csv(output_path, mode="w" if header else "a", header=header)
+        header = False
+        for clusternum, count in stars["clusternum"].value_counts().items():
+            counts[clusternum] = counts.get(clusternum, 0) + count
+    return dict(sorted(counts.items()))
+
+
+def main():
+    """ Parses the command line and fits or predicts. """
+    parser = argparse.ArgumentParser(description="Save a clustering model or predict membership.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    fit_parser = commands.add_parser("fit", help="cluster a field and save its model")
+    fit_parser.add_argument("name", help="CLUSTER_NAME of the input \"<name>gaiafield<radius>.csv\"")
+    fit_parser.add_argument("radius", help="FIELD_RADIUS of the input csv")
+    predict_parser = commands.add_parser("predict", help="predict the membership of new stars")
+    predict_parser.add_argument("name", help="CLUSTER_NAME of the saved model")
+    predict_parser.add_argument("csv", help="csv of new stars in the gaia_search.py format")
+    predict_parser.add_argument("--batch-size", type=int, default=PREDICT_BATCH_SIZE)
+    args = parser.parse_args()
+    if args.command == "fit":
+        model, fieldpar = fit_model(args.name, args.radius)
+        save_model(model, model_filename(args.name))
+        print("Saved "+model_filename(args.name)+" from "+field_filename(args.name, args.radius)+\
+         " ("+str(len(fieldpar))+" stars)")
+    else:
+        counts = predict_csv(load_model(model_filename(args.name)), args.csv,\
+         args.name+"predicted.csv", args.batch_size)
+        for clusternum, count in counts.items():
+            print("Cluster "+str(clusternum)+": "+str(count)+" stars")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+""" Ensemble membership stability of the cluster_hdbscan.py clusters.  HDBSCAN's clusterprob
+    only reflects the density within one fit, so the field is re-clustered
+    STABILITY_REALIZATIONS times with the proper motions and parallaxes redrawn from their
+    Gaia errors (the pmra_error, pmdec_error, and parallax_error columns of the
+    gaia_search.py csv), or with the stars resampled with replacement.  The realizations
+    are drawn in vectorized batches of STABILITY_BATCH and fit in parallel worker
+    processes.  Every cluster of the reference fit is matched in each realization to the
+    cluster sharing most of its members, and each star's matches are added to running
+    counters, so memory does not grow with the number of realizations.  The stability
+    of a star in a cluster is the fraction of the realizations (that drew the star) in
+    which it was a member of that cluster's match.
+
+    A redrawn parallax is kept above STABILITY_MIN_PARALLAX (after the 0.03 mas zeropoint
+    correction), so that a large negative draw never places a star at a negative or
+    near-infinite distance.  The redrawn parallaxes are inverted directly, as in
+    gaia_dr2_read_setup; with USE_DISTANCE_ENGINE set in cluster_hdbscan.py the reference
+    fit uses the Monte Carlo distances instead, so the perturbed realizations then differ
+    from it in their distance definition as well (the resampled realizations use the
+    reference distances).
+
+    Usage: python membership_stability.py CLUSTER_NAME FIELD_RADIUS [--realizations N]
+     [--mode perturb|resample] [--workers N]
+
+    The per-star stabilities are written to "<CLUSTER_NAME>stability.csv" (one
+    stability_<clusternum> column per reference cluster, for the stars that were ever a
+    member), and the per-cluster match rates to "<CLUSTER_NAME>stabilityclusters.csv". """
+import argparse
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import cluster_hdbscan
+from field_store import field_filename
+
+# The number of realizations, the number drawn and fit together by one worker task,
+# and the number of worker processes (None for one per core).
+STABILITY_REALIZATIONS = 100
+STABILITY_BATCH = 4
+STABILITY_WORKERS = None
+STABILITY_SEED = 0
+
+# "perturb" redraws the astrometry from its errors, and "resample" draws the stars with
+# replacement (a bootstrap).
+STABILITY_MODE = "perturb"
+
+# A reference cluster is matched to the realization cluster holding most of its members,
+# provided the two share at least STABILITY_MATCH of their combined members (Jaccard).
+STABILITY_MATCH = 0.5
+
+# The smallest zeropoint corrected parallax (mas) of a perturbed realization: lower draws
+# are redrawn up to STABILITY_REDRAWS times, and then raised to it.
+STABILITY_MIN_PARALLAX = 0.1
+STABILITY_REDRAWS = 10
+
+ERROR_COLUMNS = ["pmra_error", "pmdec_error", "parallax_error"]
+
+# The field arrays of a worker process, set once by _init_worker.
+_FIELD = None
+
+
+def _init_worker(field):
+    """ Keeps the field arrays in the worker, so tasks only carry their seeds. """
+    global _FIELD
+    _FIELD = field
+
+
+def field_errors(cluster_name, field_radius, index):
+    """ The ERROR_COLUMNS of the field's csv rows (the gaia_dr2_read_setup index). """
+    errors = pd.read_csv(field_filename(cluster_name, field_radius), usecols=ERROR_COLUMNS,\
+     dtype={name: np.float64 for name in ERROR_COLUMNS})
+    return {name: errors[name].to_numpy()[index] for name in ERROR_COLUMNS}
+
+
+def stability_field(fieldpar, errors, labels, distance_scale, pm_scale):
+    """ The arrays every realization is built from: the fixed angular parts of the RA and
+    DEC features (the scaled_features transformation before the distance is applied),
+    the astrometry and its errors, the scalings, and the reference labels. """
+    scaling = cluster_hdbscan.scaling_parameters(fieldpar, distance_scale, pm_scale)
+    ra = fieldpar["ra"].to_numpy(dtype=np.float64)
+    dec = fieldpar["dec"].to_numpy(dtype=np.float64)
+    ratransform = ra - scaling["racen"]
+    if scaling["wrap_check"] == 1:
+        ratransform[ratransform > 180] -= 360
+        ratransform[ratransform < -180] += 360
+    field = {"ra_angle": ratransform*np.cos(dec*3.14159/180)*3.14159/180,\
+     "dec_angle": dec*3.14159/180, "labels": labels, "distance_scale": distance_scale,\
+     "pm_scale": pm_scale, "distance": fieldpar["distance"].to_numpy(dtype=np.float64)}
+    for name in ["pmra", "pmdec", "parallax"]:
+        field[name] = fieldpar[name].to_numpy(dtype=np.float64)
+        field[name+"_error"] = errors[name+"_error"]
+    return field
+
+
+def realization_noise(field, rng, batch):
+    """ The (3, batch, stars) standard normal draws of the PM RA, PM DEC, and parallax of
+    a batch of perturbed realizations, with the parallax draws below
+    STABILITY_MIN_PARALLAX redrawn. """
+    noise = rng.standard_normal((3, batch, len(field["labels"])))
+    for _ in range(STABILITY_REDRAWS):
+        low = field["parallax"] + noise[2]*field["parallax_error"] + 0.03 < STABILITY_MIN_PARALLAX
+        if not low.any():
+            break
+        noise[2][low] = rng.standard_normal(np.count_nonzero(low))
+    return noise
+
+
+def realization_features(field, noise=None):
+    """ The scaled features of a batch of perturbed realizations at once: noise is a
+    (3, batch, stars) array of standard normal draws for the PM RA, PM DEC, and
+    parallax (see realization_noise), and the perturbed parallaxes are inverted with
+    at least STABILITY_MIN_PARALLAX.  Without noise, the single (1, stars, 5) batch of
+    the reference astrometry and distances.  Returns a (batch, stars, 5) array. """
+    if noise is None:
+        pmra, pmdec, distance = field["pmra"][None], field["pmdec"][None], field["distance"][None]
+    else:
+        pmra = field["pmra"] + noise[0]*field["pmra_error"]
+        pmdec = field["pmdec"] + noise[1]*field["pmdec_error"]
+        parallax = field["parallax"] + noise[2]*field["parallax_error"] + 0.03
+        distance = 1/(np.maximum(parallax, STABILITY_MIN_PARALLAX)*0.001)
+    features = np.empty(distance.shape+(5,))
+    features[..., 0] = field["ra_angle"]*distance
+    features[..., 1] = field["dec_angle"]*distance
+    features[..., 2] = pmra*field["pm_scale"]
+    features[..., 3] = pmdec*field["pm_scale"]
+    features[..., 4] = distance/field["distance_scale"]
+    return features
+
+
+def match_clusters(reference, labels, rows, match=STABILITY_MATCH):
+    """ The members (field rows) of the realization cluster matched to each reference
+    cluster, as a dictionary by reference cluster number.  labels are the realization
+    labels of the field rows rows. """
+    matches = {}
+    reference = reference[rows]
+    clustered = labels >= 0
+    realization_sizes = np.bincount(labels[clustered]) if clustered.any() else np.zeros(0, np.int64)
+    for clusternum in np.unique(reference[reference >= 0]):
+        members = reference == clusternum
+        shared = labels[members & clustered]
+        if len(shared) == 0:
+            continue
+        best = np.bincount(shared).argmax()
+        overlap = np.count_nonzero(shared == best)
+        if overlap/(np.count_nonzero(members) + realization_sizes[best] - overlap) >= match:
+            matches[int(clusternum)] = np.unique(rows[labels == best])
+    return matches
+
+
+def run_batch(seed, batch, mode, min_samples, match):
+    """ Draws and clusters one batch of realizations in a worker, returning for each the
+    matched members of every reference cluster and the field rows it drew. """
+    import hdbscan
+
+    field = _FIELD
+    star_count = len(field["labels"])
+    rng = np.random.default_rng(seed)
+    if mode == "perturb":
+        features = realization_features(field, realization_noise(field, rng, batch))
+        draws = [np.arange(star_count)]*batch
+    else:
+        features = realization_features(field)[0]
+        draws = [np.sort(rng.integers(0, star_count, star_count)) for _ in range(batch)]
+    results = []
+    for number, rows in enumerate(draws):
+        realization = features[number] if mode == "perturb" else features[rows]
+        labels = hdbscan.HDBSCAN(min_cluster_size=50, min_samples=min_samples,\
+         cluster_selection_method="leaf", core_dist_n_jobs=1).fit(realization).labels_
+        results.append((match_clusters(field["labels"], labels, rows, match),\
+         None if mode == "perturb" else np.unique(rows)))
+    return results
+
+
+def membership_stability(fieldpar, errors, distance_scale=None, pm_scale=None, min_samples=None,\
+ realizations=STABILITY_REALIZATIONS, batch=STABILITY_BATCH, mode=STABILITY_MODE,\
+ workers=STABILITY_WORKERS, seed=STABILITY_SEED, match=STABILITY_MATCH):
+    """ Runs the ensemble on a clustered field (with the reference clusternum column) and
+    returns the per-star stability dataframe and the per-cluster match rates.  The
+    scalings and min_samples default to the cluster_hdbscan.py values.  At most two
+    batches per worker are in flight, and their results are folded into the counters
+    as they arrive. """
+    if distance_scale is None:
+        distance_scale = cluster_hdbscan.DISTANCE_SCALE
+    if pm_scale is None:
+        pm_scale = cluster_hdbscan.PM_SCALE
+    if min_samples is None:
+        min_samples = cluster_hdbscan.MIN_SAMPLE
+    if workers is None:
+        workers = os.cpu_count() or 1
+    reference = fieldpar["clusternum"].to_numpy()
+    field = stability_field(fieldpar, errors, reference, distance_scale, pm_scale)
+    clusters = np.unique(reference[reference >= 0])
+    positions = {int(clusternum): position for position, clusternum in enumerate(clusters)}
+    member_counts = np.zeros((len(clusters), len(fieldpar)), dtype=np.uint32)
+    draw_counts = np.zeros(len(fieldpar), dtype=np.uint32)
+    match_counts = np.zeros(len(clusters), dtype=np.int64)
+    batches = [min(batch, realizations - start) for start in range(0, realizations, batch)]
+    seeds = np.random.SeedSequence(seed).spawn(len(batches))
+
+    def count(results):
+        for matches, drawn in results:
+            if drawn is None:
+                draw_counts[:] += 1
+            else:
+                draw_counts[drawn] += 1
+            for clusternum, members in matches.items():
+                member_counts[positions[clusternum], members] += 1
+                match_counts[positions[clusternum]] += 1
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,\
+     initargs=(field,)) as executor:
+        pending = deque()
+        for batch_seed, batch_size in zip(seeds, batches):
+            pending.append(executor.submit(run_batch, batch_seed, batch_size, mode, min_samples,\
+             match))
+            if len(pending) >= 2*workers:
+                count(pending.popleft().result())
+        while pending:
+            count(pending.popleft().result())
+    ever = np.flatnonzero(member_counts.any(axis=0) | (reference >= 0))
+    stability = pd.DataFrame({"clusternum": reference[ever],\
+     "clusterprob": fieldpar["clusterprob"].to_numpy()[ever]}, index=fieldpar.index[ever])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for position, clusternum in enumerate(clusters):
+            stability["stability_"+str(clusternum)] = member_counts[position, ever]/\
+             draw_counts[ever]
+    rates = pd.DataFrame({"members": np.unique(reference[reference >= 0], return_counts=True)[1],\
+     "match_rate": match_counts/realizations}, index=pd.Index(clusters, name="clusternum"))
+    return stability, rates
+
+
+def main():
+    """ Clusters the field as cluster_hdbscan.py does (re-using a cached result), runs the
+    ensemble, and writes the stabilities and match rates. """
+    parser = argparse.ArgumentParser(description="Ensemble membership stability of a field.")
+    parser.add_argument("name", help="CLUSTER_NAME of the input \"<name>gaiafield<radius>.csv\"")
+    parser.add_argument("radius", help="FIELD_RADIUS of the input csv")
+    parser.add_argument("--realizations", type=int, default=STABILITY_REALIZATIONS)
+    parser.add_argument("--mode", choices=["perturb", "resample"], default=STABILITY_MODE)
+    parser.add_argument("--workers", type=int, default=STABILITY_WORKERS)
+    args = parser.parse_args()
+    if cluster_hdbscan.USE_DISTANCE_ENGINE == 1 and args.mode == "perturb":
+        print("Note: the reference fit uses the Monte Carlo distances (USE_DISTANCE_ENGINE),"\
+         " while the perturbed realizations invert their redrawn parallaxes directly")
+    fieldpar = cluster_hdbscan.gaia_dr2_read_setup(args.name, args.radius)
+    features = cluster_hdbscan.scaled_features(fieldpar)
+    fieldpar = cluster_hdbscan.clustering_algorithm(features, fieldpar, cluster_name=args.name,\
+     source=cluster_hdbscan.feature_source(args.name, args.radius))
+    errors = field_errors(args.name, args.radius, fieldpar.index)
+    stability, rates = membership_stability(fieldpar, errors, realizations=args.realizations,\
+     mode=args.mode, workers=args.workers)
+    print(rates.to_string())
+    stability.to_csv(args.name+"stability.csv")
+    rates.to_csv(args.name+"stabilityclusters.csv")
+
+
+if __name__ == "__main__":
+    main()
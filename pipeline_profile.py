@@ -0,0 +1,237 @@
+""" Stage-level instrumentation of the clustering pipeline.  The pipeline functions of
+    cluster_hdbscan.py, cluster_hdbscan_wdsearch.py, and cluster_plot.py wrap their
+    stages in stage(), which records the wall and CPU time, peak memory, and rows in and
+    out of each stage while a run is active, and does nothing otherwise.  A run writes a
+    JSON report of its stages, and optionally a cProfile dump of its slowest stage.
+
+    Runs are turned on by setting the GAIA_PROFILE environment variable to 1 (report
+    only) or cprofile (report and cProfile dump) before running any of the scripts or
+    batch_fields.py.  The report is written to "<prefix>profile.json" and the dump to
+    "<prefix>profile.prof" (view it with python -m pstats or snakeviz), where the
+    prefix is the CLUSTER_NAME or batch field output prefix.
+
+    Stages are not nested: a stage started inside another is measured on its own and
+    its time is also included in the outer stage. """
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import threading
+import time
+
+# The run mode, from the GAIA_PROFILE environment variable ("0" for off, "1" for the
+# stage report, or "cprofile" for the report and a cProfile of the slowest stage).
+PROFILE_MODE = os.environ.get("GAIA_PROFILE", "0")
+
+# The resident memory sampling interval (s) of the stage peaks.
+SAMPLE_INTERVAL = 0.01
+
+# The active run, or None when instrumentation is off.
+_RUN = None
+
+
+def peak_rss_mb():
+    """ The peak resident memory of this process so far (MB; ru_maxrss is in kB on Linux). """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+def rss_mb():
+    """ The current resident memory of this process (MB), or the peak so far where
+    /proc is not available. """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1])*os.sysconf("SC_PAGE_SIZE")/1048576
+    except OSError:
+        return peak_rss_mb()
+
+
+def cpu_seconds():
+    """ The CPU time (user and system) of this process and its finished children. """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+class StageMeter:
+    """ Records the wall time and peak memory of named stages, using a background
+    thread that samples the resident memory.  A stage's peak is its highest resident
+    memory above that at the start of the stage; a stage that holds the GIL throughout
+    (e.g., the prims HDBSCAN algorithms) is caught instead by the process peak when it
+    sets a new one. """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.seconds = {}
+        self.peak_mb = {}
+        self._peak = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            rss = rss_mb()
+            with self._lock:
+                self._peak = max(self._peak, rss)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """ Times and measures the enclosed block as the stage name. """
+        start_rss = rss_mb()
+        start_peak = peak_rss_mb()
+        with self._lock:
+            self._peak = start_rss
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = time.perf_counter() - start
+            end_peak = peak_rss_mb()
+            with self._lock:
+                peak = max(self._peak, rss_mb())
+            if end_peak > start_peak:
+                peak = max(peak, end_peak)
+            self.peak_mb[name] = peak - start_rss
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class _NullStage:
+    """ The stage returned while no run is active: entering and leaving it, and setting
+    its rows_out, do nothing. """
+    rows_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage:
+    """ One measured stage of the active run.  Set rows_out inside the with block to
+    record the stage's output row count. """
+
+    def __init__(self, run, name, rows_in):
+        self.run = run
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+
+    def __enter__(self):
+        self._cpu = cpu_seconds()
+        self._profile = cProfile.Profile() if self.run.cprofile and\
+         not self.run.profiling else None
+        self._meter = self.run.meter.stage(self.name)
+        self._meter.__enter__()
+        if self._profile is not None:
+            self.run.profiling = True
+            self._profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._profile is not None:
+            self._profile.disable()
+            self.run.profiling = False
+        self._meter.__exit__(*exc_info)
+        record = {"stage": self.name, "seconds": round(self.run.meter.seconds[self.name], 4),\
+         "cpu_seconds": round(cpu_seconds() - self._cpu, 4),\
+         "peak_mb": round(self.run.meter.peak_mb[self.name], 1), "rows_in": self.rows_in,\
+         "rows_out": self.rows_out, "failed": exc_info[0] is not None}
+        self.run.stages.append(record)
+        if self._profile is not None and (self.run.hottest is None or\
+         record["seconds"] > self.run.hottest[0]["seconds"]):
+            self.run.hottest = (record, self._profile)
+        return False
+
+
+class ProfileRun:
+    """ The state of one instrumented run: the stage records in order, and the cProfile
+    of the slowest stage so far when cprofile is set. """
+
+    def __init__(self, prefix, cprofile=False):
+        self.prefix = prefix
+        self.cprofile = cprofile
+        self.profiling = False
+        self.stages = []
+        self.hottest = None
+        self.meter = StageMeter()
+        self.started = time.time()
+        self._start = time.perf_counter()
+
+    def report(self):
+        """ The run report as a dictionary. """
+        report = {"run": self.prefix, "started": time.strftime("%Y-%m-%dT%H:%M:%S",\
+         time.localtime(self.started)), "seconds": round(time.perf_counter() - self._start, 4),\
+         "peak_rss_mb": round(peak_rss_mb(), 1), "stages": self.stages,\
+         "slowest_stage": None, "cprofile": None}
+        if self.stages:
+            report["slowest_stage"] = max(self.stages, key=lambda record: record["seconds"])["stage"]
+        if self.hottest is not None:
+            report["cprofile"] = self.prefix+"profile.prof"
+            report["cprofile_stage"] = self.hottest[0]["stage"]
+        return report
+
+    def write(self):
+        """ Writes the JSON report (and cProfile dump), returning the report. """
+        report = self.report()
+        with open(self.prefix+"profile.json", "w") as outfile:
+            json.dump(report, outfile, indent=1)
+        if self.hottest is not None:
+            self.hottest[1].dump_stats(report["cprofile"])
+        return report
+
+
+def stage(name, rows_in=None):
+    """ A context manager measuring the enclosed block as the named stage of the active
+    run, with rows_in input rows.  Set rows_out on the returned stage to record the
+    output rows.  With no active run it returns a shared object that does nothing. """
+    if _RUN is None:
+        return _NULL_STAGE
+    return _Stage(_RUN, name, rows_in)
+
+
+def start_run(prefix, cprofile=False):
+    """ Starts recording stages for a run reported under prefix, ending any active run
+    without writing it. """
+    global _RUN
+    if _RUN is not None:
+        _RUN.meter.close()
+    _RUN = ProfileRun(prefix, cprofile)
+    return _RUN
+
+
+def finish_run():
+    """ Ends the active run, writes its report, and returns the report (None if no run
+    was active). """
+    global _RUN
+    if _RUN is None:
+        return None
+    run, _RUN = _RUN, None
+    run.meter.close()
+    return run.write()
+
+
+@contextlib.contextmanager
+def run(prefix, mode=None):
+    """ Records the enclosed block as a run reported under prefix when mode (default
+    PROFILE_MODE) is on.  The report is written even if the block raises. """
+    if mode is None:
+        mode = PROFILE_MODE
+    if mode in ["", "0"]:
+        yield
+        return
+    start_run(prefix, cprofile=mode == "cprofile")
+    try:
+        yield
+    finally:
+        finish_run()
@@ -0,0 +1,216 @@
+""" Persistent local cache of the gaia_search.py queries.  Object names resolved by SIMBAD
+    are kept in a small JSON file, and the downloaded Gaia sources are kept in a fixed
+    grid of RA and DEC sky tiles (one .npz file per tile, per parallax cut pair).  A
+    cone search is answered by filtering the cached tiles it overlaps, and only the
+    tiles it overlaps that were never downloaded are queried, so growing FIELD_RADIUS
+    from 2 to 2.5 degrees only downloads the outer ring of tiles, and a smaller or
+    renamed search of a cached field makes no queries at all.  The cache directory can
+    be deleted at any time. """
+import json
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+import gaia_search
+
+# The cache directory, and the DEC height (degrees) of its sky tiles.  The RA width of
+# each DEC band's tiles is chosen so that they are roughly square on the sky.  Changing
+# CACHE_TILE_SIZE starts a new grid, so the tiles of the old grid are no longer used.
+QUERY_CACHE_DIR = "gaia_query_cache"
+CACHE_TILE_SIZE = 0.5
+
+OBJECTS_NAME = "objects.json"
+QUERY_CACHE_VERSION = 1
+
+
+def object_key(object_name):
+    """ SIMBAD names ignore case and spacing, so "Collinder 173" and "collinder173" share
+    one cache entry. """
+    return "".join(object_name.split()).lower()
+
+
+def simbad_coordinates(object_name):
+    """ The RA and DEC (decimal degrees) of an object from SIMBAD. """
+    from astroquery.simbad import Simbad
+
+    result_table = Simbad.query_object(object_name)
+    return gaia_search.coordconv(result_table["RA"][0].split(), result_table["DEC"][0].split())
+
+
+def resolve_object(object_name, cache_dir=None, resolver=None):
+    """ The RA and DEC of object_name, from the cache if it was resolved before, or else
+    from resolver (default simbad_coordinates) and then cached. """
+    if cache_dir is None:
+        cache_dir = QUERY_CACHE_DIR
+    path = os.path.join(cache_dir, OBJECTS_NAME)
+    try:
+        with open(path) as infile:
+            objects = json.load(infile)
+    except (OSError, ValueError):
+        objects = {}
+    key = object_key(object_name)
+    if key in objects:
+        return tuple(objects[key])
+    if resolver is None:
+        resolver = simbad_coordinates
+    ra_obj, dec_obj = resolver(object_name)
+    objects[key] = [float(ra_obj), float(dec_obj)]
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path+".tmp", "w") as outfile:
+        json.dump(objects, outfile, indent=1, sort_keys=True)
+    os.replace(path+".tmp", path)
+    return ra_obj, dec_obj
+
+
+def tile_dir(cache_dir=None, tile_size=CACHE_TILE_SIZE):
+    """ The directory of the cached tiles of one grid and one pair of gaia_search.py
+    parallax cuts, since a tile downloaded with other cuts holds other stars. """
+    if cache_dir is None:
+        cache_dir = QUERY_CACHE_DIR
+    return os.path.join(cache_dir, "v"+str(QUERY_CACHE_VERSION)+"_tile"+repr(tile_size)+\
+     "_plx"+repr(gaia_search.PARALLAX_CUT)+"_ratio"+repr(gaia_search.PARALLAX_ERROR_RATIO))
+
+
+def band_count(tile_size=CACHE_TILE_SIZE):
+    """ The number of DEC bands of the grid. """
+    return max(1, math.ceil(180/tile_size))
+
+
+def band_bounds(band, tile_size=CACHE_TILE_SIZE):
+    """ The DEC bounds of a band.  Tiles include their lower bounds and exclude their
+    upper bounds, and the top band includes DEC=90. """
+    bands = band_count(tile_size)
+    declow = -90 + 180*band/bands
+    dechigh = -90 + 180*(band + 1)/bands
+    if band == bands - 1:
+        dechigh = math.nextafter(90.0, math.inf)
+    return declow, dechigh
+
+
+def band_tiles(band, tile_size=CACHE_TILE_SIZE):
+    """ The number of RA tiles of a band, from its width at its widest DEC. """
+    declow, dechigh = band_bounds(band, tile_size)
+    widest = 1.0 if declow < 0 < dechigh else max(math.cos(math.radians(declow)),\
+     math.cos(math.radians(min(dechigh, 90.0))))
+    return max(1, math.ceil(360*widest/tile_size))
+
+
+def tile_bounds(tile, tile_size=CACHE_TILE_SIZE):
+    """ The (ramin, ramax, decmin, decmax) box of a (band, step) tile. """
+    band, step = tile
+    ra_count = band_tiles(band, tile_size)
+    declow, dechigh = band_bounds(band, tile_size)
+    return 360*step/ra_count, 360*(step + 1)/ra_count, declow, dechigh
+
+
+def box_distance(ra_obj, dec_obj, box):
+    """ The smallest angular distance (degrees) from a position to an RA and DEC box.
+    Within the RA range of the box the nearest point is straight north or south, and
+    otherwise it lies on one of the two RA edges, where the distance along the edge is
+    smallest at the foot of the perpendicular great circle (clamped to the edge). """
+    ralow, rahigh, declow, dechigh = box
+    dechigh = min(dechigh, 90.0)
+    if (ra_obj - ralow) % 360 <= rahigh - ralow:
+        return max(declow - dec_obj, dec_obj - dechigh, 0.0)
+    distances = []
+    for ra_edge in (ralow, rahigh):
+        ra_diff = math.radians(ra_obj - ra_edge)
+        foot = math.degrees(math.atan2(math.sin(math.radians(dec_obj)),\
+         math.cos(math.radians(dec_obj))*math.cos(ra_diff)))
+        for dec_edge in (min(max(foot, declow), dechigh), declow, dechigh):
+            distances.append(gaia_search.angular_separation(ra_obj, dec_obj, ra_edge, dec_edge))
+    return min(distances)
+
+
+def cone_tiles(ra_obj, dec_obj, radius, tile_size=CACHE_TILE_SIZE):
+    """ The (band, step) tiles of the grid that overlap the search circle. """
+    tiles = []
+    for band in range(band_count(tile_size)):
+        declow, dechigh = band_bounds(band, tile_size)
+        if declow > dec_obj + radius or dechigh < dec_obj - radius:
+            continue
+        for step in range(band_tiles(band, tile_size)):
+            if box_distance(ra_obj, dec_obj, tile_bounds((band, step), tile_size)) <= radius:
+                tiles.append((band, step))
+    return tiles
+
+
+def tile_path(tile, directory):
+    """ The .npz file of a cached tile. """
+    return os.path.join(directory, str(tile[0])+"_"+str(tile[1])+".npz")
+
+
+def tile_circle(box):
+    """ The smallest circle about the box center that contains the whole box (its
+    farthest points are its corners), for the CIRCLE of a tile's ADQL query. """
+    ralow, rahigh, declow, dechigh = box
+    dechigh = min(dechigh, 90.0)
+    ra_center, dec_center = (ralow + rahigh)/2, (declow + dechigh)/2
+    radius = max(gaia_search.angular_separation(ra_center, dec_center, ra_corner, dec_corner)\
+     for ra_corner in (ralow, rahigh) for dec_corner in (declow, dechigh))
+    return ra_center, dec_center, radius + 1e-6
+
+
+def fetch_tile(tile, directory, tap_url=gaia_search.TAP_URL, tile_size=CACHE_TILE_SIZE,\
+ retries=gaia_search.TILE_RETRIES, backoff=gaia_search.TILE_BACKOFF):
+    """ Downloads every star of a tile (with the gaia_search.py parallax cuts) and saves
+    it to the cache.  The file is written under a temporary name first, so a tile file
+    always holds the complete tile.  Returns the number of stars. """
+    box = tile_bounds(tile, tile_size)
+    ra_center, dec_center, radius = tile_circle(box)
+    rows = gaia_search.tile_call(ra_center, dec_center, radius, box, tap_url, retries, backoff)
+    path = tile_path(tile, directory)
+    np.savez(path+".tmp.npz", **{name: rows[name].to_numpy() for name in rows.columns})
+    os.replace(path+".tmp.npz", path)
+    return len(rows)
+
+
+def load_tile(tile, directory):
+    """ The cached stars of a tile as a dataframe. """
+    with np.load(tile_path(tile, directory)) as cached:
+        return pd.DataFrame({name: cached[name] for name in cached.files})
+
+
+def cached_cone(ra_obj, dec_obj, radius, filename, tap_url=gaia_search.TAP_URL, cache_dir=None,\
+ tile_size=CACHE_TILE_SIZE, workers=gaia_search.TILE_WORKERS, retries=gaia_search.TILE_RETRIES,\
+ backoff=gaia_search.TILE_BACKOFF):
+    """ Writes the gaia_search.py csv of a cone search from the cache, first downloading
+    (with a bounded pool of worker threads) only the overlapping tiles that are not yet
+    cached.  Tiles that download successfully are kept even if others fail, so a re-run
+    only retries the failures.  Returns the number of stars written and the number of
+    tiles downloaded. """
+    directory = tile_dir(cache_dir, tile_size)
+    os.makedirs(directory, exist_ok=True)
+    tiles = cone_tiles(ra_obj, dec_obj, radius, tile_size)
+    missing = [tile for tile in tiles if not os.path.exists(tile_path(tile, directory))]
+    failed_tiles = []
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(fetch_tile, tile, directory, tap_url, tile_size, retries,\
+         backoff): tile for tile in missing}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as error:
+                failed_tiles.append((futures[future], error))
+    if failed_tiles:
+        raise RuntimeError(str(len(failed_tiles))+" of "+str(len(missing))+" tiles failed after "+\
+         str(retries)+" retries: "+"; ".join(str(tile)+": "+repr(error) for tile, error in failed_tiles))
+    partial_name = filename+".partial"
+    row_count = 0
+    with open(partial_name, "w", newline="") as outfile:
+        for tile in tiles:
+            rows = load_tile(tile, directory)
+            ra1, dec1 = np.radians(ra_obj), np.radians(dec_obj)
+            ra2, dec2 = np.radians(rows["ra"].to_numpy()), np.radians(rows["dec"].to_numpy())
+            hav = np.sin((dec2 - dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2)**2
+            rows = rows[np.degrees(2*np.arcsin(np.minimum(1, np.sqrt(hav)))) <= radius]
+            rows.index = range(row_count, row_count+len(rows))
+            rows.to_csv(outfile, header=(outfile.tell() == 0))
+            row_count += len(rows)
+    os.replace(partial_name, filename)
+    print(str(row_count)+" stars from "+str(len(tiles))+" cached tiles ("+str(len(missing))+\
+     " downloaded) in "+str(round(time.time() - start, 1))+" s")
+    return row_count, len(missing)
@@ -0,0 +1,118 @@
+""" Persistent cache of the HDBSCAN clustering results, so that re-plotting a field,
+    extracting a different cluster number, or re-running the white dwarf search never
+    re-runs HDBSCAN.  Each result (labels, membership probabilities, outlier scores, and
+    the condensed tree) is saved to its own .npz file named by a hash of the input field
+    contents, the feature scalings, and the HDBSCAN parameters.  The cache directory is
+    bounded in size, and the least recently used results are removed first.  Several
+    processes (e.g., batch_fields.py and field_pipeline.py workers) can share one cache
+    directory: each writes through its own temporary file, and a result removed or
+    replaced by another process meanwhile is simply skipped. """
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+
+# The cache directory and its size limit (MB).
+CACHE_DIR = "hdbscan_cache"
+CACHE_MAX_MB = 1024
+
+RESULT_ARRAYS = ["labels", "probabilities", "outlier_scores", "condensed_tree"]
+CACHE_VERSION = 1
+
+
+def result_key(source, settings):
+    """ The cache key: a hash of the description of the HDBSCAN input (source, e.g., from
+    cluster_hdbscan.feature_source) and the HDBSCAN parameters (settings). """
+    description = json.dumps({"version": CACHE_VERSION, "source": source, "settings": settings},\
+     sort_keys=True, default=str)
+    return hashlib.sha1(description.encode()).hexdigest()
+
+
+def result_path(key, cache_dir=None):
+    """ The .npz file of a cache key. """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    return os.path.join(cache_dir, key+".npz")
+
+
+def clustering_result(clustering):
+    """ The cached arrays of a fitted hdbscan.HDBSCAN. """
+    return {"labels": clustering.labels_, "probabilities": clustering.probabilities_,\
+     "outlier_scores": clustering.outlier_scores_,\
+     "condensed_tree": clustering.condensed_tree_.to_numpy()}
+
+
+def load(key, star_count=None, cache_dir=None):
+    """ Returns the cached result of key as a dictionary of arrays, or None if it is not
+    cached (or holds a different number of stars than star_count).  A hit marks the
+    result as recently used. """
+    if key is None:
+        return None
+    path = result_path(key, cache_dir)
+    try:
+        with np.load(path) as cached:
+            result = {name: cached[name] for name in RESULT_ARRAYS}
+    except (OSError, KeyError, ValueError):
+        return None
+    if star_count is not None and len(result["labels"]) != star_count:
+        return None
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        # Evicted by another process since it was read.
+        pass
+    return result
+
+
+def save(key, result, cache_dir=None, max_mb=None):
+    """ Saves a result under key (written to a temporary file of its own first, so an
+    interrupted or concurrent save is never read back), then evicts the least recently
+    used results until the cache is within max_mb (default CACHE_MAX_MB). """
+    if key is None:
+        return
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    os.makedirs(cache_dir, exist_ok=True)
+    path = result_path(key, cache_dir)
+    handle, tmp_path = tempfile.mkstemp(suffix=".tmp.npz", prefix=key+".", dir=cache_dir)
+    os.close(handle)
+    try:
+        np.savez(tmp_path, **{name: result[name] for name in RESULT_ARRAYS})
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    evict(cache_dir, max_mb, keep=path)
+
+
+def evict(cache_dir=None, max_mb=None, keep=None):
+    """ Removes the least recently used results (oldest modification time first) until
+    the cache is within max_mb, never removing the keep file.  Files removed by another
+    process meanwhile are skipped.  Returns the removed files. """
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    if max_mb is None:
+        max_mb = CACHE_MAX_MB
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".npz") and not entry.name.endswith(".tmp.npz"):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for _, size, path in sorted(entries):
+        if total <= max_mb*1048576:
+            break
+        if path == keep:
+            continue
+        total -= size
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        removed.append(path)
+    return removed
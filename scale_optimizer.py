@@ -0,0 +1,179 @@
+""" Automatic choice of the parameter_scaler distance and proper motion scalings.  Rather
+    than tuning DISTANCE_SCALE and PM_SCALE by hand with a full pipeline run per attempt,
+    every pair of OPTIMIZE_DISTANCE_SCALES and OPTIMIZE_PM_SCALES is clustered on a
+    stratified random subsample of the field, and scored on the clusters that pass the
+    cluster_plot real cluster cuts: how evenly their members spread across the five
+    scaled parameters (the docstring rule of parameter_scaler), and how compact they are
+    relative to the field.  The search is a successive halving: each round clusters the
+    remaining candidates in parallel on a larger subsample and keeps the better half,
+    and candidates that find no real cluster are dropped at once.  The winning scalings
+    are then used for a single full-size fit.
+
+    Usage: python scale_optimizer.py [CLUSTER_NAME FIELD_RADIUS] [--workers N]
+
+    The candidate scores are written to "<CLUSTER_NAME>scalesearch.csv" and the winning
+    scalings to "<CLUSTER_NAME>scales.json" (along with the usual cluster_hdbscan.py
+    outputs of the full fit). """
+import argparse
+import json
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import cluster_hdbscan
+from cluster_summary import ClusterSummary
+
+# The candidate scalings: the distance (pc) is divided by the distance scale and the
+# proper motions (mas/yr) are multiplied by the PM scale.
+OPTIMIZE_DISTANCE_SCALES = [2.5, 5, 10, 20]
+OPTIMIZE_PM_SCALES = [5, 10, 20, 35, 50]
+
+# The subsample sizes of the successive halving rounds (capped at the field size).  The
+# HDBSCAN min_samples and min_cluster_size are scaled by the subsample fraction, so the
+# subsample is clustered at the same density levels as the full field.
+OPTIMIZE_SAMPLE_SIZES = [20000, 40000, 80000]
+
+# The subsamples keep the field's distance distribution by sampling the same fraction of
+# every one of OPTIMIZE_STRATA distance quantile bins.
+OPTIMIZE_STRATA = 10
+OPTIMIZE_SEED = 0
+
+OPTIMIZE_WORKERS = os.cpu_count() or 1
+
+
+def stratified_sample(distance, sample_size, strata=OPTIMIZE_STRATA, seed=OPTIMIZE_SEED):
+    """ The sorted positions of a random subsample of about sample_size stars that
+    takes the same fraction of each distance quantile bin. """
+    if sample_size >= len(distance):
+        return np.arange(len(distance))
+    rng = np.random.default_rng(seed)
+    order = np.argsort(distance, kind="stable")
+    positions = []
+    for stratum in np.array_split(order, strata):
+        count = int(round(len(stratum)*sample_size/len(distance)))
+        positions.append(rng.choice(stratum, count, replace=False))
+    return np.sort(np.concatenate(positions))
+
+
+def cluster_score(features, labels, summary):
+    """ The score (lower is better) of the clusters passing the real cluster cuts: the
+    mean over clusters of the standard deviation of the log IQRs of the members' scaled
+    parameters (0 when the spreads are equal, the balance asked for by parameter_scaler),
+    plus the mean log of the members' IQRs relative to the field's in each parameter
+    (more negative for more compact clusters).  Candidates without a real cluster score
+    infinity. """
+    real = summary.real_clusters
+    if len(real) == 0:
+        return math.inf, math.inf, math.inf
+    field_iqr = np.subtract(*np.percentile(features, [75, 25], axis=0))
+    balances = []
+    compactness = []
+    for clusternum in real:
+        members = features[labels == clusternum]
+        iqr = np.maximum(np.subtract(*np.percentile(members, [75, 25], axis=0)),\
+         np.finfo(np.float64).tiny)
+        balances.append(np.std(np.log(iqr)))
+        compactness.append(np.mean(np.log(iqr/field_iqr)))
+    balance, compact = float(np.mean(balances)), float(np.mean(compactness))
+    return balance + compact, balance, compact
+
+
+def evaluate_candidate(sample, distance_scale, pm_scale, fraction, min_samples, summary_cuts):
+    """ Clusters a subsample (a dataframe with the gaia_dr2_read_setup columns and M_G)
+    with one pair of scalings, with min_samples and the cluster_hdbscan.py
+    min_cluster_size of 50 scaled by the subsample fraction, and returns its score row.
+    The candidates already run in parallel, so each fit uses a single core. """
+    import hdbscan
+
+    sample = sample.copy()
+    features = cluster_hdbscan.scaled_features(sample, distance_scale, pm_scale)
+    labels = hdbscan.HDBSCAN(min_cluster_size=max(5, int(round(50*fraction))),\
+     min_samples=max(2, int(round(min_samples*fraction))),\
+     cluster_selection_method="leaf", core_dist_n_jobs=1).fit(features).labels_
+    sample["clusternum"] = labels
+    summary = ClusterSummary(sample, **summary_cuts)
+    score, balance, compact = cluster_score(features, labels, summary)
+    return {"distance_scale": distance_scale, "pm_scale": pm_scale, "stars": len(sample),\
+     "score": score, "balance": balance, "compactness": compact,\
+     "real_clusters": len(summary.real_clusters)}
+
+
+def optimize_scales(fieldpar, distance_scales=None, pm_scales=None, sample_sizes=None,\
+ min_samples=None, summary_cuts=None, workers=None):
+    """ Runs the successive halving search on a field (the gaia_dr2_read_setup dataframe)
+    and returns the winning (distance_scale, pm_scale) and the table of every candidate
+    evaluation, by round.  Each argument defaults to its OPTIMIZE constant, min_samples
+    to the cluster_hdbscan.py MIN_SAMPLE, and summary_cuts (the ClusterSummary cut
+    arguments) to the cluster_plot cuts. """
+    if distance_scales is None:
+        distance_scales = OPTIMIZE_DISTANCE_SCALES
+    if pm_scales is None:
+        pm_scales = OPTIMIZE_PM_SCALES
+    if sample_sizes is None:
+        sample_sizes = OPTIMIZE_SAMPLE_SIZES
+    if min_samples is None:
+        min_samples = cluster_hdbscan.MIN_SAMPLE
+    if summary_cuts is None:
+        summary_cuts = {}
+    if workers is None:
+        workers = OPTIMIZE_WORKERS
+
+    field = fieldpar[["ra", "dec", "pmra", "pmdec", "parallax", "phot_g_mean_mag", "bp_rp",\
+     "distance"]]
+    field = field.assign(M_G=field["phot_g_mean_mag"] - np.log10(field["distance"]/10)*5)
+    candidates = [(distance_scale, pm_scale) for distance_scale in distance_scales\
+     for pm_scale in pm_scales]
+    rows = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for round_number, sample_size in enumerate(sample_sizes):
+            sample = field.iloc[stratified_sample(field["distance"].to_numpy(), sample_size)]
+            fraction = len(sample)/len(field)
+            futures = [executor.submit(evaluate_candidate, sample, distance_scale, pm_scale,\
+             fraction, min_samples, summary_cuts) for distance_scale, pm_scale in candidates]
+            scored = [dict(future.result(), round=round_number) for future in futures]
+            rows.extend(scored)
+            scored = sorted((row for row in scored if math.isfinite(row["score"])),\
+             key=lambda row: row["score"])
+            if not scored:
+                raise ValueError("No candidate scaling found a cluster passing the real cluster"\
+                 " cuts in a subsample of "+str(len(sample))+" stars")
+            # The better half goes on to the next round, and the search stops once a
+            # single candidate is left or the full field has been clustered.
+            candidates = [(row["distance_scale"], row["pm_scale"]) for row in\
+             scored[:max(1, len(scored)//2)]]
+            if len(candidates) == 1 or fraction >= 1:
+                break
+    return candidates[0], pd.DataFrame(rows)
+
+
+def record_scales(cluster_name, distance_scale, pm_scale, search):
+    """ Writes the search table and the winning scalings next to the clustering outputs. """
+    search.to_csv(cluster_name+"scalesearch.csv", index=False)
+    with open(cluster_name+"scales.json", "w") as outfile:
+        json.dump({"distance_scale": distance_scale, "pm_scale": pm_scale,\
+         "sample_sizes": sorted(set(search["stars"].tolist()))}, outfile, indent=1)
+
+
+def main():
+    """ Searches the scalings of a field, records them, and runs the full-size
+    cluster_hdbscan.py clustering with the winning scalings. """
+    parser = argparse.ArgumentParser(description="Choose the distance and PM scalings of a field.")
+    parser.add_argument("name", nargs="?", default=cluster_hdbscan.CLUSTER_NAME,\
+     help="CLUSTER_NAME of the input \"<name>gaiafield<radius>.csv\"")
+    parser.add_argument("radius", nargs="?", default=cluster_hdbscan.FIELD_RADIUS,\
+     help="FIELD_RADIUS of the input csv")
+    parser.add_argument("--workers", type=int, default=OPTIMIZE_WORKERS)
+    args = parser.parse_args()
+    fieldpar = cluster_hdbscan.gaia_dr2_read_setup(args.name, args.radius)
+    (distance_scale, pm_scale), search = optimize_scales(fieldpar, workers=args.workers)
+    print(search.to_string(index=False))
+    print("Distance scale "+str(distance_scale)+", PM scale "+str(pm_scale))
+    record_scales(args.name, distance_scale, pm_scale, search)
+    features = cluster_hdbscan.scaled_features(fieldpar, distance_scale, pm_scale)
+    cluster_hdbscan.clustering_algorithm(features, fieldpar, cluster_name=args.name,\
+     source=cluster_hdbscan.feature_source(args.name, args.radius, distance_scale, pm_scale))
+
+
+if __name__ == "__main__":
+    main()
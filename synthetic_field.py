@@ -0,0 +1,139 @@
+""" Generates synthetic Gaia fields with the gaia_search.py output columns: a disk field
+    population plus injected star clusters of chosen position, distance, size, proper
+    motion, and internal velocity dispersion.  The injected cluster of every star is
+    kept in the injected_cluster column (-1 for field stars), which the clustering
+    scripts ignore, so cluster recovery can be checked against the truth. """
+import numpy as np
+import pandas as pd
+
+# Converts a velocity (km/s) at 1 kpc into a proper motion (mas/yr).
+KMS_TO_MAS_YR = 1/4.74047
+
+# The default injected clusters.  ra_offset and dec_offset (degrees) are relative to
+# the field center, distance and size (the 1D Gaussian spatial sigma) are in pc,
+# pmra and pmdec are in mas/yr, and pm_dispersion is the 1D velocity dispersion in km/s.
+# white_dwarfs of the stars are placed on the white dwarf cooling sequence.
+DEFAULT_CLUSTERS = [
+    {"ra_offset": 0.0, "dec_offset": 0.0, "distance": 240, "size": 3, "pmra": 18.7,\
+     "pmdec": 2.6, "pm_dispersion": 0.6, "stars": 700, "white_dwarfs": 5},
+    {"ra_offset": 0.8, "dec_offset": -0.6, "distance": 600, "size": 4, "pmra": -5.0,\
+     "pmdec": 7.5, "pm_dispersion": 0.8, "stars": 400, "white_dwarfs": 3},
+    {"ra_offset": -0.9, "dec_offset": 0.5, "distance": 850, "size": 5, "pmra": 1.5,\
+     "pmdec": -9.0, "pm_dispersion": 1.0, "stars": 300, "white_dwarfs": 0},
+]
+
+OUTPUT_COLUMNS = ["source_id", "ra", "dec", "parallax", "parallax_error", "pmra", "pmra_error",\
+ "pmdec", "pmdec_error", "phot_g_mean_mag", "bp_rp", "injected_cluster"]
+
+
+def cap_positions(rng, ra_cen, dec_cen, radius, star_count):
+    """ RA and DEC (degrees) distributed uniformly on the sphere within radius (degrees)
+    of the center. """
+    cos_radius = np.cos(np.radians(radius))
+    theta = np.arccos(1 - rng.random(star_count)*(1 - cos_radius))
+    phi = rng.random(star_count)*2*np.pi
+    x_cap = np.sin(theta)*np.cos(phi)
+    y_cap = np.sin(theta)*np.sin(phi)
+    z_cap = np.cos(theta)
+    dec_rad, ra_rad = np.radians(dec_cen), np.radians(ra_cen)
+    x_tilt = z_cap*np.cos(dec_rad) - x_cap*np.sin(dec_rad)
+    z_tilt = z_cap*np.sin(dec_rad) + x_cap*np.cos(dec_rad)
+    x_sky = x_tilt*np.cos(ra_rad) - y_cap*np.sin(ra_rad)
+    y_sky = x_tilt*np.sin(ra_rad) + y_cap*np.cos(ra_rad)
+    return np.degrees(np.arctan2(y_sky, x_sky)) % 360, np.degrees(np.arcsin(np.clip(z_tilt, -1, 1)))
+
+
+def main_sequence(rng, star_count):
+    """ BP-RP colors and absolute G magnitudes roughly following the main sequence. """
+    bp_rp = rng.uniform(0.2, 3.2, star_count)
+    return bp_rp, 1.0 + 3.8*bp_rp + rng.normal(0, 0.3, star_count)
+
+
+def observe(rng, stars):
+    """ Adds Gaia-like errors to the true distance, proper motions, and photometry, with
+    errors that grow with apparent magnitude. """
+    star_count = len(stars["distance"])
+    g_mag = stars["M_G"] + 5*np.log10(stars["distance"]/10)
+    error_scale = 0.02 + 0.3*np.exp((g_mag - 21)/1.5)
+    parallax_error = error_scale*rng.uniform(0.8, 1.2, star_count)
+    pm_error = 1.1*error_scale*rng.uniform(0.8, 1.2, star_count)
+    return {
+        "ra": stars["ra"],
+        "dec": stars["dec"],
+        "parallax": 1000/stars["distance"] - 0.03 + rng.normal(0, 1, star_count)*parallax_error,
+        "parallax_error": parallax_error,
+        "pmra": stars["pmra"] + rng.normal(0, 1, star_count)*pm_error,
+        "pmra_error": pm_error,
+        "pmdec": stars["pmdec"] + rng.normal(0, 1, star_count)*pm_error,
+        "pmdec_error": pm_error,
+        "phot_g_mean_mag": g_mag,
+        "bp_rp": stars["bp_rp"] + rng.normal(0, 0.01, star_count),
+    }
+
+
+def disk_field(rng, ra_cen, dec_cen, radius, star_count, max_distance=1000):
+    """ Field stars uniform on the sky, with distances following the volume density
+    (out to max_distance pc) and a broad proper motion distribution centered near 0. """
+    ra, dec = cap_positions(rng, ra_cen, dec_cen, radius, star_count)
+    distance = max_distance*rng.random(star_count)**(1/3) + 20
+    velocity = rng.normal(0, 25, (2, star_count))
+    bp_rp, m_g = main_sequence(rng, star_count)
+    return {"ra": ra, "dec": dec, "distance": distance,\
+     "pmra": -2 + velocity[0]*KMS_TO_MAS_YR*1000/distance,\
+     "pmdec": -1 + velocity[1]*KMS_TO_MAS_YR*1000/distance, "bp_rp": bp_rp, "M_G": m_g}
+
+
+def cluster_stars(rng, ra_cen, dec_cen, cluster):
+    """ The stars of one injected cluster: a Gaussian ball of the cluster size in pc,
+    with the cluster's internal velocity dispersion. """
+    star_count = cluster["stars"]
+    offsets = rng.normal(0, cluster["size"], (3, star_count))
+    distance = cluster["distance"] + offsets[2]
+    dec_center = dec_cen + cluster["dec_offset"]
+    dec = dec_center + np.degrees(offsets[1]/distance)
+    ra = (ra_cen + cluster["ra_offset"] + np.degrees(offsets[0]/distance)/\
+     np.cos(np.radians(dec_center))) % 360
+    velocity = rng.normal(0, cluster["pm_dispersion"], (2, star_count))
+    bp_rp, m_g = main_sequence(rng, star_count)
+    white_dwarfs = min(cluster.get("white_dwarfs", 0), star_count)
+    bp_rp[:white_dwarfs] = rng.uniform(-0.2, 0.2, white_dwarfs)
+    m_g[:white_dwarfs] = 11.5 + 5.556*bp_rp[:white_dwarfs] + rng.uniform(0, 1, white_dwarfs)
+    return {"ra": ra, "dec": dec, "distance": distance,\
+     "pmra": cluster["pmra"] + velocity[0]*KMS_TO_MAS_YR*1000/distance,\
+     "pmdec": cluster["pmdec"] + velocity[1]*KMS_TO_MAS_YR*1000/distance,\
+     "bp_rp": bp_rp, "M_G": m_g}
+
+
+def synthetic_field(field_stars, clusters=None, ra_cen=0.0, dec_cen=-30.0, radius=2.5, seed=0):
+    """ A synthetic field of field_stars disk stars plus the injected clusters (by
+    default DEFAULT_CLUSTERS) within radius degrees of the center.  The parallax and
+    parallax error ratio cuts of gaia_search.py (parallax >= 1 and
+    parallax/parallax_error >= 3) are applied, so the returned star count is somewhat
+    smaller than requested.  The default center spans RA=0,360 like Blanco 1. """
+    if clusters is None:
+        clusters = DEFAULT_CLUSTERS
+    rng = np.random.default_rng(seed)
+    populations = [disk_field(rng, ra_cen, dec_cen, radius, field_stars)]
+    labels = [np.full(field_stars, -1)]
+    for number, cluster in enumerate(clusters):
+        populations.append(cluster_stars(rng, ra_cen, dec_cen, cluster))
+        labels.append(np.full(cluster["stars"], number))
+    stars = {column: np.concatenate([population[column] for population in populations])\
+     for column in populations[0]}
+    field = pd.DataFrame(observe(rng, stars))
+    field["injected_cluster"] = np.concatenate(labels)
+    field = field.loc[(field["parallax"] >= 1) & (field["parallax"]/field["parallax_error"] >= 3)]
+    # Shuffled so the injected clusters are not grouped in the file.
+    field = field.iloc[rng.permutation(len(field))]
+    field.insert(0, "source_id", rng.choice(2**62, len(field), replace=False).astype(np.int64))
+    return field.reset_index(drop=True)[OUTPUT_COLUMNS]
+
+
+def write_field(field, cluster_name, field_radius):
+    """ Writes the field to the "<cluster_name>gaiafield<field_radius>.csv" file read by
+    the clustering scripts, in the same format as gaia_search.py.  Returns the filename. """
+    from field_store import field_filename
+
+    filename = field_filename(cluster_name, field_radius)
+    field.to_csv(filename)
+    return filename
@@ -0,0 +1,234 @@
+""" A local stand-in for the Gaia DR2 TAP service that serves synthetic sources, so the
+    gaia_search.py downloaders can be checked for throughput and recovery from failed
+    queries without network access.  Only the ADQL produced by gaia_search.gaia_query
+    is understood: the CIRCLE, the parallax and parallax_over_error cuts, and the
+    optional RA and DEC tile bounds.  StandinResolver likewise stands in for SIMBAD name
+    resolution, so the query_cache.py cache can be checked end to end.
+
+    Usage: python tap_standin.py [download|cache] """
+import argparse
+import io
+import os
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import numpy as np
+from astropy.io.votable import from_table
+from astropy.io.votable.tree import Info
+from astropy.table import Table
+from synthetic_field import cap_positions
+
+FLOAT = r"([-+]?[0-9]*\.?[0-9]+(?:[eE][-+]?[0-9]+)?)"
+CIRCLE_PATTERN = re.compile(r"CIRCLE\('ICRS',\s*"+FLOAT+r",\s*"+FLOAT+r",\s*"+FLOAT+r"\)")
+CUT_PATTERN = re.compile(r"gaia_source\.(ra|dec|parallax|parallax_over_error)\s*(>=|<)\s*"+FLOAT)
+
+
+def synthetic_field(ra_cen, dec_cen, radius, star_count, seed=0):
+    """ Uniformly distributes star_count sources over a cap of the given radius (degrees)
+    with the gaia_search.py output columns and plausible astrometry and photometry. """
+    rng = np.random.default_rng(seed)
+    ra, dec = cap_positions(rng, ra_cen, dec_cen, radius, star_count)
+    parallax = rng.lognormal(0.3, 0.6, star_count)
+    parallax_error = rng.uniform(0.02, 0.4, star_count)
+    return {
+        "source_id": rng.choice(2**62, star_count, replace=False).astype(np.int64),
+        "ra": ra,
+        "dec": dec,
+        "parallax": parallax,
+        "parallax_error": parallax_error,
+        "pmra": rng.normal(0, 8, star_count),
+        "pmra_error": rng.uniform(0.02, 0.5, star_count),
+        "pmdec": rng.normal(0, 8, star_count),
+        "pmdec_error": rng.uniform(0.02, 0.5, star_count),
+        "phot_g_mean_mag": rng.uniform(8, 21, star_count),
+        "bp_rp": rng.uniform(-0.3, 3.2, star_count),
+    }
+
+
+def select_rows(field, query):
+    """ Returns the boolean selection of the field sources matching the query. """
+    circle = CIRCLE_PATTERN.search(query)
+    if circle is None:
+        raise ValueError("query has no CIRCLE constraint")
+    ra_cen, dec_cen, radius = (float(value) for value in circle.groups())
+    ra1, dec1 = np.radians(ra_cen), np.radians(dec_cen)
+    ra2, dec2 = np.radians(field["ra"]), np.radians(field["dec"])
+    hav = np.sin((dec2 - dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2 - ra1)/2)**2
+    keep = np.degrees(2*np.arcsin(np.minimum(1, np.sqrt(hav)))) <= radius
+    for column, operator, value in CUT_PATTERN.findall(query):
+        if column == "parallax_over_error":
+            values = field["parallax"]/field["parallax_error"]
+        else:
+            values = field[column]
+        keep &= values >= float(value) if operator == ">=" else values < float(value)
+    return keep
+
+
+def votable_bytes(field, keep):
+    """ Serializes the selected sources as a TAP result VOTable. """
+    table = Table({name: values[keep] for name, values in field.items()})
+    votable = from_table(table)
+    votable.resources[0].type = "results"
+    votable.resources[0].infos.append(Info(name="QUERY_STATUS", value="OK"))
+    output = io.BytesIO()
+    votable.to_xml(output)
+    return output.getvalue()
+
+
+class StandinTapServer:
+    """ Serves a synthetic field over the TAP sync endpoint on localhost.  latency
+    (seconds) is added to every query, and fail_every makes every n-th query fail
+    with an HTTP 500 error so that retries can be exercised.  The counts of queries
+    served and failed are kept in requests and failures. """
+
+    def __init__(self, field, latency=0.0, fail_every=0, port=0):
+        self.field = field
+        self.latency = latency
+        self.fail_every = fail_every
+        self.requests = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        """ The TAP base url to hand to gaia_search. """
+        return "http://127.0.0.1:"+str(self._server.server_address[1])+"/tap"
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """ Answers sync TAP queries from the synthetic field. """
+
+            def log_message(self, *args):
+                pass
+
+            def _answer(self, params):
+                with standin._lock:
+                    standin.requests += 1
+                    failing = standin.fail_every > 0 and standin.requests % standin.fail_every == 0
+                    if failing:
+                        standin.failures += 1
+                time.sleep(standin.latency)
+                if not urlparse(self.path).path.endswith("/sync") or failing:
+                    self.send_error(404 if not failing else 500)
+                    return
+                try:
+                    keep = select_rows(standin.field, params.get("QUERY", [""])[0])
+                except ValueError as error:
+                    self.send_error(400, str(error))
+                    return
+                body = votable_bytes(standin.field, keep)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-votable+xml")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._answer(parse_qs(urlparse(self.path).query))
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                self._answer(parse_qs(self.rfile.read(length).decode()))
+
+        return Handler
+
+    def start(self):
+        """ Starts serving in a background thread and returns the server. """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops serving and releases the port. """
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class StandinResolver:
+    """ Resolves object names from a dictionary of name: (RA, DEC), counting the lookups
+    in calls like a stand-in for SIMBAD. """
+
+    def __init__(self, positions):
+        self.positions = positions
+        self.calls = 0
+
+    def __call__(self, object_name):
+        self.calls += 1
+        return self.positions[object_name]
+
+
+def download_check():
+    """ Downloads a synthetic 2 degree field through the tiled downloader with some
+    failing queries, and compares it with the expected sources. """
+    import pandas as pd
+    import gaia_search
+
+    ra_cen, dec_cen, radius = 359.5, -28.0, 2.0
+    field = synthetic_field(ra_cen, dec_cen, radius + 0.1, 200000)
+    expected = set(field["source_id"][select_rows(field, gaia_search.gaia_query(ra_cen,\
+     dec_cen, radius))])
+    with StandinTapServer(field, latency=0.05, fail_every=7) as standin:
+        gaia_search.gaia_call_tiled(ra_cen, dec_cen, radius, "standin_gaiafield.csv",\
+         standin.url, backoff=0.1)
+        print(str(standin.requests)+" queries served, "+str(standin.failures)+" failed")
+    downloaded = pd.read_csv("standin_gaiafield.csv")["source_id"]
+    print("Duplicates: "+str(downloaded.duplicated().sum())+", missing: "+\
+     str(len(expected - set(downloaded)))+", unexpected: "+str(len(set(downloaded) - expected)))
+
+
+def cache_check():
+    """ Runs a 2 degree search, the same search under another cluster name, and a 2.5
+    degree search through query_cache.py in a temporary cache directory, printing the
+    SIMBAD lookups and TAP queries each one needed and checking every csv against the
+    expected sources. """
+    import tempfile
+    import pandas as pd
+    import gaia_search
+    import query_cache
+
+    ra_cen, dec_cen = 359.5, -28.0
+    field = synthetic_field(ra_cen, dec_cen, 2.6, 300000)
+    resolver = StandinResolver({"Standin1": (ra_cen, dec_cen), "standin 1": (ra_cen, dec_cen)})
+    with tempfile.TemporaryDirectory() as cache_dir, StandinTapServer(field, fail_every=11)\
+     as standin:
+        for object_name, radius in [("Standin1", 2.0), ("standin 1", 2.0), ("Standin1", 2.5),\
+         ("Standin1", 1.0)]:
+            requests, calls = standin.requests, resolver.calls
+            ra_obj, dec_obj = query_cache.resolve_object(object_name, cache_dir, resolver)
+            filename = os.path.join(cache_dir, "standin_gaiafield"+str(radius)+".csv")
+            query_cache.cached_cone(ra_obj, dec_obj, radius, filename, standin.url, cache_dir,\
+             backoff=0.1)
+            expected = set(field["source_id"][select_rows(field, gaia_search.gaia_query(ra_obj,\
+             dec_obj, radius))])
+            downloaded = pd.read_csv(filename)["source_id"]
+            print(object_name+" r="+str(radius)+": "+str(resolver.calls - calls)+\
+             " SIMBAD lookups, "+str(standin.requests - requests)+" TAP queries, "+\
+             str(len(downloaded))+" stars, duplicates: "+str(downloaded.duplicated().sum())+\
+             ", missing: "+str(len(expected - set(downloaded)))+", unexpected: "+\
+             str(len(set(downloaded) - expected)))
+
+
+def main():
+    """ Runs the tiled download check or the query cache check. """
+    parser = argparse.ArgumentParser(description="Check gaia_search.py against a local TAP stand-in.")
+    parser.add_argument("check", nargs="?", choices=["download", "cache"], default="download")
+    if parser.parse_args().check == "cache":
+        cache_check()
+    else:
+        download_check()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+""" Clusters survey areas too large for a single ra_wrapper projection and HDBSCAN fit
+    (tens to hundreds of square degrees, including the poles).  The sky is split into a
+    fixed grid of tiles roughly TILE_SIZE degrees across, and each tile is clustered on
+    its own, in parallel worker processes, together with a halo of the stars within
+    TILE_HALO degrees of it.  Every tile uses its own tangent-plane (gnomonic)
+    projection about its center in place of ra_wrapper, so each worker only holds its
+    tile's stars.
+
+    Each star takes its label from the tile that owns it.  Clusters found by
+    neighbouring tiles are then merged into one cluster when they share enough stars
+    (through the halos) and have consistent median proper motions and distances.  The
+    halo should be wider than the largest cluster, so that a cluster crossing a tile
+    edge is seen whole by the tiles on both sides.  The output is one labelled field
+    and one catalogue of all clusters.
+
+    Usage: python tiled_clustering.py CLUSTER_NAME FIELD_RADIUS [--tile-size DEG]
+     [--halo DEG] [--workers N] """
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+# The tile size and halo width (degrees), and the number of tiles clustered at once
+# (None for one per core, up to the number of tiles).
+TILE_SIZE = 5
+TILE_HALO = 1
+TILE_WORKERS = None
+
+# Two tile clusters are merged when the stars they share are at least MERGE_OVERLAP of
+# the smaller cluster, their median proper motions differ by less than MERGE_PM (mas/yr)
+# in each axis, and their median distances differ by less than MERGE_DISTANCE of the
+# mean of the two.
+MERGE_OVERLAP = 0.3
+MERGE_PM = 1.0
+MERGE_DISTANCE = 0.1
+
+MIN_CLUSTER_SIZE = 50
+
+
+def tile_grid(tile_size=TILE_SIZE):
+    """ The fixed tile grid: the lower DEC edge of every DEC band (from -90) and its
+    number of RA tiles, chosen so that no tile is wider than tile_size degrees.  The
+    bands touching the poles are a single polar cap tile. """
+    band_lows = np.arange(-90, 90, tile_size, dtype=np.float64)
+    band_highs = np.minimum(band_lows + tile_size, 90)
+    widest = np.where((band_lows < 0) & (band_highs > 0), 0,\
+     np.minimum(np.abs(band_lows), np.abs(band_highs)))
+    ra_counts = np.maximum(1, np.ceil(360*np.cos(np.radians(widest))/tile_size)).astype(np.int64)
+    ra_counts[(band_lows <= -90) | (band_highs >= 90)] = 1
+    return band_lows, ra_counts
+
+
+def assign_tiles(ra, dec, tile_size=TILE_SIZE):
+    """ The (DEC band, RA column) of the tile that owns each star. """
+    band_lows, ra_counts = tile_grid(tile_size)
+    band = np.clip(np.floor((dec + 90)/tile_size).astype(np.int64), 0, len(band_lows) - 1)
+    column = np.floor(ra/(360/ra_counts[band])).astype(np.int64) % ra_counts[band]
+    return band, column
+
+
+def tile_center(band, column, tile_size=TILE_SIZE):
+    """ The projection center (RA, DEC) of a tile.  Polar caps are centered on the pole. """
+    band_lows, ra_counts = tile_grid(tile_size)
+    low = band_lows[band]
+    high = min(low + tile_size, 90)
+    if low <= -90:
+        return 0.0, -90.0
+    if high >= 90:
+        return 0.0, 90.0
+    return (column + 0.5)*360/ra_counts[band], (low + high)/2
+
+
+def tile_region(ra, dec, band, column, tile_size=TILE_SIZE, halo=TILE_HALO):
+    """ A boolean mask of the stars within the tile or its halo. """
+    band_lows, ra_counts = tile_grid(tile_size)
+    low = band_lows[band] - halo
+    high = min(band_lows[band] + tile_size, 90) + halo
+    mask = (dec >= low) & (dec < high)
+    extreme = max(abs(low), abs(high))
+    width = 360/ra_counts[band]
+    if extreme >= 89.9 or ra_counts[band] == 1:
+        return mask
+    extension = halo/np.cos(np.radians(extreme))
+    if width + 2*extension >= 360:
+        return mask
+    return mask & ((ra - column*width + extension) % 360 < width + 2*extension)
+
+
+def gnomonic(ra, dec, ra_cen, dec_cen):
+    """ The tangent-plane coordinates (radians) of RA and DEC about the center. """
+    ra_rad = np.radians(ra - ra_cen)
+    dec_rad = np.radians(dec)
+    dec_cen_rad = np.radians(dec_cen)
+    cos_c = np.sin(dec_cen_rad)*np.sin(dec_rad) + np.cos(dec_cen_rad)*np.cos(dec_rad)*np.cos(ra_rad)
+    xi = np.cos(dec_rad)*np.sin(ra_rad)/cos_c
+    eta = (np.cos(dec_cen_rad)*np.sin(dec_rad) -\
+     np.sin(dec_cen_rad)*np.cos(dec_rad)*np.cos(ra_rad))/cos_c
+    return xi, eta
+
+
+def cluster_tile(columns, center, distance_scale, pm_scale, min_samples,\
+ min_cluster_size=MIN_CLUSTER_SIZE, core_dist_n_jobs=1):
+    """ Clusters one tile's stars (a dictionary of the ra, dec, pmra, pmdec, and distance
+    arrays) in the tangent plane about center, with the same scaled parameters as
+    scaled_features.  Returns the labels and probabilities. """
+    import hdbscan
+
+    xi, eta = gnomonic(columns["ra"], columns["dec"], *center)
+    features = np.empty((len(xi), 5), dtype=np.float64)
+    features[:, 0] = xi*columns["distance"]
+    features[:, 1] = eta*columns["distance"]
+    features[:, 2] = columns["pmra"]*pm_scale
+    features[:, 3] = columns["pmdec"]*pm_scale
+    features[:, 4] = columns["distance"]/distance_scale
+    if len(features) <= max(min_samples, min_cluster_size):
+        return np.full(len(features), -1), np.zeros(len(features))
+    clustering = hdbscan.HDBSCAN(min_cluster_size=min_cluster_size, min_samples=min_samples,\
+     cluster_selection_method="leaf", core_dist_n_jobs=core_dist_n_jobs).fit(features)
+    return clustering.labels_, clustering.probabilities_
+
+
+def _root(parents, node):
+    """ The union-find root of node, compressing the path to it. """
+    root = node
+    while parents[root] != root:
+        root = parents[root]
+    while parents[node] != root:
+        parents[node], node = root, parents[node]
+    return root
+
+
+def merge_tile_clusters(star_count, tiles, pmra, pmdec, distance, overlap=MERGE_OVERLAP,\
+ pm_limit=MERGE_PM, distance_limit=MERGE_DISTANCE):
+    """ Combines the tile results into global labels and probabilities.  tiles is a list
+    of (rows, owned, labels, probabilities) per tile, where rows are the field row
+    positions of the tile's stars and owned marks the stars the tile owns.  Each tile
+    cluster is a node, nodes sharing enough stars with consistent proper motions and
+    distances are joined, and the joined clusters are numbered by decreasing size.
+    Also returns the number of tiles each cluster spans. """
+    node_rows, node_labels, node_offsets = [], [], [0]
+    for rows, _, labels, _ in tiles:
+        clustered = labels >= 0
+        node_rows.append(rows[clustered])
+        node_labels.append(labels[clustered] + node_offsets[-1])
+        node_offsets.append(node_offsets[-1] + (labels.max() + 1 if len(labels) else 0))
+    node_rows = np.concatenate(node_rows)
+    node_labels = np.concatenate(node_labels)
+    node_count = node_offsets[-1]
+    sizes = np.bincount(node_labels, minlength=node_count)
+    medians = np.full((node_count, 3), np.nan)
+    for node in np.flatnonzero(sizes):
+        members = node_rows[node_labels == node]
+        medians[node] = np.median(pmra[members]), np.median(pmdec[members]),\
+         np.median(distance[members])
+
+    # Every pair of nodes holding the same star, counted once per shared star.
+    order = np.lexsort((node_labels, node_rows))
+    sorted_rows, sorted_nodes = node_rows[order], node_labels[order]
+    pairs = []
+    for shift in range(1, len(tiles)):
+        same = sorted_rows[shift:] == sorted_rows[:-shift]
+        if not same.any():
+            break
+        pairs.append(np.stack([sorted_nodes[:-shift][same], sorted_nodes[shift:][same]], axis=1))
+    parents = list(range(node_count))
+    if pairs:
+        pairs, shared = np.unique(np.concatenate(pairs), axis=0, return_counts=True)
+        for (node_a, node_b), count in zip(pairs, shared):
+            if count < overlap*min(sizes[node_a], sizes[node_b]):
+                continue
+            difference = np.abs(medians[node_a] - medians[node_b])
+            if difference[0] < pm_limit and difference[1] < pm_limit and difference[2] <\
+             distance_limit*(medians[node_a, 2] + medians[node_b, 2])/2:
+                parents[_root(parents, node_a)] = _root(parents, node_b)
+    roots = np.array([_root(parents, node) for node in range(node_count)], dtype=np.int64)
+
+    # Each star's label comes from the tile that owns it.
+    star_nodes = np.full(star_count, -1, dtype=np.int64)
+    probabilities = np.zeros(star_count)
+    for (rows, owned, labels, tile_probabilities), offset in zip(tiles, node_offsets):
+        keep = owned & (labels >= 0)
+        star_nodes[rows[keep]] = roots[labels[keep] + offset]
+        probabilities[rows[keep]] = tile_probabilities[keep]
+    clustered = star_nodes >= 0
+    groups, inverse, counts = np.unique(star_nodes[clustered], return_inverse=True,\
+     return_counts=True)
+    rank = np.empty(len(groups), dtype=np.int64)
+    rank[np.argsort(-counts, kind="stable")] = np.arange(len(groups))
+    labels = np.full(star_count, -1, dtype=np.int64)
+    labels[clustered] = rank[inverse]
+    node_tiles = np.searchsorted(node_offsets, np.arange(node_count), side="right") - 1
+    spans = np.zeros(len(groups), dtype=np.int64)
+    group_of_root = dict(zip(groups.tolist(), rank.tolist()))
+    for group in groups:
+        spans[group_of_root[group]] = len(np.unique(node_tiles[roots == group]))
+    return labels, probabilities, spans
+
+
+def cluster_centers(ra, dec, labels):
+    """ The mean sky position (RA, DEC) of every cluster, from the mean unit vector of
+    its stars so that RA=0,360 and the poles need no special handling. """
+    clustered = labels >= 0
+    count = labels.max() + 1 if clustered.any() else 0
+    ra_rad = np.radians(ra[clustered])
+    dec_rad = np.radians(dec[clustered])
+    vectors = [np.bincount(labels[clustered], weights=component, minlength=count) for component in\
+     (np.cos(dec_rad)*np.cos(ra_rad), np.cos(dec_rad)*np.sin(ra_rad), np.sin(dec_rad))]
+    ra_cen = np.degrees(np.arctan2(vectors[1], vectors[0])) % 360
+    dec_cen = np.degrees(np.arctan2(vectors[2], np.hypot(vectors[0], vectors[1])))
+    return ra_cen, dec_cen
+
+
+def tiled_clustering(fieldpar, tile_size=TILE_SIZE, halo=TILE_HALO, distance_scale=None,\
+ pm_scale=None, min_samples=None, min_cluster_size=MIN_CLUSTER_SIZE, workers=TILE_WORKERS):
+    """ Clusters a field of any size (from gaia_dr2_read_setup) tile by tile and merges
+    the tiles.  The scalings and min_samples default to the cluster_hdbscan.py values.
+    Adds the clusternum, clusterprob, tile (owning tile number), and M_G columns to
+    fieldpar, and returns it with the catalogue of every cluster (its ClusterSummary
+    statistics, mean position, and the number of tiles it spans). """
+    import cluster_hdbscan
+    from cluster_summary import ClusterSummary
+
+    if distance_scale is None:
+        distance_scale = cluster_hdbscan.DISTANCE_SCALE
+    if pm_scale is None:
+        pm_scale = cluster_hdbscan.PM_SCALE
+    if min_samples is None:
+        min_samples = cluster_hdbscan.MIN_SAMPLE
+    columns = {name: fieldpar[name].to_numpy(dtype=np.float64) for name in\
+     ["ra", "dec", "pmra", "pmdec", "distance"]}
+    band, column = assign_tiles(columns["ra"], columns["dec"], tile_size)
+    owners = np.unique(np.stack([band, column], axis=1), axis=0)
+    tile_number = np.zeros(len(fieldpar), dtype=np.int64)
+    for number, (tile_band, tile_column) in enumerate(owners):
+        tile_number[(band == tile_band) & (column == tile_column)] = number
+
+    cores = os.cpu_count() or 1
+    if workers is None:
+        workers = min(len(owners), cores)
+    workers = max(1, workers)
+    core_dist_n_jobs = max(1, cores//workers)
+    regions = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for number, (tile_band, tile_column) in enumerate(owners):
+            rows = np.flatnonzero(tile_region(columns["ra"], columns["dec"], tile_band,\
+             tile_column, tile_size, halo))
+            regions.append((rows, tile_number[rows] == number))
+            futures.append(executor.submit(cluster_tile, {name: values[rows] for name, values\
+             in columns.items()}, tile_center(tile_band, tile_column, tile_size), distance_scale,\
+             pm_scale, min_samples, min_cluster_size, core_dist_n_jobs))
+        tiles = [(rows, owned) + future.result() for (rows, owned), future in zip(regions, futures)]
+
+    labels, probabilities, spans = merge_tile_clusters(len(fieldpar), tiles, columns["pmra"],\
+     columns["pmdec"], columns["distance"])
+    fieldpar["clusternum"] = labels
+    fieldpar["clusterprob"] = probabilities
+    fieldpar["tile"] = tile_number
+    fieldpar["M_G"] = fieldpar["phot_g_mean_mag"] - np.log10(fieldpar["distance"]/10)*5
+    catalogue = ClusterSummary(fieldpar).table
+    catalogue["ra_center"], catalogue["dec_center"] = cluster_centers(columns["ra"],\
+     columns["dec"], labels)
+    catalogue["tiles"] = spans
+    return fieldpar, catalogue
+
+
+def main():
+    """ Parses the command line, clusters the field tile by tile, and writes the
+    catalogue to "<CLUSTER_NAME>tiledclusters.csv" and the clustered stars to
+    "<CLUSTER_NAME>tiledclustering.csv". """
+    import cluster_hdbscan
+
+    parser = argparse.ArgumentParser(description="Cluster a large Gaia field tile by tile.")
+    parser.add_argument("name", help="CLUSTER_NAME of the input \"<name>gaiafield<radius>.csv\"")
+    parser.add_argument("radius", help="FIELD_RADIUS of the input csv")
+    parser.add_argument("--tile-size", type=float, default=TILE_SIZE, help="tile size (degrees)")
+    parser.add_argument("--halo", type=float, default=TILE_HALO, help="halo width (degrees)")
+    parser.add_argument("--workers", type=int, default=TILE_WORKERS,\
+     help="number of tiles clustered at once (default: one per core)")
+    args = parser.parse_args()
+    fieldpar = cluster_hdbscan.gaia_dr2_read_setup(args.name, args.radius)
+    fieldpar, catalogue = tiled_clustering(fieldpar, args.tile_size, args.halo,\
+     workers=args.workers)
+    print(catalogue.loc[catalogue["real_cluster"]].to_string())
+    catalogue.to_csv(args.name+"tiledclusters.csv")
+    fieldpar.loc[fieldpar["clusternum"] >= 0].to_csv(args.name+"tiledclustering.csv")
+
+
+if __name__ == "__main__":
+    main()